@@ -20,6 +20,7 @@ import os
 import neuralNetwork as nn
 import DataGeneration.lammpsData as lammps
 import DataGeneration.symmetries as symmetries
+import DataGeneration.symmetryCache as symmetryCache
 import DataGeneration.readers as readers
 
 
@@ -59,12 +60,15 @@ class Analyze:
                  symmetry = False, \
                  numberOfAtoms = 3, \
                  klargerj = True, \
+                 symmFuncType = 'G5', \
                  cut = False, \
                  tags = False, \
                  forceFile = 'forcesklargerjplus.txt', \
                  plotEnergy=True, \
                  plotForces=True, \
-                 plotConfigSpace=True):
+                 plotConfigSpace=True, \
+                 batchSize=10000, \
+                 chunkSize=None):
         
         self.energy             = energy
         self.forces             = forces
@@ -72,12 +76,15 @@ class Analyze:
         self.symmetry           = symmetry
         self.numberOfAtoms      = numberOfAtoms
         self.klargerj           = klargerj
+        self.symmFuncType       = symmFuncType
         self.cut                = cut
         self.tags               = tags
         self.forceFile          = forceFile
         self.plotEnergy         = plotEnergy
         self.plotForces         = plotForces
         self.plotConfigSpace    = plotConfigSpace
+        self.batchSize          = batchSize
+        self.chunkSize          = chunkSize
         
         self.startSession()
         
@@ -127,24 +134,35 @@ class Analyze:
                 print 'Using k != j symmetry vectors'
                 
             symmetryFileName = '../' + self.lammpsDir + 'symmetry0.txt'
+            self.symmetryFileName = symmetryFileName
             
-            if os.path.isfile(symmetryFileName):
-                print "Reading symmetrized Behler data"
-                self.inputData = readers.readSymmetryData(symmetryFileName)
-            else: 
+            # the energy analysis can stream the symmetry file in chunks,
+            # the others need all input vectors in memory
+            stream = self.chunkSize and not (self.forces or self.configSpace or self.symmetry)
+            
+            if not os.path.isfile(symmetryFileName):
                 print "Symmetry values file does not exist, has to be made"
                 exit(1)
+            elif stream:
+                print "Streaming symmetrized Behler data in chunks of %d" % self.chunkSize
+                self.inputData = None
+                with open(symmetryFileName, 'r') as infile:
+                    self.numberOfSamples = sum(1 for line in infile if line.strip())
+            else:
+                print "Reading symmetrized Behler data"
+                self.inputData = readers.readSymmetryData(symmetryFileName)
              
-            print "Min symm. value: ", np.min(self.inputData)
-            print "Max symm. value: ", np.max(self.inputData)
+                print "Min symm. value: ", np.min(self.inputData)
+                print "Max symm. value: ", np.max(self.inputData)
                 
-            self.numberOfSamples = len(self.inputData)
+                self.numberOfSamples = len(self.inputData)
             self.numberOfTimeSteps = self.numberOfSamples/self.numberOfAtoms
             print "Number of samples: ", self.numberOfSamples
             print "Number of time steps: ", self.numberOfTimeSteps
     
             # read energy forces
             neighbourLists = '../' + self.lammpsDir + "neighbours0.txt"
+            self.neighbourLists = neighbourLists
             """if self.tags:
                 print "Reading forces and tags"
                 x0, y0, z0, r0, E, Fx, Fy, Fz, tags = readers.readNeighbourDataForceTag(neighbourLists)
@@ -177,8 +195,9 @@ class Analyze:
             with tf.name_scope('networkGradient'):
                 self.networkGradient = tf.gradients(neuralNetwork.allActivations[-1], self.x)
                 
-            with tf.name_scope('L2Force'):
-                CFDATrain = tf.nn.l2_loss( tf.subtract(self.networkGradient, self.inputData) ) 
+            if self.inputData is not None:
+                with tf.name_scope('L2Force'):
+                    CFDATrain = tf.nn.l2_loss( tf.subtract(self.networkGradient, self.inputData) ) 
             
             if self.energy:
                 self.analyzeEnergy(sess)
@@ -194,28 +213,39 @@ class Analyze:
             
             
             
+    def predictEnergies(self, sess, inputData):
+        """
+        Network energies of the input vectors, batchSize vectors per session call
+        """
+        
+        energies = np.zeros(len(inputData))
+        for start in xrange(0, len(inputData), self.batchSize):
+            end = min(start + self.batchSize, len(inputData))
+            energies[start:end] = sess.run(self.prediction, 
+                                           feed_dict={self.x: inputData[start:end]})[:,0]
+                                           
+        return energies
+            
+            
     def analyzeEnergy(self, sess):
         
-        x               = self.x
-        y               = self.y
-        inputData       = self.inputData
         E               = self.E
         numberOfSamples = self.numberOfSamples
-        prediction      = self.prediction
-        cost            = self.cost
-        inputs          = self.inputs
-    
-        # calculate RMSE of this NN
-        RMSE = np.sqrt( 2*sess.run(cost, feed_dict={x: inputData, y: E}) )
-        print "RMSE/atom: ", RMSE
         
-        # make energy error vs time step plot
-        energyNN = np.zeros(numberOfSamples)
+        # evaluate energies in batches, chunk by chunk when streaming
+        if self.inputData is None:
+            chunks = readers.readSymmetryChunks(self.symmetryFileName, self.chunkSize)
+        else:
+            chunks = [self.inputData]
+        energyNN = np.concatenate([self.predictEnergies(sess, chunk) for chunk in chunks])
         energySW = E[:,0].reshape([numberOfSamples])
-        for i in xrange(numberOfSamples):
-            energyNN[i] = sess.run(prediction, feed_dict={x: inputData[i].reshape([1,inputs])})
             
+        # calculate RMSE of this NN
         energyError = energyNN - energySW
+        RMSE = np.sqrt( np.sum(energyError**2) / numberOfSamples )
+        print "RMSE/atom: ", RMSE
+        
+        # make energy error vs time step plot
         aveError = np.sum(energyError) / len(energyError)
         print "Average error: ", aveError
         print "First 5 energies: ", energyNN[:20]
@@ -257,7 +287,17 @@ class Analyze:
             # calculate deriviative of NN
             dEdG = sess.run(networkGradient, feed_dict={x: inputData})
             dEdG = np.array(dEdG).reshape([numberOfSamples, inputs])
-            symmetries.calculateForces(x0, y0, z0, r0, parameters, forceFile, dEdG)
+            
+            # sparse derivatives of the symmetry functions, cached with the neighbour file
+            neighbourLists = self.neighbourLists
+            cacheDir = os.path.dirname(neighbourLists) + '/symmetryCache/'
+            digest = symmetryCache.neighbourDigest(neighbourLists, cacheDir)
+            xFlat, yFlat, zFlat, rFlat, offsets = symmetries.neighbourArrays(x0, y0, z0, r0)
+            derivatives = lammps.symmetryDerivatives(xFlat, yFlat, zFlat, rFlat, offsets, self.parameters, 
+                                                     self.symmFuncType, self.klargerj, cacheDir, digest)
+            symmetries.calculateForces(x0, y0, z0, r0, self.parameters, forceFile, dEdG, 
+                                       symmFuncType=self.symmFuncType, klargerj=self.klargerj, 
+                                       derivatives=derivatives)
             print
             print "Forces are written to file"
 
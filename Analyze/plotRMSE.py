@@ -1,9 +1,25 @@
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir) 
+
 import matplotlib.pyplot as plt
 import numpy as np
+import Tools.metricsLog as metricsLog
 
 # plot RMSE as function of epoch
 
 def readError(filename):
+    """
+    Epochs and RMSE of train and test of a meta.dat, 
+    read from the binary metrics.bin next to it if it exists
+    """
+    
+    metricsName = metricsLog.metricsFileName(filename)
+    if os.path.isfile(metricsName):
+        metrics = metricsLog.readMetrics(metricsName)
+        return metrics['epoch'].astype(float).tolist(), metrics['trainRMSE'].tolist(), \
+               metrics['testRMSE'].tolist()
     
     with open(filename) as infile:
         
@@ -5,22 +5,76 @@ import sys
 import symmetries
 import readers
 import symmetryParameters
+import symmetryCache
 import os
     
 
 
 def SiTrainingData(dataFolder, symmFuncType, function=None, forces=False, Behler=True, 
                    klargerj=False, tags=True, normalize=False, shiftMean=False, standardize=False, 
-                   trainingDir=''):
+                   trainingDir='', workers=1, chunkSize=None, tripletIndex=False, tableSpacing=None):
     """ 
     Coordinates and energies of neighbours is sampled from lammps
     Angular symmtry funcitons are used to transform input data  
+    If chunkSize is given the neighbour file is streamed with streamTrainingData
+    If tripletIndex is True the pair and triplet geometry of the neighbour file
+    is cached once and shared by all symmetry parameter sets
+    If tableSpacing is given the radial functions are interpolated in spline tables 
+    of that spacing, and the deviation from the exact symmetry functions over all 
+    environments is reported and stored with the cached data
     """
     
     filename = dataFolder + "neighbours.txt"
-     
-    # read file
+    
+    # stream neighbour files that are too large for memory
+    if chunkSize:
+        if forces or normalize or shiftMean or standardize or function != None or tableSpacing:
+            print 'Streaming only supports untransformed, exact symmetry data and energies from lammps'
+            exit(1)
+        if Behler:
+            parameters = symmetryParameters.SiBehler()
+        else:
+            parameters = symmetryParameters.SiBulkCustom()
+        inputTraining, outputTraining, inputTest, outputTest = \
+            streamTrainingData(filename, parameters, symmFuncType, chunkSize=chunkSize, 
+                               klargerj=klargerj, workers=workers)
+        
+        if trainingDir:
+            print 'Writing min and max of each symm func to file'
+            smin = np.min(inputTest, axis=0)
+            smax = np.max(inputTest, axis=0)
+            for start in xrange(0, len(inputTraining), chunkSize):
+                chunk = inputTraining[start:start+chunkSize]
+                smin = np.minimum(smin, np.min(chunk, axis=0))
+                smax = np.maximum(smax, np.max(chunk, axis=0))
+            with open(trainingDir + '/minmax.txt', 'w') as outfile:
+                for s in xrange(len(parameters)):
+                    outfile.write('%g %g' % (smin[s], smax[s]))
+                    outfile.write('\n')
+                    
+        return inputTraining, outputTraining, inputTest, outputTest, len(parameters), 1, parameters, None, None
+    columns = []
     if forces:
+        columns.append('F')
+        if tags:
+            columns.append('tags')
+    binaryDir = readers.currentBinaryDir(filename, columns)
+    offsets = None
+     
+    # read file, the binary columnar version if it has been converted
+    if binaryDir:
+        print "Reading binary neighbour lists:", binaryDir
+        data = readers.readNeighbourDataBinary(binaryDir)
+        x = data['x']; y = data['y']; z = data['z']; r = data['r']
+        offsets = data['offsets']
+        E = np.array(data['E']).reshape(-1, 1)
+        if forces:
+            F = np.array(data['F'])
+            Fx = F[:,0:1]
+            Fy = F[:,1:2]
+            Fz = F[:,2:3]
+            print "Forces are applied"
+    elif forces:
         if tags:
             print 
             print "Tags are included in neighbour lists"
@@ -80,19 +134,63 @@ def SiTrainingData(dataFolder, symmFuncType, function=None, forces=False, Behler
         symmetryFileName += '.txt'
         print "Using customized symmetry parameters"
             
-    # apply symmetry or read already existing file
-    if os.path.isfile(symmetryFileName):
-        print "Reading symmetrized input data:", symmetryFileName
-        inputData = readers.readSymmetryData(symmetryFileName)
-        outputData = np.array(E)
-        print "Energy is supplied from lammps"
-    else: 
+    # read untransformed symmetry data of an earlier run with the same 
+    # neighbour file and parameters from the cache, or apply symmetry
+    cacheDir = sampleDir + 'symmetryCache/'
+    originalInputData = None
+    if function is None:
+        digest = symmetryCache.neighbourDigest(filename if offsets is None else binaryDir, cacheDir)
+        if tableSpacing is None:
+            cacheKey = symmetryCache.symmetryKey(digest, parameters, symmFuncType, klargerj)
+        else:
+            cacheKey = symmetryCache.symmetryKey(digest, parameters, symmFuncType, klargerj, 
+                                                 'table', tableSpacing)
+        originalInputData = symmetryCache.loadSymmetryData(cacheDir, cacheKey)
+        if originalInputData is not None and tableSpacing is not None:
+            metadata = symmetryCache.loadMetadata(cacheDir, cacheKey)
+            if metadata and 'tableDeviation' in metadata:
+                symmetries.printTableDeviation(metadata['tableDeviation'], len(originalInputData))
+        
+    deviation = None
+    if originalInputData is None:
         # apply symmetry transformastion
         print 'Applying symmetry transformations...'
-        inputData, outputData, inputParams = symmetries.applyThreeBodySymmetry(x, y, z, r, parameters, symmFuncType, \
-                                                                  function=function, E=E, sampleName=symmetryFileName, 
-                                                                  forces=forces, klargerj=klargerj, 
-                                                                  normalize=normalize, shiftMean=shiftMean, standardize=standardize)
+        if tripletIndex and function is None:
+            if offsets is None:
+                x, y, z, r, offsets = symmetries.neighbourArrays(x, y, z, r)
+            indexKey = symmetryCache.tripletIndexKey(digest)
+            index = symmetryCache.loadTripletIndex(cacheDir, indexKey)
+            if index is None:
+                index = symmetries.buildTripletIndex(x, y, z, r, offsets)
+                symmetryCache.saveTripletIndex(cacheDir, indexKey, index)
+            originalInputData = symmetries.symmetryFromIndex(index, parameters, symmFuncType, klargerj=klargerj,
+                                                             tableSpacing=tableSpacing)
+            outputData = E
+        else:
+            originalInputData, outputData, _ = symmetries.applyThreeBodySymmetry(x, y, z, r, parameters, symmFuncType, \
+                                                                      function=function, E=E, forces=forces, klargerj=klargerj, 
+                                                                      workers=workers, offsets=offsets, 
+                                                                      tableSpacing=tableSpacing)
+        if tableSpacing is not None:
+            deviation = symmetries.tableDeviation(x, y, z, r, offsets, parameters, symmFuncType, 
+                                                  originalInputData, klargerj)
+        if function is None:
+            metadata = {'neighbourFile': filename, 'symmFuncType': symmFuncType, 'klargerj': klargerj, 
+                        'parameters': [[float(value) for value in p] for p in parameters], 
+                        'tableSpacing': tableSpacing, 'tableDeviation': deviation}
+            symmetryCache.saveSymmetryData(cacheDir, cacheKey, originalInputData, metadata)
+    else:
+        outputData = E
+        print "Energy is supplied from lammps"
+        
+    # the text files are only written for the analysis scripts
+    if os.path.isfile(symmetryFileName):
+        symmetryFileName = ''
+    inputData, outputData, inputParams = symmetries.transformInputData(originalInputData.copy(), 
+                                                                       np.array(outputData, dtype=float), 
+                                                                       sampleName=symmetryFileName, 
+                                                                       normalize=normalize, shiftMean=shiftMean, 
+                                                                       standardize=standardize)
         
         
     # split in training set and test set randomly
@@ -122,13 +220,9 @@ def SiTrainingData(dataFolder, symmFuncType, function=None, forces=False, Behler
                 outfile.write('\n')
                 
         
-        # if any transformations, read untransformed file to calculate means
+        # if any transformations, use the untransformed data to calculate means
         if shiftMean or normalize or standardize:
-            print 'Reading unshifted symmetry data'
-            originalTrainingData = readers.readSymmetryData(symmetryFileName.rsplit('S',1)[0] + '.txt')
-            print originalTrainingData
-            #exit(1)
-            originalTrainingData = np.delete(originalTrainingData, indicies, axis=0)
+            originalTrainingData = np.delete(originalInputData, indicies, axis=0)
         else:
             originalTrainingData = inputTraining
                 
@@ -186,23 +280,217 @@ def SiTrainingData(dataFolder, symmFuncType, function=None, forces=False, Behler
     return inputTraining, outputTraining, inputTest, outputTest, numberOfSymmFunc, outputs, parameters, Ftrain, Ftest 
     
 
-def SiO2TrainingData(dataFolder, symmFuncType, atomType, forces=False, nAtoms=9):
+def symmetryDerivatives(x, y, z, r, offsets, parameters, symmFuncType, klargerj, cacheDir, digest, *extra):
+    """
+    Sparse derivatives of the symmetry functions with respect to the neighbours, 
+    see symmetries.neighbourDerivatives, stored in the symmetry cache under the 
+    digest of the neighbour data and any extra arguments that affect them
+    """
+    
+    derivativeKey = symmetryCache.symmetryKey(digest, parameters, symmFuncType, klargerj, 
+                                              'derivatives', *extra)
+    derivatives = symmetryCache.loadDerivatives(cacheDir, derivativeKey)
+    if derivatives is None:
+        print 'Computing derivatives of symmetry functions...'
+        derivatives = symmetries.neighbourDerivatives(x, y, z, r, offsets, parameters, symmFuncType, 
+                                                      klargerj=klargerj)
+        symmetryCache.saveDerivatives(cacheDir, derivativeKey, derivatives)
+        
+    return derivatives
+    
+    
+def SiTrajectoryData(trajectoryFile, symmFuncType, energyColumn, forceColumns=['fx', 'fy', 'fz'], 
+                     cut=None, Behler=True, klargerj=False, shiftMean=False, start=0, stop=None, 
+                     stride=1, trainingDir='', workers=1):
+    """
+    Energies and forces of all atoms of the frames start:stop:stride of a lammps dump, 
+    for training on energies and forces
+    The force on an atom depends on the energies of all the environments it is part of, 
+    so whole frames are split between the training and the test set, and Ftrain and Ftest
+    are made by frameForceData from the sparse derivatives of the symmetry functions
+    The symmetry data and the derivatives are cached by the contents of the dump
+    The neighbour lists are cut at the largest cutoff of the symmetry functions by default
+    """
+    
+    if Behler:
+        print 
+        print "Using Behler parameters"
+        parameters = symmetryParameters.SiBehler()
+    else:
+        parameters = symmetryParameters.SiBulkCustom()
+        print
+        print "Using customized parameters" 
+    numberOfSymmFunc = len(parameters)
+    if cut is None:
+        cut = max(p[1] for p in parameters)
+        
+    data = readers.readTrajectoryForces(trajectoryFile, cut, energyColumn, forceColumns=forceColumns, 
+                                        start=start, stop=stop, stride=stride, workers=workers)
+    x = data['x']; y = data['y']; z = data['z']; r = data['r']
+    offsets = data['offsets']
+    frames = data['frames']
+    numberOfFrames = len(frames) - 1
+    print "Read %d atoms in %d frames" % (frames[-1], numberOfFrames)
+    if numberOfFrames < 2:
+        print "At least two frames are needed to make a training and a test set. Exiting."
+        exit(1)
+        
+    cacheDir = os.path.join(os.path.dirname(trajectoryFile), 'symmetryCache/')
+    digest = symmetryCache.neighbourDigest(trajectoryFile, cacheDir)
+    frameArguments = ('trajectory', cut, start, stop, stride)
+    cacheKey = symmetryCache.symmetryKey(digest, parameters, symmFuncType, klargerj, *frameArguments)
+    originalInputData = symmetryCache.loadSymmetryData(cacheDir, cacheKey)
+    if originalInputData is None:
+        print 'Applying symmetry transformations...'
+        originalInputData, _, _ = symmetries.applyThreeBodySymmetry(x, y, z, r, parameters, symmFuncType, 
+                                                                    E=data['E'].reshape(-1, 1), 
+                                                                    klargerj=klargerj, workers=workers, 
+                                                                    offsets=offsets)
+        metadata = {'neighbourFile': trajectoryFile, 'symmFuncType': symmFuncType, 'klargerj': klargerj, 
+                    'parameters': [[float(value) for value in p] for p in parameters], 
+                    'cut': cut, 'frames': [start, stop, stride]}
+        symmetryCache.saveSymmetryData(cacheDir, cacheKey, originalInputData, metadata)
+    # no sample name, so that no text file of the symmetry data is written
+    inputData, outputData, _ = symmetries.transformInputData(originalInputData.copy(), 
+                                                             data['E'].reshape(-1, 1), shiftMean=shiftMean)
+    
+    derivatives = symmetryDerivatives(x, y, z, r, offsets, parameters, symmFuncType, klargerj, 
+                                      cacheDir, digest, *frameArguments)
+    
+    # split whole frames in training set and test set randomly
+    testFrames = np.sort(np.random.choice(numberOfFrames, max(1, int(0.1*numberOfFrames)), replace=False))
+    trainFrames = np.delete(np.arange(numberOfFrames), testFrames)
+    trainAtoms, Ftrain = frameForceData(data['F'], derivatives, offsets, data['atoms'], frames, trainFrames)
+    testAtoms, Ftest = frameForceData(data['F'], derivatives, offsets, data['atoms'], frames, testFrames)
+    inputTraining  = inputData[trainAtoms]
+    outputTraining = outputData[trainAtoms]
+    inputTest      = inputData[testAtoms]
+    outputTest     = outputData[testAtoms]
+    
+    if trainingDir:
+        print 'Writing min and max of each symm func to file'
+        with open(trainingDir + '/minmax.txt', 'w') as outfile:
+            for s in xrange(numberOfSymmFunc):
+                outfile.write('%g %g' % (np.min(inputTraining[:,s]), np.max(inputTraining[:,s])))
+                outfile.write('\n')
+        if shiftMean:
+            print 'Writing mean of each symm func to file'
+            with open(trainingDir + '/mean.txt', 'w') as outfile:
+                for s in xrange(numberOfSymmFunc):
+                    outfile.write('%g' % np.mean(originalInputData[trainAtoms,s]))
+                    outfile.write('\n')
+    
+    return inputTraining, outputTraining, inputTest, outputTest, numberOfSymmFunc, 1, parameters, Ftrain, Ftest
+    
+    
+def frameForceData(F, derivatives, offsets, atoms, frames, selected):
+    """
+    Forces and sparse symmetry derivatives of the selected frames, see SiTrajectoryData
+    Returns the indices of the atoms of the frames and a dictionary of
+    F [size,3] and frames [selected+1] of the atoms of the frames in order, 
+    nonZeros [size+1]: the derivatives of environment i are nonZeros[i]:nonZeros[i+1] 
+    of function, dGdr [nonZeros,3] and atoms: the atom of the neighbour counted 
+    from the first atom of its frame
+    """
+    
+    neighbourOffsets = derivatives['neighbourOffsets']
+    environmentOffsets = neighbourOffsets[offsets]
+    starts = frames[selected]
+    ends = frames[selected+1]
+    
+    frameAtoms = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+    nonZeros = np.concatenate([np.arange(environmentOffsets[start], environmentOffsets[end]) 
+                               for start, end in zip(starts, ends)])
+    
+    # atom of the neighbour of each derivative, counted from its frame
+    neighbour = np.searchsorted(neighbourOffsets, nonZeros, side='right') - 1
+    frameOfAtom = np.repeat(np.arange(len(frames)-1), np.diff(frames))
+    neighbourAtoms = atoms[neighbour] - frames[frameOfAtom[atoms[neighbour]]]
+    
+    forceData = {'F': np.asarray(F[frameAtoms], dtype=np.float64), 
+                 'frames': np.concatenate(([0], np.cumsum(ends - starts))), 
+                 'nonZeros': np.concatenate(([0], np.cumsum(np.diff(environmentOffsets)[frameAtoms]))), 
+                 'function': np.asarray(derivatives['function'][nonZeros]), 
+                 'dGdr': np.asarray(derivatives['dGdr'][nonZeros]), 
+                 'atoms': neighbourAtoms.astype(np.int32)}
+                 
+    return frameAtoms, forceData
+    
+    
+def SiCoordinateData(dataFolder, Behler=True, forces=False, tags=False):
+    """
+    Padded neighbour coordinates and energies sampled from lammps, for training 
+    with the symmetry functions evaluated in the graph by symmetryFunctions.symmetryLayerTF
+    forces and tags give the layout of the neighbour file as for readers.convertNeighbourData,
+    only the energies are used
+    All environments are padded to the largest number of neighbours in memory at once,
+    [size, 4*maxNeighbours] floats, so the neighbour file must be small enough for that
+    Returns the training and test coordinates [size, 4*maxNeighbours] packed by 
+    symmetries.packCoordinates, the energies, the symmetry parameters and maxNeighbours
+    """
+    
+    filename = dataFolder + "neighbours.txt"
+    binaryDir = readers.currentBinaryDir(filename)
+    
+    # read file, the binary columnar version if it has been converted
+    if binaryDir:
+        print "Reading binary neighbour lists:", binaryDir
+        data = readers.readNeighbourDataBinary(binaryDir)
+        x = data['x']; y = data['y']; z = data['z']; r = data['r']
+        offsets = data['offsets']
+        E = np.array(data['E']).reshape(-1, 1)
+    else:
+        chunks = list(readers.readNeighbourChunks(filename, forces=forces, tags=tags))
+        x = np.concatenate([chunk['x'] for chunk in chunks])
+        y = np.concatenate([chunk['y'] for chunk in chunks])
+        z = np.concatenate([chunk['z'] for chunk in chunks])
+        r = np.concatenate([chunk['r'] for chunk in chunks])
+        numberOfNeighbours = np.concatenate([np.diff(chunk['offsets']) for chunk in chunks])
+        offsets = np.zeros(len(numberOfNeighbours)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum(numberOfNeighbours)
+        E = np.concatenate([chunk['E'] for chunk in chunks]).reshape(-1, 1)
+    print "Neighbour list file is read..."
+    
+    if Behler:
+        print 
+        print "Using Behler parameters"
+        parameters = symmetryParameters.SiBehler()
+    else:
+        parameters = symmetryParameters.SiBulkCustom()
+        print
+        print "Using customized parameters" 
+        
+    maxNeighbours = np.max(np.diff(offsets))
+    inputData = symmetries.packCoordinates(x, y, z, r, offsets, maxNeighbours)
+    print "Padded coordinates of %d environments with up to %d neighbours, %g MB" % \
+          (len(inputData), maxNeighbours, inputData.nbytes / 1e6)
+    
+    # split in training set and test set randomly
+    totalSize = len(inputData)
+    if totalSize < 10:
+        testSize = 1
+    else:
+        testSize = int(0.1*totalSize) 
+    indicies        = np.random.choice(totalSize, testSize, replace=False)
+    inputTest       = inputData[indicies]         
+    outputTest      = E[indicies]
+    inputTraining   = np.delete(inputData, indicies, axis=0)
+    outputTraining  = np.delete(E, indicies, axis=0)
+    
+    return inputTraining, outputTraining, inputTest, outputTest, parameters, maxNeighbours
+    
+    
+def SiO2TrainingData(dataFolder, symmFuncType, atomType, forces=False, nAtoms=9, workers=1, 
+                     chunkSize=None):
     """ 
     Coordinates and energies of neighbours is sampled from lammps
     Angular symmtry funcitons are used to transform input data  
+    If chunkSize is given the neighbour file is streamed with streamTrainingData
     """
     
     print 'Training type %d' % atomType
     neighbourFile = dataFolder + 'neighbours%d.txt' % atomType
-    
-    # read training data
-    if forces:
-        print 'Forces included in lammps training data not implemented for SiO2'
-        exit(1)
-    else:
-        print 'Forces are not included in lammps training data'
-        x, y, z, r, types, E = readers.readNeighbourDataMultiType(neighbourFile)
-    print "Lammps data %s is read..." % neighbourFile
+    offsets = None
     
     # get symmetry parameters
     if nAtoms >= 9:
@@ -225,21 +513,58 @@ def SiO2TrainingData(dataFolder, symmFuncType, atomType, forces=False, nAtoms=9)
     numberOfSymmFunc = len(parameters)
     outputs = 1
     
+    # stream neighbour files that are too large for memory
+    if chunkSize:
+        if forces:
+            print 'Forces included in lammps training data not implemented for SiO2'
+            exit(1)
+        inputTraining, outputTraining, inputTest, outputTest = \
+            streamTrainingData(neighbourFile, parameters, symmFuncType, chunkSize=chunkSize, 
+                               atomType=atomType, elem2param=elem2param, workers=workers)
+        return inputTraining, outputTraining, inputTest, outputTest, numberOfSymmFunc, outputs, parameters, elem2param
+    
+    # read training data
+    if forces:
+        print 'Forces included in lammps training data not implemented for SiO2'
+        exit(1)
+    binaryDir = readers.currentBinaryDir(neighbourFile, ['types'])
+    if binaryDir:
+        print "Reading binary neighbour lists:", binaryDir
+        data = readers.readNeighbourDataBinary(binaryDir)
+        x = data['x']; y = data['y']; z = data['z']; r = data['r']
+        types = data['types']
+        offsets = data['offsets']
+        E = np.array(data['E']).reshape(-1, 1)
+    else:
+        print 'Forces are not included in lammps training data'
+        x, y, z, r, types, E = readers.readNeighbourDataMultiType(neighbourFile)
+    print "Lammps data %s is read..." % neighbourFile
+    
     symmetryFileName = 'symmetry%dnoZeros.txt' % atomType
     symmetryFileName = dataFolder + symmetryFileName
     
-    # apply symmetry or read already existing file
-    if os.path.isfile(symmetryFileName):
-        print "Reading symmetrized input data"
-        inputData = readers.readSymmetryData(symmetryFileName)
+    # read symmetry data of an earlier run with the same neighbour file 
+    # and parameters from the cache, or apply symmetry
+    cacheDir = dataFolder + 'symmetryCache/'
+    digest = symmetryCache.neighbourDigest(neighbourFile if offsets is None else binaryDir, cacheDir)
+    cacheKey = symmetryCache.symmetryKey(digest, parameters, symmFuncType, True, 
+                                         atomType, sorted(elem2param.items()))
+    inputData = symmetryCache.loadSymmetryData(cacheDir, cacheKey)
+    if inputData is not None:
         outputData = np.array(E)
         print "Energy is supplied from lammps"
     else: 
         # apply symmetry transformastion
+        if os.path.isfile(symmetryFileName):
+            symmetryFileName = ''
         inputData, outputData = symmetries.applyThreeBodySymmetryMultiType(x, y, z, r, types, atomType,
                                                                            parameters, elem2param, symmFuncType, E=E, 
-                                                                           sampleName=symmetryFileName)
+                                                                           sampleName=symmetryFileName, workers=workers, 
+                                                                           offsets=offsets)
         print 'Applying symmetry transformation'
+        metadata = {'neighbourFile': neighbourFile, 'symmFuncType': symmFuncType, 'atomType': atomType, 
+                    'parameters': [[float(value) for value in p] for p in parameters]}
+        symmetryCache.saveSymmetryData(cacheDir, cacheKey, inputData, metadata)
     
     print inputData
     print outputData    
@@ -264,6 +589,66 @@ def SiO2TrainingData(dataFolder, symmFuncType, atomType, forces=False, nAtoms=9)
         
         
         
+def streamTrainingData(neighbourFile, parameters, symmFuncType, chunkSize=100000, klargerj=False, 
+                       atomType=0, elem2param=None, workers=1):
+    """
+    Symmetrized training data of a neighbour file too large for memory
+    The file, or its binary version if converted, is read and transformed 
+    chunkSize environments at a time and written to memory-mapped .npy files 
+    in the symmetry cache. The test set is a random subset of at most chunkSize
+    environments and is returned in memory, the training set as memory maps
+    """
+    
+    cacheDir = os.path.dirname(neighbourFile) + '/symmetryCache/'
+    binaryDir = readers.currentBinaryDir(neighbourFile, [] if elem2param is None else ['types'])
+    if binaryDir:
+        source = binaryDir
+    else:
+        source = neighbourFile
+        
+    # streamed entries have their own key as they include the test split
+    digest = symmetryCache.neighbourDigest(source, cacheDir)
+    if elem2param is None:
+        key = symmetryCache.symmetryKey(digest, parameters, symmFuncType, klargerj, 'stream', chunkSize)
+    else:
+        key = symmetryCache.symmetryKey(digest, parameters, symmFuncType, True, 'stream', chunkSize, 
+                                        atomType, sorted(elem2param.items()))
+    data = symmetryCache.loadStreamedData(cacheDir, key)
+    
+    if data is None:
+        totalSize = readers.countEnvironments(source)
+        if totalSize < 10:
+            testSize = 1
+        else:
+            testSize = min(int(0.1*totalSize), chunkSize)
+        trainSize = totalSize - testSize
+        isTest = np.zeros(totalSize, dtype=bool)
+        isTest[np.random.choice(totalSize, testSize, replace=False)] = True
+        print "Streaming %d environments from %s, %d at a time" % (totalSize, source, chunkSize)
+        
+        if source == binaryDir:
+            chunks = readers.readNeighbourChunksBinary(binaryDir, chunkSize)
+        else:
+            chunks = readers.readNeighbourChunks(neighbourFile, chunkSize, multiType=elem2param is not None)
+            
+        # training environments are written in order, test environments after
+        data = symmetryCache.createStreamedData(cacheDir, key, trainSize, testSize, len(parameters))
+        start = 0; trainStart = 0; testStart = 0
+        for inputData, E in symmetries.symmetryChunks(chunks, parameters, symmFuncType, klargerj=klargerj, 
+                                                      workers=workers, itype=atomType, elem2param=elem2param):
+            chunkIsTest = isTest[start:start+len(inputData)]
+            trainEnd = trainStart + np.sum(~chunkIsTest)
+            testEnd = testStart + np.sum(chunkIsTest)
+            data['xTrain'][trainStart:trainEnd] = inputData[~chunkIsTest]
+            data['yTrain'][trainStart:trainEnd] = E[~chunkIsTest]
+            data['xTest'][testStart:testEnd] = inputData[chunkIsTest]
+            data['yTest'][testStart:testEnd] = E[chunkIsTest]
+            start += len(inputData); trainStart = trainEnd; testStart = testEnd
+        symmetryCache.finishStreamedData(cacheDir, key, data)
+        
+    return data['xTrain'], data['yTrain'], np.array(data['xTest']), np.array(data['yTest'])
+        
+        
 if __name__ == '__main__':
     pass
     
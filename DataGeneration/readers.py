@@ -1,6 +1,9 @@
 import numpy as np
 import tensorflow as tf
 import sys
+import os
+import itertools
+import symmetries
 
 
 def readXYZ(filename, cut):
@@ -11,72 +14,277 @@ def readXYZ(filename, cut):
     
     # process xyz-file
     with open(filename, 'r') as inFile:
+        timeStep, systemSize, positions, _, _ = readFrame(inFile)
+        
+    numberOfAtoms = len(positions)
+    print "Number of atoms: ", numberOfAtoms
+    print "System size: ", systemSize
+    print "System size half: ", systemSize / 2.0
+        
+    # make neighbour list for all atoms in the system
+    i, j, dr, distance = cellListPairs(positions, systemSize, cut)
+    
+    # split the pairs, which are sorted on i and then j, into the lists of each atom
+    ends = np.cumsum(np.bincount(i, minlength=numberOfAtoms))[:-1]
+    x = [list(neighbours) for neighbours in np.split(dr[:,0], ends)]
+    y = [list(neighbours) for neighbours in np.split(dr[:,1], ends)]
+    z = [list(neighbours) for neighbours in np.split(dr[:,2], ends)]
+    r = [list(neighbours) for neighbours in np.split(distance, ends)]
+
+    return x, y, z, r
+    
+    
+def readFrame(inFile, energyColumn=None, forceColumns=None):
+    """
+    Read one frame of a lammps dump from the current position of inFile:
+    ITEM: TIMESTEP, ITEM: NUMBER OF ATOMS, ITEM: BOX BOUNDS with three lines
+    of lower and upper bounds and ITEM: ATOMS followed by one line per atom
+    Positions are the columns named x, y, z, or the first three columns
+    Returns the time step, the system size, the positions, the column 
+    energyColumn and the three forceColumns of each atom, None if not given
+    """
+    
+    inFile.readline()
+    timeStep = int(inFile.readline())
+    inFile.readline()
+    numberOfAtoms = int(inFile.readline())
+    
+    inFile.readline()
+    systemSize = []
+    for _ in xrange(3):
+        systemSize.append( float(inFile.readline().split()[1]) )
+    systemSize = np.array(systemSize)
+    
+    names = inFile.readline().split()[2:]
+    atoms = np.loadtxt(itertools.islice(inFile, numberOfAtoms), ndmin=2)
+    
+    if all(name in names for name in ['x', 'y', 'z']):
+        positions = atoms[:,[names.index('x'), names.index('y'), names.index('z')]]
+    else:
+        positions = atoms[:,:3]
+        
+    energies = None
+    if energyColumn is not None:
+        energies = atoms[:,names.index(energyColumn)]
+        
+    forces = None
+    if forceColumns is not None:
+        forces = atoms[:,[names.index(name) for name in forceColumns]]
+    
+    return timeStep, systemSize, positions, energies, forces
+    
+    
+def indexTrajectory(filename):
+    """
+    Byte offset and number of atoms of each frame in a lammps dump
+    The index is found with one pass over the file and stored in filename.index,
+    it is reused as long as the size and modification time of the dump are unchanged
+    """
+    
+    stat = os.stat(filename)
+    stamp = '%d %r' % (stat.st_size, stat.st_mtime)
+    indexFile = filename + '.index'
     
-        # skip three first lines
-        for _ in xrange(3):
-            inFile.readline()
+    if os.path.isfile(indexFile):
+        with open(indexFile, 'r') as inFile:
+            if inFile.readline().strip() == stamp:
+                index = np.loadtxt(inFile, dtype=np.int64, ndmin=2)
+                return index[:,0], index[:,1]
+    
+    print "Indexing frames of %s" % filename
+    offsets = []; numberOfAtoms = []
+    with open(filename, 'r') as inFile:
+        position = 0
+        line = inFile.readline()
+        while line:
+            if not line.startswith('ITEM: TIMESTEP'):
+                position += len(line)
+                line = inFile.readline()
+                continue
+                
+            offsets.append(position)
+            header = [line] + [inFile.readline() for _ in xrange(3)]
+            numberOfAtoms.append(int(header[3]))
+            position += sum(len(line) for line in header)
             
-        numberOfAtoms = int(inFile.readline())
-        print "Number of atoms: ", numberOfAtoms
+            # box bounds, atoms header and atoms
+            for _ in xrange(5 + numberOfAtoms[-1]):
+                position += len(inFile.readline())
+            line = inFile.readline()
+            
+    offsets = np.array(offsets, dtype=np.int64)
+    numberOfAtoms = np.array(numberOfAtoms, dtype=np.int64)
+    
+    with open(indexFile, 'w') as outFile:
+        outFile.write(stamp + '\n')
+        np.savetxt(outFile, np.column_stack((offsets, numberOfAtoms)), fmt='%d')
+    print "Number of frames: ", len(offsets)
         
-        inFile.readline()
+    return offsets, numberOfAtoms
+    
+    
+def frameNeighbours(arguments):
+    """
+    Neighbour lists of all atoms of the frame at a byte offset of a lammps dump
+    Top-level function so that frames can be sent to a process pool
+    Returns the number of neighbours of each atom, dr and r^2 of all pairs,
+    the energy of each atom, the atom j of each pair and the force on each atom,
+    see readTrajectory and readTrajectoryForces
+    """
+    
+    filename, offset, cut, energyColumn, forceColumns = arguments
+    
+    with open(filename, 'r') as inFile:
+        inFile.seek(offset)
+        timeStep, systemSize, positions, energies, forces = readFrame(inFile, energyColumn, forceColumns)
         
-        systemSize = []
-        for _ in xrange(3):
-            systemSize.append( float(inFile.readline().split()[1]) )
-        systemSize = np.array(systemSize)
-        systemSizeHalf = systemSize / 2.0
-        print "System size: ", systemSize
-        print "System size half: ", systemSizeHalf
+    i, j, dr, distance = cellListPairs(positions, systemSize, cut)
+    
+    return np.bincount(i, minlength=len(positions)), dr, distance**2, energies, j, forces
+    
+    
+def readTrajectory(filename, cut, start=0, stop=None, stride=1, workers=1, energyColumn=None):
+    """
+    Neighbour lists of the atoms of the frames start:stop:stride of a lammps dump,
+    frame by frame and atom by atom, in the layout of readNeighbourData:
+    nested lists x, y, z, r where r is squared, and E = [[Ei], ...] 
+    taken from the column energyColumn, None if not given
+    The frames are found with indexTrajectory and their neighbour lists
+    are made in a pool of worker processes if workers > 1
+    """
+    
+    offsets, _ = indexTrajectory(filename)
+    offsets = offsets[start:stop:stride]
+    
+    frames = ( (filename, offset, cut, energyColumn, None) for offset in offsets )
+    
+    x = []; y = []; z = []; r = []; E = []
+    for frame, (numberOfNeighbours, dr, r2, energies, _, _) in \
+        enumerate(symmetries.runShards(frameNeighbours, frames, workers)):
         
-        inFile.readline()
+        ends = np.cumsum(numberOfNeighbours)[:-1]
+        x.extend( list(neighbours) for neighbours in np.split(dr[:,0], ends) )
+        y.extend( list(neighbours) for neighbours in np.split(dr[:,1], ends) )
+        z.extend( list(neighbours) for neighbours in np.split(dr[:,2], ends) )
+        r.extend( list(neighbours) for neighbours in np.split(r2, ends) )
+        if energies is not None:
+            E.extend( [energy] for energy in energies )
         
-        # read positions and store in array
-        positions = np.zeros((numberOfAtoms, 3))   
-        counter = 0     
-        for line in inFile:
-            coordinates = line.split()
-            positions[counter,0] = float(coordinates[0])
-            positions[counter,1] = float(coordinates[1])
-            positions[counter,2] = float(coordinates[2])
-            counter += 1
+        # show progress
+        sys.stdout.write("\r%2d %% complete" % ((float(frame+1)/len(offsets))*100))
+        sys.stdout.flush()
+    print
+    
+    if energyColumn is None:
+        E = None
+        
+    return x, y, z, r, E
+    
+    
+def readTrajectoryForces(filename, cut, energyColumn, forceColumns=['fx', 'fy', 'fz'], 
+                         start=0, stop=None, stride=1, workers=1):
+    """
+    Neighbour lists, energies and forces of all atoms of the frames start:stop:stride 
+    of a lammps dump, for force matching
+    Unlike readTrajectory each neighbour keeps the index of its atom, so that the 
+    force on an atom can be summed over all the environments it is part of
+    Returns a dictionary of flat arrays like readNeighbourDataBinary: offsets and
+    x, y, z, r (squared) of the neighbour vectors r_j - r_i, atoms: the atom of each 
+    neighbour, E [size] and F [size,3], where environment i is that of atom i,
+    and frames: the atoms of frame f are frames[f]:frames[f+1]
+    """
+    
+    offsets, numberOfAtoms = indexTrajectory(filename)
+    offsets = offsets[start:stop:stride]
+    
+    frames = ( (filename, offset, cut, energyColumn, forceColumns) for offset in offsets )
+    
+    counts = []; dr = []; r2 = []; atoms = []; E = []; F = []
+    frameOffsets = [0]
+    for frame, (numberOfNeighbours, frameDr, frameR2, energies, j, forces) in \
+        enumerate(symmetries.runShards(frameNeighbours, frames, workers)):
+        
+        # cellListPairs gives r_i - r_j
+        counts.append(numberOfNeighbours)
+        dr.append(-frameDr)
+        r2.append(frameR2)
+        atoms.append(j + frameOffsets[-1])
+        E.append(energies)
+        F.append(forces)
+        frameOffsets.append(frameOffsets[-1] + len(numberOfNeighbours))
         
-    # make neighbour list for all atoms in the system
-    x = []; y = []; z = []; r = []
-    for i in xrange(numberOfAtoms):
-        atom1 = positions[i]
-        xNeigh = []; yNeigh = []; zNeigh = []; rNeigh = []
-        for j in xrange(numberOfAtoms):
-            if i != j:
-                atom2 = positions[j]
-                dr = atom1 - atom2 
-                
-                # periodic boundary conditions
-                for dim in xrange(3):
-                    if dr[dim] > systemSizeHalf[dim]:
-                        dr[dim] -= systemSize[dim]
-                    elif dr[dim] < -systemSizeHalf[dim]:
-                        dr[dim] += systemSize[dim]
-                    
-                distance = np.sqrt( dr[0]**2 + dr[1]**2 + dr[2]**2 )
-                
-                # add to neighbour lists if r2 under cut
-                if distance < cut:
-                    xNeigh.append(dr[0])
-                    yNeigh.append(dr[1])
-                    zNeigh.append(dr[2])
-                    rNeigh.append(distance)
-                    
-        x.append(xNeigh)
-        y.append(yNeigh)
-        z.append(zNeigh)
-        r.append(rNeigh)
-  
         # show progress
-        sys.stdout.write("\r%2d %% complete" % ((float(i)/numberOfAtoms)*100))
+        sys.stdout.write("\r%2d %% complete" % ((float(frame+1)/len(offsets))*100))
         sys.stdout.flush()
-
-    return x, y, z, r
+    print
+    
+    dr = np.concatenate(dr)
+    data = {'x': dr[:,0].copy(), 'y': dr[:,1].copy(), 'z': dr[:,2].copy(), 'r': np.concatenate(r2), 
+            'atoms': np.concatenate(atoms), 'E': np.concatenate(E), 'F': np.concatenate(F), 
+            'frames': np.array(frameOffsets)}
+    data['offsets'] = np.zeros(frameOffsets[-1]+1, dtype=neighbourDtypes['offsets'])
+    data['offsets'][1:] = np.cumsum(np.concatenate(counts))
+    
+    return data
+    
+    
+def cellListPairs(positions, systemSize, cut):
+    """
+    All pairs (i,j), i != j, of atoms closer than cut in a periodic box
+    Atoms are binned in cells with sides of at least cut, so only the
+    atoms in the 27 surrounding cells are candidates, and the minimum
+    image convention is applied to all candidate pairs at once
+    Returns i, j, dr = positions[i] - positions[j] and |dr|, sorted on i and then j
+    """
+    
+    numberOfAtoms = len(positions)
+    systemSize = np.asarray(systemSize, dtype=np.float64)
+    systemSizeHalf = systemSize / 2.0
+    
+    # a dimension with fewer than three cells is treated as one cell,
+    # so that no pair of cells is visited twice
+    numberOfCells = np.floor(systemSize / cut).astype(int)
+    numberOfCells[numberOfCells < 3] = 1
+    
+    cells = np.floor(positions / systemSize * numberOfCells).astype(int) % numberOfCells
+    cellIndex = np.ravel_multi_index(cells.T, numberOfCells)
+    
+    # atoms sorted on cell, the atoms of cell c are atomsByCell[cellStart[c]:cellStart[c+1]]
+    atomsByCell = np.argsort(cellIndex, kind='mergesort')
+    cellCount = np.bincount(cellIndex, minlength=np.prod(numberOfCells))
+    cellStart = np.concatenate(([0], np.cumsum(cellCount)))
+    
+    offsets = [[-1, 0, 1] if n > 1 else [0] for n in numberOfCells]
+    
+    allI = []; allJ = []; allDr = []; allDistance = []
+    for offset in itertools.product(*offsets):
+    
+        # cell of each atom shifted by offset, and the candidate atoms in it
+        neighbourCell = np.ravel_multi_index(((cells + offset) % numberOfCells).T, numberOfCells)
+        count = cellCount[neighbourCell]
+        i = np.repeat(np.arange(numberOfAtoms), count)
+        first = np.repeat(cellStart[neighbourCell], count)
+        within = np.arange(len(i)) - np.repeat(np.cumsum(count) - count, count)
+        j = atomsByCell[first + within]
+        
+        # periodic boundary conditions
+        dr = positions[i] - positions[j]
+        dr -= systemSize * (dr > systemSizeHalf)
+        dr += systemSize * (dr < -systemSizeHalf)
+        
+        distance = np.sqrt( dr[:,0]**2 + dr[:,1]**2 + dr[:,2]**2 )
+        
+        # add to neighbour lists if under cut
+        keep = (distance < cut) & (i != j)
+        allI.append(i[keep]); allJ.append(j[keep])
+        allDr.append(dr[keep]); allDistance.append(distance[keep])
+        
+    i = np.concatenate(allI); j = np.concatenate(allJ)
+    dr = np.concatenate(allDr); distance = np.concatenate(allDistance)
+    
+    order = np.lexsort((j, i))
+    
+    return i[order], j[order], dr[order], distance[order]
     
     
 def readNeighbourData(filename):
@@ -249,6 +457,253 @@ def readEnergyAndForce(filename):
     return E, Fx, Fy, Fz
     
     
+def binaryNeighbourDir(filename):
+    """
+    Directory of the binary columnar version of a neighbour text file,
+    neighbours.txt -> neighboursBinary/
+    """
+    
+    return os.path.splitext(filename)[0] + 'Binary/'
+    
+    
+# dtypes of the columns of the binary neighbour format
+# pair columns have one value per neighbour, E and F one row per environment
+neighbourDtypes = {'x': '<f8', 'y': '<f8', 'z': '<f8', 'r': '<f8', 
+                   'types': 'i1', 'tags': '<i4', 'E': '<f8', 'F': '<f8', 'offsets': '<i4'}
+pairColumns = ['x', 'y', 'z', 'r', 'types', 'tags']
+
+
+def neighbourColumns(forces=False, tags=False, multiType=False):
+    """
+    Values stored for each neighbour and number of values at the end
+    of each line for the layouts of the neighbour text files
+    """
+    
+    if multiType:
+        return ['x', 'y', 'z', 'r', 'types'], 1
+    elif tags:
+        return ['tags', 'x', 'y', 'z', 'r'], 4
+    elif forces:
+        return ['x', 'y', 'z', 'r'], 4
+    else:
+        return ['x', 'y', 'z', 'r'], 1
+        
+        
+def readNeighbourChunks(filename, chunkSize=10000, forces=False, tags=False, multiType=False):
+    """
+    Generator over a neighbour text file with chunkSize environments at a time,
+    so that memory is bounded by the chunk size and not the file size
+    The layout of the file is given by the flags, as for convertNeighbourData
+    Each chunk is a dictionary of flat arrays like readNeighbourDataBinary:
+    offsets [chunk+1] starting at 0, pair columns, E [chunk] and F [chunk,3]
+    """
+    
+    columns, tail = neighbourColumns(forces, tags, multiType)
+    stride = len(columns)
+    
+    def makeChunk(neighbours, ends):
+        neighbours = np.concatenate(neighbours)
+        ends = np.array(ends)
+        chunk = {}
+        for c, name in enumerate(columns):
+            chunk[name] = neighbours[:,c].astype(neighbourDtypes[name])
+        chunk['offsets'] = np.zeros(len(ends)+1, dtype=neighbourDtypes['offsets'])
+        chunk['offsets'][1:] = np.cumsum(ends[:,0])
+        chunk['E'] = ends[:,1]
+        if tail == 4:
+            chunk['F'] = ends[:,2:]
+        return chunk
+    
+    with open(filename, 'r') as inFile:
+        
+        neighbours = []; ends = []
+        for line in inFile:
+            values = np.fromstring(line, sep=' ')
+            if values.size == 0:
+                continue
+                
+            # number of neighbours followed by E (and Fx, Fy, Fz)
+            neighbours.append(values[:-tail].reshape(-1, stride))
+            ends.append([len(neighbours[-1])] + list(values[-tail:]))
+            
+            if len(neighbours) == chunkSize:
+                yield makeChunk(neighbours, ends)
+                neighbours = []; ends = []
+                
+        if neighbours:
+            yield makeChunk(neighbours, ends)
+            
+            
+def readNeighbourChunksBinary(binaryDir, chunkSize=10000):
+    """
+    Generator over a neighbour file converted with convertNeighbourData,
+    chunks are read from the memory-mapped columns in the format of readNeighbourChunks
+    """
+    
+    data = readNeighbourDataBinary(binaryDir)
+    offsets = data['offsets']
+    size = len(offsets) - 1
+    
+    for start in xrange(0, size, chunkSize):
+        end = min(start + chunkSize, size)
+        pairs = slice(offsets[start], offsets[end])
+        chunk = {}
+        for name in data:
+            if name in pairColumns:
+                chunk[name] = np.array(data[name][pairs])
+            elif name != 'offsets':
+                chunk[name] = np.array(data[name][start:end])
+        chunk['offsets'] = np.array(offsets[start:end+1]) - offsets[start]
+        yield chunk
+        
+        
+def countEnvironments(filename):
+    """
+    Number of environments in a neighbour text file or binary neighbour directory
+    """
+    
+    if os.path.isdir(filename):
+        with open(os.path.join(filename, 'header.txt'), 'r') as inFile:
+            return int(inFile.readline().split()[1])
+            
+    size = 0
+    with open(filename, 'r') as inFile:
+        for line in inFile:
+            if line.strip():
+                size += 1
+                
+    return size
+    
+    
+def convertNeighbourData(filename, binaryDir='', forces=False, tags=False, multiType=False, 
+                         chunkSize=10000):
+    """
+    One-time conversion of a neighbour text file to the binary columnar format
+    read by readNeighbourDataBinary. The layout of the text file is given by
+    the flags, as for readNeighbourData, readNeighbourDataForce,
+    readNeighbourDataForceTag and readNeighbourDataMultiType:
+    
+    binaryDir/header.txt    number of environments, pairs and the columns
+    binaryDir/offsets.bin   int32, neighbours of atom i are [offsets[i], offsets[i+1])
+    binaryDir/x.bin etc.    float64 x, y, z and r (squared) of all neighbours
+    binaryDir/types.bin     int8 type of all neighbours (multiType)
+    binaryDir/tags.bin      int32 tag of all neighbours (tags)
+    binaryDir/E.bin         float64 energy of each environment
+    binaryDir/F.bin         float64 [size, 3] force of each environment (forces or tags)
+    
+    header.txt also stores the size and modification time of the text file, 
+    see currentBinaryDir
+    """
+    
+    if not binaryDir:
+        binaryDir = binaryNeighbourDir(filename)
+    if not os.path.isdir(binaryDir):
+        os.makedirs(binaryDir)
+        
+    columns, tail = neighbourColumns(forces, tags, multiType)
+    environmentColumns = ['E', 'F'] if tail == 4 else ['E']
+    
+    outFiles = {}
+    for name in columns + environmentColumns + ['offsets']:
+        outFiles[name] = open(binaryDir + name + '.bin', 'wb')
+        
+    print "Converting %s to %s" % (filename, binaryDir)
+    size = 0
+    numberOfPairs = 0
+    np.zeros(1, dtype=neighbourDtypes['offsets']).tofile(outFiles['offsets'])
+    for chunk in readNeighbourChunks(filename, chunkSize, forces, tags, multiType):
+        for name in columns + environmentColumns:
+            chunk[name].astype(neighbourDtypes[name]).tofile(outFiles[name])
+        (chunk['offsets'][1:] + numberOfPairs).astype(neighbourDtypes['offsets']).tofile(outFiles['offsets'])
+        size += len(chunk['E'])
+        numberOfPairs += int(chunk['offsets'][-1])
+            
+    for outFile in outFiles.values():
+        outFile.close()
+        
+    with open(binaryDir + 'header.txt', 'w') as outFile:
+        outFile.write('size %d\n' % size)
+        outFile.write('pairs %d\n' % numberOfPairs)
+        outFile.write('columns %s\n' % ' '.join(columns + environmentColumns))
+        outFile.write('source %s\n' % fileStamp(filename))
+        
+    print "Converted %d environments with %d neighbours" % (size, numberOfPairs)
+    
+    return binaryDir
+    
+    
+def fileStamp(filename):
+    """
+    Size and modification time of a file
+    """
+    
+    stat = os.stat(filename)
+    return '%d %r' % (stat.st_size, stat.st_mtime)
+    
+    
+def currentBinaryDir(filename, columns=[]):
+    """
+    Binary directory of the neighbour text file filename if it was converted 
+    from the present version of the file and stores the given columns, 
+    otherwise None, and the text file should be read
+    A binary directory without its text file is used as it is
+    """
+    
+    binaryDir = binaryNeighbourDir(filename)
+    if not os.path.isdir(binaryDir):
+        return None
+        
+    with open(binaryDir + 'header.txt', 'r') as inFile:
+        header = dict(line.rstrip('\n').split(' ', 1) for line in inFile if ' ' in line)
+        
+    missing = [name for name in columns if name not in header['columns'].split()]
+    if missing:
+        reason = "lack the columns %s" % ", ".join(missing)
+    elif os.path.isfile(filename) and header.get('source') != fileStamp(filename):
+        reason = "were not converted from the present %s" % filename
+    else:
+        return binaryDir
+        
+    if not os.path.isfile(filename):
+        print "Binary neighbour lists %s %s, and %s does not exist. Exiting." % (binaryDir, reason, filename)
+        exit(1)
+    print "Binary neighbour lists %s %s, reading the text file instead" % (binaryDir, reason)
+    print "Convert it again with convertNeighbourData to use it"
+    
+    return None
+    
+    
+def readNeighbourDataBinary(binaryDir):
+    """
+    Memory-map a neighbour file converted with convertNeighbourData
+    Returns a dictionary of flat column arrays: offsets and x, y, z, r 
+    (squared) of all neighbours, and E [size] and F [size,3] if present
+    """
+    
+    with open(binaryDir + 'header.txt', 'r') as inFile:
+        size = int(inFile.readline().split()[1])
+        numberOfPairs = int(inFile.readline().split()[1])
+        columns = inFile.readline().split()[1:]
+        
+    data = {}
+    data['offsets'] = np.memmap(binaryDir + 'offsets.bin', dtype=neighbourDtypes['offsets'], 
+                                mode='r', shape=(size+1,))
+    for name in columns:
+        if name in pairColumns:
+            shape = (numberOfPairs,)
+        elif name == 'F':
+            shape = (size, 3)
+        else:
+            shape = (size,)
+        if np.prod(shape) == 0:
+            data[name] = np.zeros(shape, dtype=neighbourDtypes[name])
+        else:
+            data[name] = np.memmap(binaryDir + name + '.bin', dtype=neighbourDtypes[name], 
+                                   mode='r', shape=shape)
+        
+    return data
+    
+    
 def readSymmetryData(filename):
     
     inputData = []
@@ -262,8 +717,31 @@ def readSymmetryData(filename):
             inputData.append(inputVector)
             
     return np.array(inputData)
-    
-    
+
+
+def readSymmetryChunks(filename, chunkSize=10000):
+    """
+    Generator over a symmetry file written by lammpsData,
+    yielding [chunkSize, numberOfSymmFunc] arrays of input vectors
+    """
+
+    with open(filename, 'r') as infile:
+
+        inputData = []
+        for line in infile:
+            values = np.fromstring(line, sep=' ')
+            if values.size == 0:
+                continue
+            inputData.append(values)
+
+            if len(inputData) == chunkSize:
+                yield np.array(inputData)
+                inputData = []
+
+        if inputData:
+            yield np.array(inputData)
+
+
 def readParameters(filename):
     
     parameters = []
@@ -1,6 +1,8 @@
 import numpy as np
 import tensorflow as tf
 import sys
+import itertools
+import multiprocessing
 import symmetryFunctions
      
            
@@ -51,104 +53,584 @@ def applyTwoBodySymmetry(inputTemp, parameters):
     return inputData
     
     
-def calculateForces(x, y, z, r, parameters, forceFile, dEdG):
+def calculateForces(x, y, z, r, parameters, forceFile, dEdG, symmFuncType='G5', klargerj=False, 
+                    derivatives=None):
+    """
+    Force on each neighbour j of atom i from the energy of atom i,
+    F_j = -sum_s dEdG[i,s]*dG_s/dr_j, including the contributions
+    of j as the third atom k of the triplets (i,k,j)
+    The environments are evaluated block by block with forceBlock, or 
+    contracted with the sparse derivatives of neighbourDerivatives if given
+    Writes the forces of environment i as one line of Fx Fy Fz per neighbour
+    and returns them as a [size, maxNeigh, 3] array padded with zeros
+    """
     
     print
     print "Computing forces..."
     
-    size = len(x)
+    xFlat, yFlat, zFlat, rFlat, offsets = neighbourArrays(x, y, z, r)
+    dEdG = np.asarray(dEdG, dtype=np.float64)
+    
+    size = len(offsets) - 1
+    numberOfNeighbours = np.diff(offsets)
+    maxNeighbours = int(np.max(numberOfNeighbours))
+    blockSize = defaultBlockSize(maxNeighbours)
+    
+    forces = np.zeros((size, maxNeighbours, 3))
+    if derivatives is not None:
+        environment = np.repeat(np.arange(size), numberOfNeighbours)
+        neighbour = np.arange(offsets[-1]) - offsets[environment]
+        forces[environment, neighbour] = sparseForces(derivatives, dEdG, offsets)
+    else:
+        for start in xrange(0, size, blockSize):
+            end = min(start + blockSize, size)
+            forces[start:end] = forceBlock(xFlat, yFlat, zFlat, rFlat, offsets, start, end, maxNeighbours, 
+                                           parameters, dEdG[start:end], symmFuncType, klargerj=klargerj)
+                                           
+            # show progress
+            sys.stdout.write("\r%2d %% complete" % ((float(end)/size)*100))
+            sys.stdout.flush()
     
     with open(forceFile, 'w') as outfile:
+        for i in xrange(size):
+            outfile.write('%.17g %.17g %.17g ' * numberOfNeighbours[i] % 
+                          tuple(forces[i,:numberOfNeighbours[i]].ravel()))
+            outfile.write('\n')
+            
+    return forces
+    
+    
+def neighbourDerivatives(xFlat, yFlat, zFlat, rFlat, offsets, parameters, symmFuncType='G5', klargerj=False):
+    """
+    Derivatives dG_s/dr_j of each symmetry function with respect to each neighbour j,
+    for the environments block by block with neighbourDerivativeBlock
+    Most of them are zero beyond the cutoffs, so only the non-zero (neighbour, function)
+    pairs are kept, in compressed rows over the flat neighbour arrays: the pairs of 
+    neighbour n are neighbourOffsets[n]:neighbourOffsets[n+1] of function: [nonZeros] 
+    and dGdr: [nonZeros, 3]
+    """
+    
+    size = len(offsets) - 1
+    maxNeighbours = int(np.max(np.diff(offsets)))
+    blockSize = defaultBlockSize(maxNeighbours)
+    
+    neighbourOffsets = np.zeros(offsets[-1]+1, dtype=np.int64)
+    function = []; dGdr = []
+    for start in xrange(0, size, blockSize):
+        end = min(start + blockSize, size)
+        derivatives = neighbourDerivativeBlock(xFlat, yFlat, zFlat, rFlat, offsets, start, end, 
+                                               maxNeighbours, parameters, symmFuncType, klargerj=klargerj)
+        nonZero = np.any(derivatives != 0, axis=3)
+        mask = np.arange(maxNeighbours) < np.diff(offsets[start:end+1])[:,np.newaxis]
+        neighbourOffsets[offsets[start]+1:offsets[end]+1] = np.sum(nonZero, axis=2)[mask]
+        function.append(np.nonzero(nonZero)[2].astype(np.int32))
+        dGdr.append(derivatives[nonZero])
+    np.cumsum(neighbourOffsets, out=neighbourOffsets)
         
-        # calculate force for each neighbour atom at each time step in given configs
-        for i in xrange(size):  
+    derivatives = {'neighbourOffsets': neighbourOffsets, 'function': np.concatenate(function), 
+                   'dGdr': np.concatenate(dGdr)}
+    
+    print "Fraction of non-zero derivatives: ", \
+          len(derivatives['function']) / float(offsets[-1]*len(parameters))
+    
+    return derivatives
+    
+    
+def neighbourDerivativeBlock(xFlat, yFlat, zFlat, rFlat, offsets, start, end, maxNeighbours,
+                             parameters, symmFuncType, klargerj=False):
+    """
+    dG_s/dr_j for the neighbours of the environments [start,end), zero for padding
+    Each triplet (j,k) contributes through rij, rik, cos(theta) and for G4 rjk
+    Returns [size, maxNeigh, numberOfSymmFunc, 3]
+    """
+    
+    xi, yi, zi, ri, mask = padNeighbours(xFlat, yFlat, zFlat, rFlat, offsets, 
+                                         start, end, maxNeighbours)
+    size = end - start
+    coordinates = np.concatenate([xi[:,:,np.newaxis], yi[:,:,np.newaxis], zi[:,:,np.newaxis]], axis=2)
+    unit = coordinates / ri[:,:,np.newaxis]
+    
+    derivatives = np.zeros((size, maxNeighbours, len(parameters), 3))
+    G2Rows = [s for s, p in enumerate(parameters) if len(p) == 3]
+    tripletRows = [s for s, p in enumerate(parameters) if len(p) != 3]
+    
+    if G2Rows:
+        p = np.array([parameters[s] for s in G2Rows])
+        dr = symmetryFunctions.dG2drBlock(ri, p[:,0], p[:,1], p[:,2])
+        derivatives[:,:,G2Rows] = dr[:,:,:,np.newaxis] * unit[:,:,np.newaxis,:]
         
-            # neighbour coordinates for atom i
-            xi = np.array(x[i][:])
-            yi = np.array(y[i][:])
-            zi = np.array(z[i][:])
-            ri = np.array(r[i][:])
-            ri = np.sqrt(ri)
-            numberOfNeighbours = len(xi)
-               
-            # sum over all neighbours k for each neighbour j
-            # this loop takes care of both 2-body and 3-body configs
-            # want to save total force on all NEIGHBOURS, not the atom i itself
-            Fx = np.zeros(numberOfNeighbours)
-            Fy = np.zeros(numberOfNeighbours)
-            Fz = np.zeros(numberOfNeighbours)
-            for j in xrange(numberOfNeighbours):
-                
-                # atom j
-                rij = ri[j]
-                xij = xi[j]; yij = yi[j]; zij = zi[j]
-                
-                # all k != i,j OR I > J ??? REMEMBER TO CHANGE WHEN NEEDED
-                k = np.arange(len(ri[:])) != j
-                rik = ri[k] 
-                xik = xi[k]; yik = yi[k]; zik = zi[k]
-                
-                # compute cos(theta_ijk) and rjk
-                cosTheta = (xij*xik + yij*yik + zij*zik) / (rij*rik) 
-                
-                xjk = xij - xik
-                yjk = yij - yik
-                zjk = zij - zik
-                rjk = np.sqrt(xjk*xjk + yjk*yjk + zjk*zjk) 
+    if tripletRows:
+        if klargerj:
+            pairs = np.triu(np.ones((maxNeighbours, maxNeighbours), dtype=bool), 1)
+        else:
+            pairs = ~np.eye(maxNeighbours, dtype=bool)
+        tripletMask = mask[:,:,np.newaxis] & mask[:,np.newaxis,:] & pairs
+        
+        # each triplet contributes to both of its neighbours
+        tripletWeight = tripletMask.astype(np.float64) + np.transpose(tripletMask, (0,2,1))
+        
+        cosTheta, rjk = tripletGeometry(xi, yi, zi, ri)
+        np.clip(cosTheta, -1, 1, out=cosTheta)
+        rjk[tripletWeight == 0] = 1.0
+        
+        angularCache = {}
+        radialCache = {}
+        for s in tripletRows:
+            eta, Rc, zeta, Lambda = parameters[s]
+            
+            # angular factor and its derivative with respect to cos(theta)
+            if (zeta, Lambda) not in angularCache:
+                base = 1 + Lambda*cosTheta
+                angularCache[(zeta, Lambda)] = \
+                    (2**(1-zeta) * symmetryFunctions.integerPower(base, zeta),
+                     2**(1-zeta) * zeta*Lambda * symmetryFunctions.integerPower(base, zeta-1))
+            angular, dAngular = angularCache[(zeta, Lambda)]
+            
+            # radial factor, its derivative and the weight of each triplet
+            # without the factors of neighbour j, once per distinct (eta, Rc)
+            if (eta, Rc) not in radialCache:
+                exponential = np.exp(-eta*ri**2)
+                fc = symmetryFunctions.cutoffFunctionBlock(ri, Rc)
+                radial = exponential*fc
+                dRadial = exponential*(-2*eta*ri*fc + symmetryFunctions.dfcdrBlock(ri, Rc))
+                weight = tripletWeight * radial[:,np.newaxis,:]
+                rjkWeight = None
+                if symmFuncType == 'G4':
+                    exponential = np.exp(-eta*rjk**2)
+                    fc = symmetryFunctions.cutoffFunctionBlock(rjk, Rc)
+                    rjkWeight = weight * radial[:,:,np.newaxis] * exponential * \
+                                (-2*eta*rjk*fc + symmetryFunctions.dfcdrBlock(rjk, Rc)) / rjk
+                    weight *= exponential*fc
+                radialCache[(eta, Rc)] = radial, dRadial, weight, rjkWeight
+            radial, dRadial, weight, rjkWeight = radialCache[(eta, Rc)]
                 
-                # differentiate each symmetry function and compute forces for current input vector
-                # xij, yij, zij, rij are numbers, i.e. on neighbour j at a tie
-                # xik, yik, zik, rik are vectors, i.e. all neighbours k > j
-                # we therefore include all triplets for a specific pair (i,j)
-                symmFuncNumber = 0
-                for s in parameters:
-                    if len(s) == 3:
-                        # compute derivative of G2 w.r.t. (x,y,z) of all neighbours simultaneously
-                        dij = symmetryFunctions.dG2dr(xij, yij, zij, rij, s[0], s[1], s[2]) 
-                        Fx[j] += dEdG[i][symmFuncNumber]*dij[0]
-                        Fy[j] += dEdG[i][symmFuncNumber]*dij[1]
-                        Fz[j] += dEdG[i][symmFuncNumber]*dij[2]
-                        
-                    else:
-                        # compute derivative of G5 w.r.t. (x,y,z) of all k for on j 
-                        # atom j must get contribution from all k's
-                        # each k gets one contribution per k
-                        dij3 = symmetryFunctions.dG5dj(xij, yij, zij, xik, yik, zik, rij, rik, cosTheta, \
-                                                      s[0], s[1], s[2], s[3])
-                        dik = symmetryFunctions.dG5dk(xij, yij, zij, xik, yik, zik, rij, rik, cosTheta, \
-                                                      s[0], s[1], s[2], s[3])
-                                                      
-                        # atom j gets force contribution for all ks, i.e. all triplets for this (i,j)                                      
-                        Fx[j] += dEdG[i][symmFuncNumber]*np.sum(dij3[0])
-                        Fy[j] += dEdG[i][symmFuncNumber]*np.sum(dij3[1])
-                        Fz[j] += dEdG[i][symmFuncNumber]*np.sum(dij3[2])
-                        
-                        # find force contribution on each k
-                        #Fx[k] += dEdG[i][symmFuncNumber]*dik[0]
-                        #Fy[k] += dEdG[i][symmFuncNumber]*dik[1]
-                        #Fz[k] += dEdG[i][symmFuncNumber]*dik[2]
+            # d cos(theta_jk)/d r_j = (unit_k - cos(theta_jk) unit_j) / rj
+            cosineCoefficient = weight * dAngular * (radial / ri)[:,:,np.newaxis]
+            radialCoefficient = np.sum(weight * angular, axis=2) * dRadial
+            
+            gradient = np.einsum('ijk,ikc->ijc', cosineCoefficient, unit) + \
+                       (radialCoefficient - np.sum(cosineCoefficient*cosTheta, axis=2))[:,:,np.newaxis] * unit
+                       
+            # d rjk/d r_j = (r_j - r_k) / rjk
+            if rjkWeight is not None:
+                rjkCoefficient = rjkWeight * angular
+                gradient += np.sum(rjkCoefficient, axis=2)[:,:,np.newaxis] * coordinates - \
+                            np.einsum('ijk,ikc->ijc', rjkCoefficient, coordinates)
+            derivatives[:,:,s] = gradient
+            
+    derivatives[~mask] = 0
+            
+    return derivatives
+    
+    
+def sparseForces(derivatives, dEdG, offsets):
+    """
+    Forces -sum_s dEdG[i,s]*dG_s/dr_j on the neighbours from the sparse 
+    derivatives of neighbourDerivatives, a sparse-dense product over the non-zeros
+    Returns [numberOfNeighbours, 3] for the flat neighbour arrays
+    """
+    
+    numberOfNeighbours = offsets[-1]
+    counts = np.diff(derivatives['neighbourOffsets'])
+    environment = np.repeat(np.repeat(np.arange(len(offsets)-1), np.diff(offsets)), counts)
+    weights = -np.asarray(dEdG)[environment, derivatives['function']]
+    neighbour = np.repeat(np.arange(numberOfNeighbours), counts)
+    forces = np.zeros((numberOfNeighbours, 3))
+    for c in xrange(3):
+        forces[:,c] = np.bincount(neighbour, weights=weights*derivatives['dGdr'][:,c], 
+                                  minlength=numberOfNeighbours)
+        
+    return forces
+    
+    
+def atomForces(neighbourForces, offsets, atoms):
+    """
+    Total force on each atom from the energies of all environments, for data where
+    environment i is that of atom i and atoms is the atom of each neighbour, 
+    see readers.readTrajectoryForces
+    neighbourForces are the forces on the neighbours of sparseForces, the neighbour
+    vectors are r_j - r_i, so the central atom of each environment gets minus their sum
+    Returns [size, 3]
+    """
+    
+    size = len(offsets) - 1
+    environment = np.repeat(np.arange(size), np.diff(offsets))
+    forces = np.zeros((size, 3))
+    for c in xrange(3):
+        forces[:,c] = np.bincount(atoms, weights=neighbourForces[:,c], minlength=size) - \
+                      np.bincount(environment, weights=neighbourForces[:,c], minlength=size)
+                      
+    return forces
+    
+    
+def forceBlock(xFlat, yFlat, zFlat, rFlat, offsets, start, end, maxNeighbours,
+               parameters, dEdG, symmFuncType, klargerj=False):
+    """
+    Forces on the neighbours of the environments [start,end) for the
+    network gradient dEdG: [size, numberOfSymmFunc]
+    The derivatives of all parameter rows, pairs and triplets are formed 
+    with the same padded broadcasts as symmetryBlock
+    Returns [size, maxNeigh, 3]
+    """
+    
+    xi, yi, zi, ri, mask = padNeighbours(xFlat, yFlat, zFlat, rFlat, offsets, 
+                                         start, end, maxNeighbours)
+    size = end - start
+    coordinates = np.concatenate([xi[:,:,np.newaxis], yi[:,:,np.newaxis], zi[:,:,np.newaxis]], axis=2)
+    
+    # dE/dr_j, the force is the negative
+    gradient = np.zeros((size, maxNeighbours, 3))
+    G2Rows = [s for s, p in enumerate(parameters) if len(p) == 3]
+    tripletRows = [s for s, p in enumerate(parameters) if len(p) != 3]
+    
+    if G2Rows:
+        p = np.array([parameters[s] for s in G2Rows])
+        dr = symmetryFunctions.dG2drBlock(ri, p[:,0], p[:,1], p[:,2])
+        gradient += (np.einsum('is,ijs->ij', dEdG[:,G2Rows], dr) / ri)[:,:,np.newaxis] * coordinates
+        
+    if tripletRows:
+        if klargerj:
+            pairs = np.triu(np.ones((maxNeighbours, maxNeighbours), dtype=bool), 1)
+        else:
+            pairs = ~np.eye(maxNeighbours, dtype=bool)
+        tripletMask = mask[:,:,np.newaxis] & mask[:,np.newaxis,:] & pairs
+        
+        # each triplet contributes to both of its neighbours, which is
+        # the same as including (k,j) along with (j,k)
+        tripletWeight = tripletMask.astype(np.float64) + np.transpose(tripletMask, (0,2,1))
+        
+        cosTheta, rjk = tripletGeometry(xi, yi, zi, ri)
+        np.clip(cosTheta, -1, 1, out=cosTheta)
+        rjk[tripletWeight == 0] = 1.0
+        
+        p = np.array([parameters[s] for s in tripletRows])
+        angular, radial, rjkCoefficient = \
+            symmetryFunctions.tripletGradientBlock(ri, cosTheta, rjk, tripletWeight, dEdG[:,tripletRows], 
+                                                   p[:,0], p[:,1], p[:,2], p[:,3], symmFuncType)
+                                                   
+        scaled = coordinates / ri[:,:,np.newaxis]
+        gradient += np.einsum('ijk,ikc->ijc', angular, scaled) / ri[:,:,np.newaxis]
+        gradient -= (np.sum(angular*cosTheta, axis=2) / ri**2)[:,:,np.newaxis] * coordinates
+        gradient += (np.sum(radial + rjkCoefficient, axis=2))[:,:,np.newaxis] * coordinates
+        gradient -= np.einsum('ijk,ikc->ijc', rjkCoefficient, coordinates)
+        
+    gradient[~mask] = 0
+        
+    return -gradient
+    
+    
+def neighbourArrays(x, y, z, r):
+    """
+    Flatten the nested neighbour lists x[i][:] etc. into contiguous arrays
+    The neighbours of atom i are found at [offsets[i], offsets[i+1])
+    """
+    
+    size = len(x)
+    offsets = np.zeros(size+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(xi) for xi in x])
+    numberOfPairs = offsets[-1]
+    
+    xFlat = np.fromiter(itertools.chain.from_iterable(x), dtype=np.float64, count=numberOfPairs)
+    yFlat = np.fromiter(itertools.chain.from_iterable(y), dtype=np.float64, count=numberOfPairs)
+    zFlat = np.fromiter(itertools.chain.from_iterable(z), dtype=np.float64, count=numberOfPairs)
+    rFlat = np.fromiter(itertools.chain.from_iterable(r), dtype=np.float64, count=numberOfPairs)
+    
+    return xFlat, yFlat, zFlat, rFlat, offsets
+    
+    
+def padNeighbours(xFlat, yFlat, zFlat, rFlat, offsets, start, end, maxNeighbours):
+    """
+    Pack the environments [start,end) into padded [size, maxNeighbours] arrays
+    rFlat is squared like in the neighbour files, the returned r is not
+    Padded neighbours sit at the origin with a distance beyond any cutoff
+    and are flagged False in mask
+    """
+    
+    size = end - start
+    numberOfNeighbours = np.diff(offsets[start:end+1])
+    mask = np.arange(maxNeighbours) < numberOfNeighbours[:,np.newaxis]
+    
+    pairs = slice(offsets[start], offsets[end])
+    xi = np.zeros((size, maxNeighbours))
+    yi = np.zeros((size, maxNeighbours))
+    zi = np.zeros((size, maxNeighbours))
+    ri = np.zeros((size, maxNeighbours)) + 1e3
+    xi[mask] = xFlat[pairs]
+    yi[mask] = yFlat[pairs]
+    zi[mask] = zFlat[pairs]
+    ri[mask] = np.sqrt(rFlat[pairs])
+    
+    return xi, yi, zi, ri, mask
+    
+    
+def packCoordinates(xFlat, yFlat, zFlat, rFlat, offsets, maxNeighbours):
+    """
+    Padded coordinates of all environments packed in one array 
+    [size, 4*maxNeighbours] of x, y, z and mask, the input of symmetryFunctions.symmetryLayerTF
+    """
+    
+    xi, yi, zi, ri, mask = padNeighbours(xFlat, yFlat, zFlat, rFlat, offsets, 
+                                         0, len(offsets) - 1, maxNeighbours)
                                          
-                    symmFuncNumber += 1
-                
-                # write force on current j, this will be total force when k > j
-                outfile.write('%.17g %.17g %.17g ' % (Fx[j], Fy[j], Fz[j])) 
+    return np.hstack([xi, yi, zi, mask])
+    
+    
+def defaultBlockSize(maxNeighbours, maxElements=2**17):
+    """
+    Number of environments per block so that each 
+    [size, maxNeigh, maxNeigh] triplet array stays below maxElements
+    """
+    
+    return max(1, maxElements / max(maxNeighbours, 1)**2)
+    
+    
+def tripletGeometry(xi, yi, zi, ri):
+    """
+    cos(theta_ijk) and rjk for all pairs of neighbours of padded environments
+    Returns two [size, maxNeigh, maxNeigh] arrays
+    """
+    
+    cosTheta = ( xi[:,:,np.newaxis]*xi[:,np.newaxis,:] + \
+                 yi[:,:,np.newaxis]*yi[:,np.newaxis,:] + \
+                 zi[:,:,np.newaxis]*zi[:,np.newaxis,:] ) / \
+               ( ri[:,:,np.newaxis]*ri[:,np.newaxis,:] )
+    
+    xjk = xi[:,:,np.newaxis] - xi[:,np.newaxis,:]
+    yjk = yi[:,:,np.newaxis] - yi[:,np.newaxis,:]
+    zjk = zi[:,:,np.newaxis] - zi[:,np.newaxis,:]
+    rjk = np.sqrt(xjk*xjk + yjk*yjk + zjk*zjk)
+    
+    return cosTheta, rjk
+    
+    
+def symmetryBlock(xFlat, yFlat, zFlat, rFlat, offsets, start, end, maxNeighbours,
+                  parameters, symmFuncType, klargerj=True, tableSpacing=None):
+    """
+    Evaluate all symmetry functions for the environments [start,end)
+    with one set of broadcasts over padded [size, maxNeigh] arrays
+    The radial factors are interpolated in tables if tableSpacing is given,
+    see symmetryFunctions.radialTable
+    Returns the input vectors [size, numberOfSymmFunc] and min/max of rjk
+    """
+    
+    xi, yi, zi, ri, mask = padNeighbours(xFlat, yFlat, zFlat, rFlat, offsets, 
+                                         start, end, maxNeighbours)
+    size = end - start
+    
+    # triplets (j,k) to include for each environment
+    if klargerj:
+        pairs = np.triu(np.ones((maxNeighbours, maxNeighbours), dtype=bool), 1)
+    else:
+        pairs = ~np.eye(maxNeighbours, dtype=bool)
+    tripletMask = mask[:,:,np.newaxis] & mask[:,np.newaxis,:] & pairs
+    
+    # compute cos(theta_ijk) and rjk for all triplets
+    cosTheta, rjk = tripletGeometry(xi, yi, zi, ri)
+    
+    # floating-point error can yield an argument outside of arccos range
+    outside = np.sum( (np.abs(cosTheta) > 1) & tripletMask )
+    if outside:
+        print "Warning: %d values of cos(theta) have been replaced by -1 or 1" % outside
+    np.clip(cosTheta, -1, 1, out=cosTheta)
+    
+    if np.any(tripletMask):
+        rjkMin = np.min(rjk[tripletMask])
+        rjkMax = np.max(rjk[tripletMask])
+    else:
+        rjkMin = 100.0
+        rjkMax = 0.0
+        
+    # evaluate all parameter rows of each kind at once
+    inputData = np.zeros((size, len(parameters)))
+    G2Rows = [s for s, p in enumerate(parameters) if len(p) == 3]
+    tripletRows = [s for s, p in enumerate(parameters) if len(p) != 3]
+    
+    if G2Rows:
+        p = np.array([parameters[s] for s in G2Rows])
+        inputData[:,G2Rows] = symmetryFunctions.G2Block(ri, p[:,0], p[:,1], p[:,2], 
+                                                        tableSpacing=tableSpacing)
+                                                        
+    if tripletRows:
+        p = np.array([parameters[s] for s in tripletRows])
+        inputData[:,tripletRows] = symmetryFunctions.tripletBlock(ri, cosTheta, rjk, tripletMask, 
+                                                                  p[:,0], p[:,1], p[:,2], p[:,3],
+                                                                  symmFuncType, tableSpacing=tableSpacing)
+                                                                  
+    return inputData, rjkMin, rjkMax
+    
+    
+def symmetryShard(arguments):
+    """
+    Transform the environments of one shard block by block
+    Top-level function so that shards can be sent to a process pool
+    The shard must start on a block boundary for the blocks, 
+    and thereby the results, to be identical to the serial path
+    """
+    
+    xFlat, yFlat, zFlat, rFlat, offsets, start, maxNeighbours, \
+    parameters, symmFuncType, klargerj, blockSize, tableSpacing = arguments
+    
+    size = len(offsets) - 1
+    inputData = np.zeros((size, len(parameters)))
+    rjkMin = 100.0
+    rjkMax = 0.0
+    for blockStart in xrange(0, size, blockSize):
+        blockEnd = min(blockStart + blockSize, size)
+        inputData[blockStart:blockEnd], rjkMinBlock, rjkMaxBlock = \
+            symmetryBlock(xFlat, yFlat, zFlat, rFlat, offsets, blockStart, blockEnd, maxNeighbours, 
+                          parameters, symmFuncType, klargerj=klargerj, tableSpacing=tableSpacing)
+        rjkMin = min(rjkMin, rjkMinBlock)
+        rjkMax = max(rjkMax, rjkMaxBlock)
+        
+    statistics = symmetryStatistics(inputData, start, np.diff(offsets), rjkMin, rjkMax)
+    
+    return inputData, statistics
+    
+    
+def symmetryShards(xFlat, yFlat, zFlat, rFlat, offsets, maxNeighbours, parameters, 
+                   symmFuncType, klargerj, blockSize, workers=1, start=0, tableSpacing=None):
+    """
+    Split the environments in shards of whole blocks for symmetryShard,
+    a few shards per worker when transforming in parallel
+    start is the index of the first environment, used for the statistics
+    """
+    
+    size = len(offsets) - 1
+    numberOfBlocks = (size + blockSize - 1) / blockSize
+    if workers > 1:
+        shardSize = blockSize * max(1, numberOfBlocks / (4*workers))
+    else:
+        shardSize = blockSize
+        
+    return ( (xFlat[offsets[first]:offsets[last]], yFlat[offsets[first]:offsets[last]], 
+              zFlat[offsets[first]:offsets[last]], rFlat[offsets[first]:offsets[last]], 
+              offsets[first:last+1] - offsets[first], start + first, maxNeighbours, 
+              parameters, symmFuncType, klargerj, blockSize, tableSpacing) 
+             for first, last in ( (first, min(first + shardSize, size)) 
+                                  for first in xrange(0, size, shardSize) ) )
+    
+    
+def symmetryStatistics(inputData, start, numberOfNeighbours, rjkMin=100.0, rjkMax=0.0):
+    """
+    Statistics of a shard of input vectors starting at environment start
+    Counts are kept as integers so that merging shards is exact
+    """
+    
+    return {'nonZeros'  : int(np.sum(inputData != 0)),
+            'onlyZeros' : list(start + np.where( ~np.any(inputData, axis=1) )[0]),
+            'neighbours': int(np.sum(numberOfNeighbours)),
+            'rjkMin'    : rjkMin,
+            'rjkMax'    : rjkMax}
             
-                    
-            outfile.write('\n')
             
-            # show progress
-            sys.stdout.write("\r%2d %% complete" % ((float(i)/size)*100))
-            sys.stdout.flush()
-      
-      
+def mergeStatistics(allStatistics):
+    """
+    Merge the statistics of shards given in their original order
+    """
+    
+    merged = {'nonZeros': 0, 'onlyZeros': [], 'neighbours': 0, 'rjkMin': 100.0, 'rjkMax': 0.0}
+    for statistics in allStatistics:
+        merged['nonZeros']   += statistics['nonZeros']
+        merged['onlyZeros']  += statistics['onlyZeros']
+        merged['neighbours'] += statistics['neighbours']
+        merged['rjkMin'] = min(merged['rjkMin'], statistics['rjkMin'])
+        merged['rjkMax'] = max(merged['rjkMax'], statistics['rjkMax'])
+        
+    return merged
+    
+    
+def runShards(shardFunction, shards, workers=1):
+    """
+    Apply shardFunction to each shard, in a pool of worker processes if workers > 1,
+    and yield the results in the original order of the shards
+    """
+    
+    if workers <= 1:
+        for shard in shards:
+            yield shardFunction(shard)
+        return
+        
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap(shardFunction, shards):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        
+        
+def printStatistics(statistics, size, numberOfSymmFunc):
+    
+    fractionOfZeros = 1 - statistics['nonZeros'] / float(size*numberOfSymmFunc)
+    fractionOfInputVectorsOnlyZeros = len(statistics['onlyZeros']) / float(size)
+    print "Fraction of zeros: ", fractionOfZeros
+    print "Fraction of input vectors with only zeros: ", fractionOfInputVectorsOnlyZeros
+    print
+    
+    meanNeighbours = statistics['neighbours'] / float(size)
+    print "Mean number of neighbours: ", meanNeighbours
+    print
+    
+    print "min(Rjk) ", statistics['rjkMin']
+    print "max(Rjk) ", statistics['rjkMax']
+    print
+    
+    
+def functionEnergy(xFlat, yFlat, zFlat, rFlat, offsets, function, klargerj=True):
+    """
+    Energy of each environment from a user-supplied 3-body function(rij, rik, cosTheta)
+    """
+    
+    size = len(offsets) - 1
+    outputData = np.zeros((size, 1))
+    for i in xrange(size):
+        
+        neighbours = slice(offsets[i], offsets[i+1])
+        xi = xFlat[neighbours]
+        yi = yFlat[neighbours]
+        zi = zFlat[neighbours]
+        ri = np.sqrt(rFlat[neighbours])
+        
+        for j in xrange(len(xi)):
+            
+            # all k != i,j OR k > j
+            if klargerj:
+                k = np.arange(len(ri)) > j
+            else:
+                k = np.arange(len(ri)) != j
+                
+            cosTheta = (xi[j]*xi[k] + yi[j]*yi[k] + zi[j]*zi[k]) / (ri[j]*ri[k])
+            cosTheta = np.clip(cosTheta, -1, 1)
+            outputData[i,0] += function(ri[j], ri[k], cosTheta)
+            
+    return outputData
+    
+    
+def nestedNeighbours(flat, offsets, start, end):
+    """
+    Nested list of the neighbours of atoms [start,end) from a flat array
+    """
+    
+    return [flat[offsets[i]:offsets[i+1]] for i in xrange(start, end)]
+    
+    
            
 def applyThreeBodySymmetry(x, y, z, r, parameters, symmFuncType, function=None, E=None, forces=False,
-                           sampleName='', klargerj=True, shiftMean=False, normalize=False, standardize=False):
+                           sampleName='', klargerj=True, shiftMean=False, normalize=False, standardize=False,
+                           blockSize=None, workers=1, offsets=None, tableSpacing=None):
     """
     Transform input coordinates with 2- and 3-body symmetry functions
     Input coordinates can be random or sampled from lammps
     Output data can be supplied with an array E or be generated
     using the optional function argument
+    x, y, z, r are nested lists, or flat arrays indexed by offsets
+    as returned by readers.readNeighbourDataBinary
+    The environments are transformed blockSize at a time with symmetryBlock,
+    spread over a pool of processes if workers > 1
+    The radial factors are interpolated in tables if tableSpacing is given
     """
     
     if symmFuncType == 'G4':
@@ -168,13 +650,17 @@ def applyThreeBodySymmetry(x, y, z, r, parameters, symmFuncType, function=None,
         print
         print "Using k != j when training"
     
-    size = len(x)
+    # pack the ragged neighbour lists into flat arrays once
+    if offsets is None:
+        x, y, z, r, offsets = neighbourArrays(x, y, z, r)
+    
+    size = len(offsets) - 1
     numberOfSymmFunc = len(parameters)
     
     inputData  = np.zeros((size,numberOfSymmFunc)) 
        
     if function == None:
-        if E == None:
+        if E is None:
             print "Either function or energy must be supplied"
             exit(1)
         else:
@@ -184,149 +670,38 @@ def applyThreeBodySymmetry(x, y, z, r, parameters, symmFuncType, function=None,
         outputData = np.zeros((size, 1))
         print "Energy is generated with user-supplied function"
         
-    # store 
-    Rijs = []
-    drijs = []
-    Riks = []
-    driks = []
-    cosThetas = []
-    Rjks = []
-    drjks = []
-    
-    # loop through each data vector, i.e. each atomic environment
-    fractionOfNonZeros = 0.0
-    fractionOfInputVectorsOnlyZeros = 0.0
-    meanNeighbours = 0.0
-    rjkMin = 100.0
-    rjkMax = 0.0
-    for i in xrange(size):  
+    # each block of environments is padded to the largest neighbour list
+    maxNeighbours = np.max(np.diff(offsets))
+    if blockSize is None:
+        blockSize = defaultBlockSize(maxNeighbours)
         
-        # nested lists
-        drijs.append([])
-        Riks.append([])
-        driks.append([])
-        cosThetas.append([])
-        Rjks.append([])
-        drjks.append([])
+    if workers > 1:
+        print "Transforming with %d worker processes" % workers
+    if tableSpacing is not None:
+        print "Using tabulated radial functions with spacing %g" % tableSpacing
+    shards = symmetryShards(x, y, z, r, offsets, maxNeighbours, parameters, symmFuncType, 
+                            klargerj, blockSize, workers, tableSpacing=tableSpacing)
     
-        # neighbour coordinates for atom i
-        xi = np.array(x[i][:])
-        yi = np.array(y[i][:])
-        zi = np.array(z[i][:])
-        ri = np.array(r[i][:])
-        ri = np.sqrt(ri)
-        numberOfNeighbours = len(xi)
-        
-        # store
-        Rijs.append(ri)     # list of arrays
-        drijs[i].append(xi) # list of list of arrays
-        drijs[i].append(yi)
-        drijs[i].append(zi)
-        
-        # count mean number of neighbours
-        meanNeighbours += numberOfNeighbours
-        
-        # sum over all neighbours k for each neighbour j
-        # this loop takes care of both 2-body and 3-body configs   
-        for j in xrange(numberOfNeighbours):
-            
-            # 3d lists
-            driks[i].append([]);
-            drjks[i].append([]);
-                      
-            # atom j
-            rij = ri[j]
-            xij = xi[j]; yij = yi[j]; zij = zi[j]
-            
-            # all k != i,j OR k > j
-            if klargerj:
-                k = np.arange(len(ri[:])) > j
-            else:
-                k = np.arange(len(ri[:])) != j  
-                
-            rik = ri[k] 
-            xik = xi[k]; yik = yi[k]; zik = zi[k]
-            
-            # compute cos(theta_ijk) and rjk
-            cosTheta = (xij*xik + yij*yik + zij*zik) / (rij*rik) 
-            
-            # floating-point error can yield an argument outside of arccos range
-            if not (np.abs(cosTheta) <= 1).all():
-                for l, arg in enumerate(cosTheta):
-                    if arg < -1:
-                        cosTheta[l] = -1
-                        print "Warning: %.14f has been replaced by %d" % (arg, cosTheta[l])
-                    if arg > 1:
-                        cosTheta[l] = 1
-                        print "Warning: %.14f has been replaced by %d" % (arg, cosTheta[l])
-            
-            xjk = xij - xik
-            yjk = yij - yik
-            zjk = zij - zik
-            rjk = np.sqrt(xjk*xjk + yjk*yjk + zjk*zjk)
-            
-            # store
-            Riks[i].append(rik)             # list of list of arrays
-            driks[i][j].append(xik)         # list of list of list of arrays
-            driks[i][j].append(yik)
-            driks[i][j].append(zik)
-            cosThetas[i].append(cosTheta)
-            Rjks[i].append(rjk)
-            drjks[i][j].append(xjk)
-            drjks[i][j].append(yjk)
-            drjks[i][j].append(zjk)
-                      
-            if rjk.size > 0:            
-                minR = np.min(rjk)
-                maxR = np.max(rjk)
-                if minR < rjkMin:
-                    rjkMin = minR
-                if maxR > rjkMax:
-                    rjkMax = maxR
-            
-            # find value of each symmetry function for this triplet
-            symmFuncNumber = 0
-            for s in parameters:
-                if len(s) == 3:
-                    inputData[i,symmFuncNumber] += symmetryFunctions.G2(rij, s[0], s[1], s[2])
-                else:
-                    if symmFuncType == 'G4':
-                        inputData[i,symmFuncNumber] += symmetryFunctions.G4(rij, rik, rjk, cosTheta, \
-                                                          s[0], s[1], s[2], s[3])
-                    else:
-                        inputData[i,symmFuncNumber] += symmetryFunctions.G5(rij, rik, cosTheta, \
-                                                          s[0], s[1], s[2], s[3])
-                    
-                symmFuncNumber += 1
-
-            # calculate energy with supplied 3-body function or with
-            if function != None:
-                outputData[i,0] += function(rij, rik, cosTheta)                   
-        
-        # count zeros
-        fractionOfNonZeros += np.count_nonzero(inputData[i,:]) / float(numberOfSymmFunc)
-        if not np.any(inputData[i,:]):
-            fractionOfInputVectorsOnlyZeros += 1
+    # transform each shard and reassemble in the original order
+    allStatistics = []
+    start = 0
+    for inputShard, statistics in runShards(symmetryShard, shards, workers):
+        end = start + len(inputShard)
+        inputData[start:end] = inputShard
+        allStatistics.append(statistics)
+        for i in statistics['onlyZeros']:
             print i
+        start = end
             
         # show progress
-        sys.stdout.write("\r%2d %% complete" % ((float(i)/size)*100))
+        sys.stdout.write("\r%2d %% complete" % ((float(end)/size)*100))
         sys.stdout.flush()
         
-                  
-    fractionOfZeros = 1 - fractionOfNonZeros / float(size)
-    fractionOfInputVectorsOnlyZeros /= float(size)
-    print "Fraction of zeros: ", fractionOfZeros
-    print "Fraction of input vectors with only zeros: ", fractionOfInputVectorsOnlyZeros
-    print
-    
-    meanNeighbours /= float(size)
-    print "Mean number of neighbours: ", meanNeighbours
-    print
-    
-    print "min(Rjk) ", rjkMin
-    print "max(Rjk) ", rjkMax
-    print
+    # calculate energy with supplied 3-body function
+    if function != None:
+        outputData = functionEnergy(x, y, z, r, offsets, function, klargerj=klargerj)
+        
+    printStatistics(mergeStatistics(allStatistics), size, numberOfSymmFunc)
     
     print "Input data:"
     maxInput = np.max(inputData)
@@ -344,9 +719,229 @@ def applyThreeBodySymmetry(x, y, z, r, parameters, symmFuncType, function=None,
     print "Mean: ", np.mean(outputData)
     print
     
+    return transformInputData(inputData, outputData, sampleName=sampleName, shiftMean=shiftMean, 
+                              normalize=normalize, standardize=standardize)
+    
+    
+def buildTripletIndex(xFlat, yFlat, zFlat, rFlat, offsets, blockSize=None):
+    """
+    Geometry of all pairs and triplets of a set of environments,
+    which does not depend on the symmetry parameters:
+    offsets and r (not squared) of the pairs of each environment, and
+    for each triplet j < k the indices j, k of its pairs, rjk and cos(theta)
+    The triplets of environment i are found at [tripletOffsets[i], tripletOffsets[i+1])
+    """
+
+    size = len(offsets) - 1
+    numberOfNeighbours = np.diff(offsets)
+    maxNeighbours = int(np.max(numberOfNeighbours))
+    if blockSize is None:
+        blockSize = defaultBlockSize(maxNeighbours)
+
+    pairs = np.triu(np.ones((maxNeighbours, maxNeighbours), dtype=bool), 1)
+
+    allJ = []; allK = []; allRjk = []; allCosTheta = []
+    outside = 0
+    for start in xrange(0, size, blockSize):
+        end = min(start + blockSize, size)
+        xi, yi, zi, ri, mask = padNeighbours(xFlat, yFlat, zFlat, rFlat, offsets,
+                                             start, end, maxNeighbours)
+        tripletMask = mask[:,:,np.newaxis] & mask[:,np.newaxis,:] & pairs
+        cosTheta, rjk = tripletGeometry(xi, yi, zi, ri)
+
+        # triplets in the order of environment, j and k
+        environment, j, k = np.nonzero(tripletMask)
+        first = offsets[start:end][environment]
+        allJ.append(first + j)
+        allK.append(first + k)
+        allRjk.append(rjk[tripletMask])
+        allCosTheta.append(cosTheta[tripletMask])
+        outside += np.sum(np.abs(allCosTheta[-1]) > 1)
+
+    # floating-point error can yield an argument outside of arccos range
+    if outside:
+        print "Warning: %d values of cos(theta) have been replaced by -1 or 1" % outside
+
+    numberOfTriplets = numberOfNeighbours*(numberOfNeighbours - 1) / 2
+    tripletOffsets = np.zeros(size+1, dtype=np.int64)
+    tripletOffsets[1:] = np.cumsum(numberOfTriplets)
+
+    return {'offsets'        : np.asarray(offsets, dtype=np.int64),
+            'r'              : np.sqrt(rFlat),
+            'tripletOffsets' : tripletOffsets,
+            'j'              : np.concatenate(allJ),
+            'k'              : np.concatenate(allK),
+            'rjk'            : np.concatenate(allRjk),
+            'cosTheta'       : np.clip(np.concatenate(allCosTheta), -1, 1)}
+
+
+def symmetryFromIndex(index, parameters, symmFuncType, klargerj=True, chunkSize=10000, tableSpacing=None):
+    """
+    Evaluate all symmetry functions for the environments of a triplet index
+    made by buildTripletIndex, chunkSize environments at a time
+    Only the radial and angular factors are computed, the geometry is read from the index
+    With k != j every triplet is counted twice, as G4 and G5 are symmetric in j and k
+    The radial factors are interpolated in tables if tableSpacing is given
+    Returns the untransformed input vectors [size, numberOfSymmFunc]
+    """
+
+    offsets = index['offsets']
+    tripletOffsets = index['tripletOffsets']
+    size = len(offsets) - 1
+
+    inputData = np.zeros((size, len(parameters)))
+    G2Rows = [s for s, p in enumerate(parameters) if len(p) == 3]
+    tripletRows = [s for s, p in enumerate(parameters) if len(p) != 3]
+
+    rjkMin = 100.0
+    rjkMax = 0.0
+    for start in xrange(0, size, chunkSize):
+        end = min(start + chunkSize, size)
+
+        # environment of each pair and triplet of the chunk
+        pairs = slice(offsets[start], offsets[end])
+        pairEnvironment = np.repeat(np.arange(end - start), np.diff(offsets[start:end+1]))
+        r = np.array(index['r'][pairs])
+
+        for s in G2Rows:
+            eta, Rc, Rs = parameters[s]
+            inputData[start:end,s] = np.bincount(pairEnvironment, minlength=end-start,
+                weights=symmetryFunctions.radialFactor(r, eta, Rc, Rs, tableSpacing))
+
+        if not tripletRows:
+            continue
+
+        triplets = slice(tripletOffsets[start], tripletOffsets[end])
+        tripletEnvironment = np.repeat(np.arange(end - start), np.diff(tripletOffsets[start:end+1]))
+        j = index['j'][triplets] - offsets[start]
+        k = index['k'][triplets] - offsets[start]
+        cosTheta = np.array(index['cosTheta'][triplets])
+        rjk = np.array(index['rjk'][triplets])
+        if len(rjk):
+            rjkMin = min(rjkMin, np.min(rjk))
+            rjkMax = max(rjkMax, np.max(rjk))
+
+        p = np.array([parameters[s] for s in tripletRows])
+        inputData[start:end,tripletRows] = symmetryFunctions.tripletKernel(r, j, k, cosTheta, rjk,
+                                                                           tripletEnvironment, end - start,
+                                                                           p[:,0], p[:,1], p[:,2], p[:,3],
+                                                                           symmFuncType, tableSpacing)
+
+    if not klargerj:
+        inputData[:,tripletRows] *= 2
+
+    statistics = symmetryStatistics(inputData, 0, np.diff(offsets), rjkMin, rjkMax)
+    printStatistics(statistics, size, len(parameters))
+
+    return inputData
+
+
+def tableDeviation(x, y, z, r, offsets, parameters, symmFuncType, inputData, klargerj):
+    """
+    Print and return the maximum absolute and relative deviation of input data 
+    computed with tabulated radial functions from the exact symmetry functions
+    over all environments, one block at a time so that the exact data is never stored
+    The relative deviation of each symmetry function is taken to its largest exact value
+    x, y, z, r are nested lists, or flat arrays indexed by offsets
+    """
+    
+    if offsets is None:
+        x, y, z, r, offsets = neighbourArrays(x, y, z, r)
+        
+    size = len(offsets) - 1
+    maxNeighbours = np.max(np.diff(offsets))
+    blockSize = defaultBlockSize(maxNeighbours)
+    maxDeviation = np.zeros(len(parameters))
+    scale = np.zeros(len(parameters))
+    for start in xrange(0, size, blockSize):
+        end = min(start + blockSize, size)
+        exact = symmetryBlock(x, y, z, r, offsets, start, end, maxNeighbours, 
+                              parameters, symmFuncType, klargerj=klargerj)[0]
+        maxDeviation = np.maximum(maxDeviation, np.max(np.abs(inputData[start:end] - exact), axis=0))
+        scale = np.maximum(scale, np.max(np.abs(exact), axis=0))
+                                         
+    scale[scale == 0] = 1
+    deviation = {'maxAbsolute': float(np.max(maxDeviation)), 
+                 'maxRelative': float(np.max(maxDeviation / scale))}
+    printTableDeviation(deviation, size)
+    
+    return deviation
+    
+    
+def printTableDeviation(deviation, size):
+    
+    print
+    print "Deviation of tabulated from exact symmetry functions for all %d environments:" % size
+    print "Max absolute deviation: %g" % deviation['maxAbsolute']
+    print "Max relative deviation: %g" % deviation['maxRelative']
+    print
+    
+    
+def symmetryChunks(chunks, parameters, symmFuncType, klargerj=True, blockSize=None, workers=1,
+                   itype=0, elem2param=None):
+    """
+    Transform a stream of neighbour chunks from readers.readNeighbourChunks or
+    readers.readNeighbourChunksBinary one chunk at a time, so that memory is
+    bounded by the chunk size and not the number of environments
+    Multi-type chunks are transformed with multiTypeShard when elem2param is given
+    Yields the untransformed input data [chunk, numberOfSymmFunc] and the
+    energies [chunk, 1] of each chunk, statistics are printed at the end
+    """
+    
+    if workers > 1:
+        print "Transforming with %d worker processes" % workers
+        
+    statistics = mergeStatistics([])
+    start = 0
+    for chunk in chunks:
+        offsets = chunk['offsets']
+        size = len(offsets) - 1
+        
+        if elem2param is None:
+            maxNeighbours = np.max(np.diff(offsets))
+            shards = symmetryShards(chunk['x'], chunk['y'], chunk['z'], chunk['r'], offsets, 
+                                    maxNeighbours, parameters, symmFuncType, klargerj, 
+                                    blockSize or defaultBlockSize(maxNeighbours), workers, start)
+            shardFunction = symmetryShard
+        else:
+            shards = multiTypeShards(chunk['x'], chunk['y'], chunk['z'], chunk['r'], chunk['types'], 
+                                     offsets, itype, parameters, elem2param, symmFuncType, 
+                                     workers, start)
+            shardFunction = multiTypeShard
+            
+        inputData = np.zeros((size, len(parameters)))
+        first = 0
+        for inputShard, shardStatistics in runShards(shardFunction, shards, workers):
+            inputData[first:first+len(inputShard)] = inputShard
+            first += len(inputShard)
+            statistics = mergeStatistics([statistics, shardStatistics])
+        start += size
+        
+        # show progress
+        sys.stdout.write("\r%d environments transformed" % start)
+        sys.stdout.flush()
+        
+        yield inputData, chunk['E'].reshape(-1, 1)
+        
+    print
+    if start:
+        printStatistics(statistics, start, len(parameters))
+    
+    
+def transformInputData(inputData, outputData, sampleName='', shiftMean=False, normalize=False, 
+                       standardize=False):
+    """
+    Normalize, shift or standardize symmetrized input data in place
+    Used by applyThreeBodySymmetry and on untransformed data loaded from symmetryCache
+    Returns the transformed data and the parameters of the transformation
+    """
+    
+    size, numberOfSymmFunc = inputData.shape
+    
     # write wymmetry data to file before any coordinate transformation
     # this is to later read the file and save max, min and mean to file
-    if shiftMean or normalize or standardize:
+    # an empty sampleName writes nothing, e.g. when the file exists from an earlier run
+    if sampleName and (shiftMean or normalize or standardize):
         originalName = sampleName.rsplit('S',1)[0] + '.txt'
     else:
         originalName = ''
@@ -453,48 +1048,57 @@ def applyThreeBodySymmetry(x, y, z, r, parameters, symmFuncType, function=None,
     
     
     
-def applyThreeBodySymmetryMultiType(x, y, z, r, types, itype, parameters, elem2param, symmFuncType, E=None, forces=False,
-                                    sampleName='', klargerj=True, shiftMeanFlag=False, normalizeFlag=False):
+def multiTypeShards(x, y, z, r, types, offsets, itype, parameters, elem2param, 
+                    symmFuncType, workers=1, start=0):
     """
-    Transform input coordinates with 2- and 3-body symmetry functions
-    Input coordinates can be random or sampled from lammps
-    Output data can be supplied with an array E or be generated
-    using the optional function argument
+    Split the environments in shards for multiTypeShard
+    x, y, z, r, types are nested lists, or flat arrays indexed by offsets
+    start is the index of the first environment, used for the statistics
     """
     
-    if symmFuncType == 'G4':
-        print 
-        print 'Using G4'
-        tripletSymmFunc = symmetryFunctions.G4
-    elif symmFuncType == 'G5':
-        print 
-        print 'Using G5'
-        tripletSymmFunc = symmetryFunctions.G5
+    size = len(x) if offsets is None else len(offsets) - 1
+    if workers > 1:
+        shardSize = max(1, size / (4*workers))
     else:
-        print 'Not valid triplet symmetry function'
-        exit(1)
+        shardSize = max(1, size / 100)
         
-    if klargerj:
-        print 
-        print "Using k > j when training"
+    if offsets is None:
+        shardColumns = lambda first, last: [column[first:last] for column in (x, y, z, r, types)]
     else:
-        print
-        print "Using k != j when training"
+        shardColumns = lambda first, last: [nestedNeighbours(column, offsets, first, last) 
+                                            for column in (x, y, z, r, types)]
+        
+    return ( shardColumns(first, min(first + shardSize, size)) + \
+             [start + first, itype, parameters, elem2param, symmFuncType] 
+             for first in xrange(0, size, shardSize) )
+    
+    
+def multiTypeShard(arguments):
+    """
+    Transform the environments of one shard for applyThreeBodySymmetryMultiType
+    Top-level function so that shards can be sent to a process pool
+    """
+    
+    x, y, z, r, types, start, itype, parameters, elem2param, symmFuncType = arguments
     
     size = len(x)
-    numberOfSymmFunc = len(parameters)
+    inputData = np.zeros((size, len(parameters)))
     
-    inputData  = np.zeros((size,numberOfSymmFunc)) 
-       
-    outputData = np.array(E)
-    print "Energy is supplied from lammps"
+    # triplet parameter rows of each type combination grouped by cutoff, and
+    # the largest triplet cutoff for each type of neighbour j
+    tripletGroups = {}
+    tripletCutoff = {}
+    for key, (first, last) in elem2param.items():
+        if len(key) != 3 or key[0] != itype or last == first:
+            continue
+        Rc = np.array([p[1] for p in parameters[first:last]])
+        tripletGroups[key] = [(cutoff, rows + first) for cutoff, rows in symmetryFunctions.cutoffGroups(Rc)]
+        tripletCutoff[key[1]] = max(tripletCutoff.get(key[1], 0.0), tripletGroups[key][0][0])
     
     # loop through each data vector, i.e. each atomic environment
-    fractionOfNonZeros = 0.0
-    fractionOfInputVectorsOnlyZeros = 0.0
-    meanNeighbours = 0.0
     rjkMin = 100.0
     rjkMax = 0.0
+    numberOfNeighbours = np.zeros(size, dtype=int)
     for i in xrange(size):  
     
         # neighbour coordinates for atom i
@@ -504,14 +1108,11 @@ def applyThreeBodySymmetryMultiType(x, y, z, r, types, itype, parameters, elem2p
         ri = np.array(r[i][:])
         typesi = np.array(types[i])
         ri = np.sqrt(ri)
-        numberOfNeighbours = len(xi)
-        
-        # count mean number of neighbours
-        meanNeighbours += numberOfNeighbours
+        numberOfNeighbours[i] = len(xi)
         
         # sum over all neighbours k for each neighbour j
         # this loop takes care of both 2-body and 3-body configs   
-        for j in xrange(numberOfNeighbours):
+        for j in xrange(numberOfNeighbours[i]):
                       
             # atom j
             rij = ri[j]
@@ -523,64 +1124,124 @@ def applyThreeBodySymmetryMultiType(x, y, z, r, types, itype, parameters, elem2p
             for s, p in enumerate( parameters[pairRange[0]:pairRange[1]], pairRange[0] ):
                 inputData[i,s] += symmetryFunctions.G2(rij, p[0], p[1], p[2])
                 
-            if rij > 2.6:
+            if rij > tripletCutoff.get(jtype, 0.0):
                 continue
                 
             # must deal with one triplet at a time
-            for k in xrange(j+1, numberOfNeighbours, 1):
+            for k in xrange(j+1, numberOfNeighbours[i], 1):
                               
                 rik = ri[k] 
                 xik = xi[k]; yik = yi[k]; zik = zi[k]
                 ktype = typesi[k]
                 
-                # test triplet cut and types
-                if rik > 2.6:
+                # test triplet types and cut
+                if not (itype, jtype, ktype) in tripletGroups:
                     continue
-                if not (itype, jtype, ktype) in elem2param:
+                groups = tripletGroups[(itype, jtype, ktype)]
+                if rij > groups[0][0] or rik > groups[0][0]:
                     continue
                 
                 # compute cos(theta_ijk) and rjk
                 cosTheta = (xij*xik + yij*yik + zij*zik) / (rij*rik) 
                 
                 # floating-point error can yield an argument outside of arccos range
-                if not (np.abs(cosTheta) <= 1).all():
-                    for l, arg in enumerate(cosTheta):
-                        if arg < -1:
-                            cosTheta[l] = -1
-                            print "Warning: %.14f has been replaced by %d" % (arg, cosTheta[l])
-                        if arg > 1:
-                            cosTheta[l] = 1
-                            print "Warning: %.14f has been replaced by %d" % (arg, cosTheta[l])
+                if np.abs(cosTheta) > 1:
+                    arg = cosTheta
+                    cosTheta = np.sign(arg)
+                    print "Warning: %.14f has been replaced by %d" % (arg, cosTheta)
                 
+                # find symmetry values for [itype,jtype,ktype],
+                # only for the cutoffs that contain the triplet
                 if symmFuncType == 'G4':
                     xjk = xik - xij
                     yjk = yik - yij
                     zjk = zik - zij
                     rjk = np.sqrt(xjk*xjk + yjk*yjk + zjk*zjk)
-                              
-                    if rjk.size > 0:            
-                        minR = np.min(rjk)
-                        maxR = np.max(rjk)
-                        if minR < rjkMin:
-                            rjkMin = minR
-                        if maxR > rjkMax:
-                            rjkMax = maxR
-                
-                # find symmetry values for [itype,jtype,ktype]
-                tripletRange = elem2param[(itype, jtype, ktype)]
-                for s, p in enumerate( parameters[tripletRange[0]:tripletRange[1]], tripletRange[0] ):
-                    inputData[i,s] += tripletSymmFunc(rij, rik, cosTheta,
-                                                      p[0], p[1], p[2], p[3])
+                    rjkMin = min(rjkMin, rjk)
+                    rjkMax = max(rjkMax, rjk)
+                    
+                    rMax = max(rij, rik, rjk)
+                    for cutoff, rows in groups:
+                        if rMax > cutoff:
+                            break
+                        for s in rows:
+                            p = parameters[s]
+                            inputData[i,s] += symmetryFunctions.G4(rij, rik, rjk, cosTheta,
+                                                                   p[0], p[1], p[2], p[3])
+                else:
+                    rMax = max(rij, rik)
+                    for cutoff, rows in groups:
+                        if rMax > cutoff:
+                            break
+                        for s in rows:
+                            p = parameters[s]
+                            inputData[i,s] += symmetryFunctions.G5(rij, rik, cosTheta,
+                                                                   p[0], p[1], p[2], p[3])
+                                                               
+    statistics = symmetryStatistics(inputData, start, numberOfNeighbours, rjkMin, rjkMax)
         
+    return inputData, statistics
+    
+    
+    
+def applyThreeBodySymmetryMultiType(x, y, z, r, types, itype, parameters, elem2param, symmFuncType, E=None, forces=False,
+                                    sampleName='', klargerj=True, shiftMeanFlag=False, normalizeFlag=False, workers=1,
+                                    offsets=None):
+    """
+    Transform input coordinates with 2- and 3-body symmetry functions
+    Input coordinates can be random or sampled from lammps
+    Output data can be supplied with an array E or be generated
+    using the optional function argument
+    x, y, z, r, types are nested lists, or flat arrays indexed by offsets
+    as returned by readers.readNeighbourDataBinary
+    The environments are transformed in shards by multiTypeShard,
+    spread over a pool of processes if workers > 1
+    """
+    
+    if symmFuncType == 'G4':
+        print 
+        print 'Using G4'
+    elif symmFuncType == 'G5':
+        print 
+        print 'Using G5'
+    else:
+        print 'Not valid triplet symmetry function'
+        exit(1)
         
-        # count zeros
-        fractionOfNonZeros += np.count_nonzero(inputData[i,:]) / float(numberOfSymmFunc)
-        if not np.any(inputData[i,:]):
-            fractionOfInputVectorsOnlyZeros += 1
+    if klargerj:
+        print 
+        print "Using k > j when training"
+    else:
+        print
+        print "Using k != j when training"
+    
+    size = len(x) if offsets is None else len(offsets) - 1
+    numberOfSymmFunc = len(parameters)
+    
+    inputData  = np.zeros((size,numberOfSymmFunc)) 
+       
+    outputData = np.array(E)
+    print "Energy is supplied from lammps"
+    
+    # split the environments in shards and transform each shard
+    if workers > 1:
+        print "Transforming with %d worker processes" % workers
+    shards = multiTypeShards(x, y, z, r, types, offsets, itype, parameters, elem2param, 
+                             symmFuncType, workers)
+    
+    # reassemble in the original order
+    allStatistics = []
+    start = 0
+    for inputShard, statistics in runShards(multiTypeShard, shards, workers):
+        end = start + len(inputShard)
+        inputData[start:end] = inputShard
+        allStatistics.append(statistics)
+        for i in statistics['onlyZeros']:
             print i
+        start = end
             
         # show progress
-        sys.stdout.write("\r%2d %% complete" % ((float(i)/size)*100))
+        sys.stdout.write("\r%2d %% complete" % ((float(end)/size)*100))
         sys.stdout.flush()
         
         
@@ -593,19 +1254,7 @@ def applyThreeBodySymmetryMultiType(x, y, z, r, types, itype, parameters, elem2p
                     outfile.write('%g ' % symmValue)
                 outfile.write('\n')
                   
-    fractionOfZeros = 1 - fractionOfNonZeros / float(size)
-    fractionOfInputVectorsOnlyZeros /= float(size)
-    print "Fraction of zeros: ", fractionOfZeros
-    print "Fraction of input vectors with only zeros: ", fractionOfInputVectorsOnlyZeros
-    print
-    
-    meanNeighbours /= float(size)
-    print "Mean number of neighbours: ", meanNeighbours
-    print
-    
-    print "min(Rjk) ", rjkMin
-    print "max(Rjk) ", rjkMax
-    print
+    printStatistics(mergeStatistics(allStatistics), size, numberOfSymmFunc)
     
     print "Input data:"
     maxInput = np.max(inputData)
@@ -652,7 +1301,7 @@ def applyThreeBodySymmetryMultiType(x, y, z, r, types, itype, parameters, elem2p
         print "Decorrelating input..."
        
        
-    if normalize or shiftMean or scaleCovarianceFlag or decorrelateFlag:
+    if normalizeFlag or shiftMeanFlag or scaleCovarianceFlag or decorrelateFlag:
         print "New input data:"
         maxInput = np.max(inputData)
         minInput = np.min(inputData)
@@ -0,0 +1,354 @@
+# cache of symmetrized input data keyed on the contents of the neighbour file
+# and the symmetry parameters, stored as binary .npz files
+
+import numpy as np
+import hashlib
+import json
+import os
+import time
+
+
+# bump when the symmetry transformation changes so that old entries are not reused
+cacheVersion = 2
+
+# maximum total size of a cache directory in bytes
+defaultCacheSize = 2*1024**3
+
+
+def fileDigest(filename, chunkSize=2**20):
+    """
+    sha1 of the contents of a file
+    """
+
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as inFile:
+        chunk = inFile.read(chunkSize)
+        while chunk:
+            digest.update(chunk)
+            chunk = inFile.read(chunkSize)
+
+    return digest.hexdigest()
+
+
+def neighbourDigest(filename, cacheDir):
+    """
+    sha1 of a neighbour file, memoized in cacheDir/digests.txt on
+    path, size and modification time so that large files are hashed once
+    A binary neighbour directory is hashed file by file
+    """
+
+    if os.path.isdir(filename):
+        digest = hashlib.sha1()
+        for name in sorted(os.listdir(filename)):
+            digest.update(name + ' ' + neighbourDigest(os.path.join(filename, name), cacheDir) + '\n')
+        return digest.hexdigest()
+
+    stat = os.stat(filename)
+    path = os.path.abspath(filename)
+    stamp = '%d %r' % (stat.st_size, stat.st_mtime)
+
+    digestFile = os.path.join(cacheDir, 'digests.txt')
+    digests = {}
+    if os.path.isfile(digestFile):
+        with open(digestFile, 'r') as inFile:
+            for line in inFile:
+                words = line.rstrip('\n').split(' ', 3)
+                if len(words) == 4:
+                    digests[words[3]] = (words[1] + ' ' + words[2], words[0])
+
+    if path in digests and digests[path][0] == stamp:
+        return digests[path][1]
+
+    print "Hashing neighbour file %s" % filename
+    digest = fileDigest(filename)
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    with open(digestFile, 'a') as outFile:
+        outFile.write('%s %s %s\n' % (digest, stamp, path))
+
+    return digest
+
+
+def symmetryKey(digest, parameters, symmFuncType, klargerj, *extra):
+    """
+    Cache key of the symmetrized data of a neighbour file with the given digest
+    Any extra arguments that affect the transformation, e.g. elem2param,
+    are included through their repr
+    """
+
+    key = hashlib.sha1()
+    key.update('version %d\n' % cacheVersion)
+    key.update(digest + '\n')
+    key.update(repr([[float(value) for value in p] for p in parameters]) + '\n')
+    key.update('%s %s\n' % (symmFuncType, bool(klargerj)))
+    for argument in extra:
+        key.update(repr(argument) + '\n')
+
+    return key.hexdigest()
+
+
+def cacheFileName(cacheDir, key):
+
+    return os.path.join(cacheDir, key + '.npz')
+
+
+def loadSymmetryData(cacheDir, key):
+    """
+    Untransformed symmetry data stored under key, or None if not cached
+    A hit refreshes the modification time, which orders the entries for pruning
+    """
+
+    filename = cacheFileName(cacheDir, key)
+    if not os.path.isfile(filename):
+        return None
+
+    try:
+        with np.load(filename) as entry:
+            inputData = entry['inputData']
+    except (IOError, ValueError, KeyError) as error:
+        print "Ignoring unreadable cache entry %s: %s" % (filename, error)
+        return None
+
+    os.utime(filename, None)
+    print "Read symmetrized input data from cache:", filename
+
+    return inputData
+
+
+def loadMetadata(cacheDir, key):
+    """
+    Dictionary of metadata stored with saveSymmetryData under key, or None if not cached
+    """
+
+    filename = cacheFileName(cacheDir, key)
+    if not os.path.isfile(filename):
+        return None
+
+    try:
+        with np.load(filename) as entry:
+            return json.loads(str(entry['metadata']))
+    except (IOError, ValueError, KeyError) as error:
+        print "Ignoring unreadable cache metadata %s: %s" % (filename, error)
+        return None
+
+
+def saveSymmetryData(cacheDir, key, inputData, metadata={}, cacheSize=defaultCacheSize):
+    """
+    Store untransformed symmetry data under key together with a dictionary
+    of metadata, then prune the cache directory to cacheSize bytes
+    """
+
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+
+    metadata = dict(metadata)
+    metadata['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    metadata['shape'] = list(inputData.shape)
+
+    # write to a temporary file and rename so that a crash never leaves a partial entry
+    filename = cacheFileName(cacheDir, key)
+    temporaryName = filename[:-4] + '.%d.tmp.npz' % os.getpid()
+    np.savez(temporaryName, inputData=inputData, metadata=np.array(json.dumps(metadata)))
+    os.rename(temporaryName, filename)
+    print "Wrote symmetrized input data to cache:", filename
+
+    pruneCache(cacheDir, cacheSize, keep=key)
+
+
+def streamFileNames(cacheDir, key):
+    """
+    Memory-mapped .npy files of a streamed entry, see lammpsData.streamTrainingData
+    """
+    
+    return dict( (name, os.path.join(cacheDir, key + name + '.npy')) 
+                 for name in ['xTrain', 'yTrain', 'xTest', 'yTest'] )
+    
+    
+def loadStreamedData(cacheDir, key):
+    """
+    Memory-mapped training and test data of a streamed entry, or None if not cached
+    """
+    
+    fileNames = streamFileNames(cacheDir, key)
+    if not all(os.path.isfile(filename) for filename in fileNames.values()):
+        return None
+        
+    data = {}
+    for name, filename in fileNames.items():
+        data[name] = np.load(filename, mmap_mode='r')
+        os.utime(filename, None)
+    print "Read streamed symmetry data from cache:", os.path.join(cacheDir, key)
+    
+    return data
+    
+    
+def createStreamedData(cacheDir, key, trainSize, testSize, numberOfSymmFunc):
+    """
+    Writable memory-mapped arrays for a streamed entry, 
+    stored under temporary names until finishStreamedData is called
+    """
+    
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+        
+    shapes = {'xTrain': (trainSize, numberOfSymmFunc), 'yTrain': (trainSize, 1), 
+              'xTest' : (testSize, numberOfSymmFunc),  'yTest' : (testSize, 1)}
+    data = {}
+    for name, filename in streamFileNames(cacheDir, key).items():
+        temporaryName = filename[:-4] + '.%d.tmp.npy' % os.getpid()
+        data[name] = np.lib.format.open_memmap(temporaryName, mode='w+', dtype=np.float64, 
+                                               shape=shapes[name])
+        
+    return data
+    
+    
+def finishStreamedData(cacheDir, key, data, cacheSize=defaultCacheSize):
+    """
+    Flush and move the arrays of createStreamedData in place, then prune the cache
+    """
+    
+    for name, filename in streamFileNames(cacheDir, key).items():
+        data[name].flush()
+        os.rename(data[name].filename, filename)
+    print "Wrote streamed symmetry data to cache:", os.path.join(cacheDir, key)
+    
+    pruneCache(cacheDir, cacheSize, keep=key)
+    
+    
+def tripletIndexKey(digest):
+    """
+    Cache key of the triplet index of a neighbour file with the given digest,
+    which is shared by all symmetry parameter sets
+    """
+
+    key = hashlib.sha1()
+    key.update('version %d\n' % cacheVersion)
+    key.update(digest + '\n')
+    key.update('triplet index\n')
+
+    return key.hexdigest()
+
+
+def tripletIndexFileNames(cacheDir, key):
+    """
+    .npy files of the arrays of a triplet index, see symmetries.buildTripletIndex
+    """
+
+    return dict( (name, os.path.join(cacheDir, key + name + '.npy'))
+                 for name in ['offsets', 'r', 'tripletOffsets', 'j', 'k', 'rjk', 'cosTheta'] )
+
+
+def loadTripletIndex(cacheDir, key):
+    """
+    Memory-mapped triplet index stored under key, or None if not cached
+    """
+
+    fileNames = tripletIndexFileNames(cacheDir, key)
+    if not all(os.path.isfile(filename) for filename in fileNames.values()):
+        return None
+
+    index = {}
+    for name, filename in fileNames.items():
+        index[name] = np.load(filename, mmap_mode='r')
+        os.utime(filename, None)
+    print "Read triplet index from cache:", os.path.join(cacheDir, key)
+
+    return index
+
+
+def saveTripletIndex(cacheDir, key, index, cacheSize=defaultCacheSize):
+    """
+    Store the arrays of a triplet index under key, then prune the cache
+    """
+
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+
+    for name, filename in tripletIndexFileNames(cacheDir, key).items():
+        temporaryName = filename[:-4] + '.%d.tmp.npy' % os.getpid()
+        np.save(temporaryName, index[name])
+        os.rename(temporaryName, filename)
+    print "Wrote triplet index to cache:", os.path.join(cacheDir, key)
+
+    pruneCache(cacheDir, cacheSize, keep=key)
+
+
+def derivativeFileNames(cacheDir, key):
+    """
+    .npy files of the arrays of sparse derivatives, see symmetries.neighbourDerivatives
+    """
+
+    return dict( (name, os.path.join(cacheDir, key + name + '.npy'))
+                 for name in ['neighbourOffsets', 'function', 'dGdr'] )
+
+
+def loadDerivatives(cacheDir, key):
+    """
+    Memory-mapped sparse derivatives stored under key, or None if not cached
+    """
+
+    fileNames = derivativeFileNames(cacheDir, key)
+    if not all(os.path.isfile(filename) for filename in fileNames.values()):
+        return None
+
+    derivatives = {}
+    for name, filename in fileNames.items():
+        derivatives[name] = np.load(filename, mmap_mode='r')
+        os.utime(filename, None)
+    print "Read symmetry derivatives from cache:", os.path.join(cacheDir, key)
+
+    return derivatives
+
+
+def saveDerivatives(cacheDir, key, derivatives, cacheSize=defaultCacheSize):
+    """
+    Store the arrays of sparse derivatives under key, then prune the cache
+    """
+
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+
+    for name, filename in derivativeFileNames(cacheDir, key).items():
+        temporaryName = filename[:-4] + '.%d.tmp.npy' % os.getpid()
+        np.save(temporaryName, derivatives[name])
+        os.rename(temporaryName, filename)
+    print "Wrote symmetry derivatives to cache:", os.path.join(cacheDir, key)
+
+    pruneCache(cacheDir, cacheSize, keep=key)
+
+
+def pruneCache(cacheDir, cacheSize=defaultCacheSize, keep=''):
+    """
+    Delete the least recently used entries until the cache is below cacheSize bytes
+    The files of an entry all start with its key and are removed together
+    """
+
+    entries = {}
+    for name in os.listdir(cacheDir):
+        if not name.endswith(('.npz', '.npy')) or '.tmp.' in name:
+            continue
+        filename = os.path.join(cacheDir, name)
+        stat = os.stat(filename)
+        key = name[:40]
+        mtime, entrySize, filenames = entries.get(key, (0, 0, []))
+        entries[key] = (max(mtime, stat.st_mtime), entrySize + stat.st_size, filenames + [filename])
+
+    totalSize = sum(entry[1] for entry in entries.values())
+    for mtime, entrySize, filenames in sorted(entries.values()):
+        if totalSize <= cacheSize:
+            break
+        if os.path.basename(filenames[0])[:40] == keep:
+            continue
+        for filename in filenames:
+            print "Removing least recently used cache entry", filename
+            os.remove(filename)
+        totalSize -= entrySize
+
+
+def readMetadata(filename):
+    """
+    Metadata dictionary of a cache entry
+    """
+
+    with np.load(filename) as entry:
+        return json.loads(str(entry['metadata']))
@@ -1,5 +1,6 @@
 import numpy as np
 import tensorflow as tf
+import collections
 
 def cutoffFunction(R, Rc):   
     
@@ -45,6 +46,355 @@ def G5(Rij, Rik, cosTheta, eta, Rc, zeta, Lambda):
            
            
            
+def cutoffFunctionBlock(R, Rc):
+    """
+    Cutoff function for arrays of any shape, Rc is broadcast against R
+    """
+
+    return np.where(R <= Rc, 0.5 * (np.cos(np.pi*R / Rc) + 1), 0.0)
+
+
+# tables of radialTable, keyed on (eta, Rc, Rs, spacing), the oldest are dropped 
+# beyond maxRadialTables so that the memory of a long-lived process is bounded
+radialTables = collections.OrderedDict()
+maxRadialTables = 256
+maxTablePoints = 10**6
+
+
+def radialTable(eta, Rc, Rs, spacing):
+    """
+    Cubic Hermite spline of exp(-eta*(r - Rs)**2) * fc(r) on a grid of the given
+    spacing from 0 to Rc, matching the exact value and derivative at each grid point
+    Returns the coefficients c0, c1, c2, c3 of the cubic of each interval in the local 
+    coordinate t in [0, 1) as four contiguous arrays, so that they can be gathered separately
+    Tables are built once per parameter row and process, at most maxRadialTables are kept
+    """
+    
+    key = (float(eta), float(Rc), float(Rs), float(spacing))
+    if key not in radialTables:
+        points = int(np.ceil(Rc/spacing)) + 2 if spacing > 0 else 0
+        if points < 2 or points > maxTablePoints:
+            raise ValueError('table spacing %g gives %d points for Rc = %g, at most %d are allowed' 
+                             % (spacing, points, Rc, maxTablePoints))
+        while len(radialTables) >= maxRadialTables:
+            radialTables.popitem(last=False)
+        r = spacing*np.arange(points)
+        exponential = np.exp(-eta*(r - Rs)**2)
+        fc = cutoffFunctionBlock(r, Rc)
+        values = exponential*fc
+        derivatives = exponential*(2*eta*(Rs - r)*fc + dfcdrBlock(r, Rc)) * spacing
+        
+        radialTables[key] = (values[:-1], 
+                             derivatives[:-1], 
+                             3*(values[1:] - values[:-1]) - 2*derivatives[:-1] - derivatives[1:], 
+                             2*(values[:-1] - values[1:]) + derivatives[:-1] + derivatives[1:])
+        
+    return radialTables[key]
+    
+    
+def radialFactor(R, eta, Rc, Rs=0.0, tableSpacing=None):
+    """
+    exp(-eta*(R - Rs)**2) * fc(R) for arrays of any shape and one parameter row,
+    interpolated in a radialTable if tableSpacing is given
+    """
+    
+    if tableSpacing is None:
+        return np.exp(-eta*(R - Rs)**2) * cutoffFunctionBlock(R, Rc)
+        
+    c0, c1, c2, c3 = radialTable(eta, Rc, Rs, tableSpacing)
+    t = R / tableSpacing
+    interval = t.astype(np.intp)
+    np.minimum(interval, len(c0) - 1, out=interval)
+    t -= interval
+    
+    # Horner's scheme in place
+    value = c3.take(interval)
+    value *= t
+    value += c2.take(interval)
+    value *= t
+    value += c1.take(interval)
+    value *= t
+    value += c0.take(interval)
+    value[R > Rc] = 0
+    
+    return value
+
+
+def G2Block(Rij, eta, Rc, Rs, tableSpacing=None):
+    """
+    G2 for a block of padded environments
+    Rij: [size, maxNeigh], eta, Rc, Rs: [numberOfG2]
+    The radial factors are interpolated in radialTable if tableSpacing is given
+    Returns [size, numberOfG2]
+    """
+
+    if tableSpacing is not None:
+        values = np.zeros((len(Rij), len(eta)))
+        for s in xrange(len(eta)):
+            values[:,s] = np.sum(radialFactor(Rij, eta[s], Rc[s], Rs[s], tableSpacing), axis=1)
+        return values
+
+    R = Rij[:,:,np.newaxis]
+
+    return np.sum( np.exp(-eta*(R - Rs)**2) * cutoffFunctionBlock(R, Rc), axis=1 )
+
+
+def integerPower(base, zeta):
+    """
+    base**zeta by repeated squaring when zeta is a whole number,
+    which is much faster than the generic power for array arguments
+    """
+    
+    if zeta != int(zeta) or zeta < 1:
+        return base**zeta
+        
+    zeta = int(zeta)
+    value = None
+    while zeta:
+        if zeta & 1:
+            value = base.copy() if value is None else value*base
+        zeta >>= 1
+        if zeta:
+            base = base*base
+            
+    return value
+
+
+def angularFactors(cosTheta, zeta, Lambda):
+    """
+    Yield each distinct (zeta, Lambda) with its angular factor
+    2**(1-zeta) * (1 + Lambda*cosTheta)**zeta, in increasing zeta for each Lambda
+    The repeated squares of 1 + Lambda*cosTheta are shared by all whole zeta,
+    e.g. zeta = 1, 2, 4, 16 cost four multiplications in total
+    """
+    
+    for l in np.unique(Lambda):
+        base = 1 + l*cosTheta
+        squares = [base]
+        for z in np.unique(zeta[Lambda == l]):
+            if z != int(z) or z < 1:
+                yield z, l, 2**(1-z) * base**z
+                continue
+                
+            value = None
+            bit = 0
+            power = int(z)
+            while power:
+                if bit == len(squares):
+                    squares.append(squares[-1]*squares[-1])
+                if power & 1:
+                    value = squares[bit] if value is None else value*squares[bit]
+                power >>= 1
+                bit += 1
+            yield z, l, 2**(1-z) * value
+
+
+def cutoffGroups(Rc):
+    """
+    Distinct cutoffs of the parameter rows, largest first, and the rows of each
+    Every triplet inside a cutoff is also inside all larger ones,
+    so the triplets of each group can be pruned from those of the previous group
+    """
+    
+    return [(cutoff, np.where(Rc == cutoff)[0]) for cutoff in np.unique(Rc)[::-1]]
+
+
+def tripletBlock(Rij, cosTheta, Rjk, tripletMask, eta, Rc, zeta, Lambda, symmFuncType, tableSpacing=None):
+    """
+    G4 or G5 for a block of padded environments
+    Rij: [size, maxNeigh], cosTheta, Rjk, tripletMask: [size, maxNeigh, maxNeigh]
+    eta, Rc, zeta, Lambda: [numberOfTriplets]
+    For each cutoff the neighbours beyond it are moved to the end of each row
+    and cut away, so that only triplets inside the cutoff are evaluated.
+    Within a cutoff each transcendental factor is computed once: the cutoff
+    function per pair, the Gaussian per pair and distinct eta, the angular 
+    factor per triplet and distinct (zeta, Lambda) and the rjk factor of G4
+    per triplet and distinct eta. Each G is then a contraction of these factors
+    The radial factors are interpolated in radialTable if tableSpacing is given
+    Returns [size, numberOfTriplets]
+    """
+    
+    size = Rij.shape[0]
+    environments = np.arange(size)[:,np.newaxis]
+    
+    values = np.zeros((size, len(eta)))
+    for cutoff, group in cutoffGroups(Rc):
+        
+        # neighbours inside the cutoff first, padded neighbours are always outside
+        inside = Rij <= cutoff
+        width = np.max(np.sum(inside, axis=1)) if size else 0
+        if width == 0:
+            continue
+        if width < Rij.shape[1]:
+            order = np.argsort(~inside, axis=1, kind='mergesort')[:,:width]
+            Rij = Rij[environments, order]
+            inside = inside[environments, order]
+            cosTheta = cosTheta[environments[:,:,np.newaxis], order[:,:,np.newaxis], order[:,np.newaxis,:]]
+            Rjk = Rjk[environments[:,:,np.newaxis], order[:,:,np.newaxis], order[:,np.newaxis,:]]
+            tripletMask = tripletMask[environments[:,:,np.newaxis], order[:,:,np.newaxis], order[:,np.newaxis,:]]
+        mask = tripletMask & inside[:,:,np.newaxis] & inside[:,np.newaxis,:]
+        
+        # radial part for each pair and distinct eta, [size, width, numberOfEta]
+        etas, etaIndex = np.unique(eta[group], return_inverse=True)
+        if tableSpacing is None:
+            R = Rij[:,:,np.newaxis]
+            radial = np.exp(-etas*R**2) * cutoffFunctionBlock(R, cutoff)
+        else:
+            radial = np.dstack([radialFactor(Rij, e, cutoff, 0.0, tableSpacing) for e in etas])
+        
+        if symmFuncType == 'G4':
+            # rjk factor for each triplet and distinct eta, padded triplets are zero
+            if tableSpacing is None:
+                fcRjk = cutoffFunctionBlock(Rjk, cutoff) * mask
+                rjkFactors = [np.exp(-e*Rjk**2) * fcRjk for e in etas]
+            else:
+                rjkFactors = [radialFactor(Rjk, e, cutoff, 0.0, tableSpacing) * mask for e in etas]
+            
+        for z, l, angular in angularFactors(cosTheta, zeta[group], Lambda[group]):
+            rows = np.where((zeta[group] == z) & (Lambda[group] == l))[0]
+            
+            if symmFuncType == 'G4':
+                for s in rows:
+                    e = etaIndex[s]
+                    values[:,group[s]] = np.einsum('ijk,ijk,ij,ik->i', angular, rjkFactors[e],
+                                                   radial[:,:,e], radial[:,:,e])
+            else:
+                angular *= mask
+                values[:,group[rows]] = np.einsum('ijk,ijs,iks->is', angular, 
+                                                  radial[:,:,etaIndex[rows]], radial[:,:,etaIndex[rows]])
+
+    return values
+
+
+def tripletKernel(Rij, j, k, cosTheta, Rjk, environment, size, eta, Rc, zeta, Lambda, symmFuncType,
+                  tableSpacing=None):
+    """
+    G4 or G5 for flat lists of pairs and triplets j < k, see symmetries.buildTripletIndex
+    Rij: [numberOfPairs], j, k, cosTheta, Rjk, environment: [numberOfTriplets]
+    where j and k index Rij and environment is in [0, size)
+    eta, Rc, zeta, Lambda: [numberOfTriplets]
+    For each cutoff the triplets with rij or rik (and rjk for G4) beyond it are dropped,
+    then the radial product of each triplet is computed once per distinct eta and
+    the angular factor once per distinct (zeta, Lambda), see tripletBlock
+    Returns [size, numberOfTriplets]
+    """
+    
+    values = np.zeros((size, len(eta)))
+    for cutoff, group in cutoffGroups(Rc):
+        
+        # triplets inside the cutoff
+        inside = (Rij[j] <= cutoff) & (Rij[k] <= cutoff)
+        if symmFuncType == 'G4':
+            inside &= Rjk <= cutoff
+        if not np.all(inside):
+            j = j[inside]; k = k[inside]
+            cosTheta = cosTheta[inside]; Rjk = Rjk[inside]
+            environment = environment[inside]
+        if len(j) == 0:
+            continue
+            
+        # radial product of each triplet for each distinct eta
+        etas, etaIndex = np.unique(eta[group], return_inverse=True)
+        radialProducts = []
+        if tableSpacing is None:
+            fc = cutoffFunctionBlock(Rij, cutoff)
+            if symmFuncType == 'G4':
+                fcRjk = cutoffFunctionBlock(Rjk, cutoff)
+        for e in etas:
+            if tableSpacing is None:
+                radial = np.exp(-e*Rij**2) * fc
+            else:
+                radial = radialFactor(Rij, e, cutoff, 0.0, tableSpacing)
+            product = radial[j] * radial[k]
+            if symmFuncType == 'G4':
+                if tableSpacing is None:
+                    product *= np.exp(-e*Rjk**2) * fcRjk
+                else:
+                    product *= radialFactor(Rjk, e, cutoff, 0.0, tableSpacing)
+            radialProducts.append(product)
+            
+        for z, l, angular in angularFactors(cosTheta, zeta[group], Lambda[group]):
+            for s in np.where((zeta[group] == z) & (Lambda[group] == l))[0]:
+                values[:,group[s]] = np.bincount(environment, minlength=size,
+                                                 weights=angular*radialProducts[etaIndex[s]])
+            
+    return values
+    
+    
+def dfcdrBlock(R, Rc):
+    """
+    Derivative of cutoffFunctionBlock, zero beyond the cutoff
+    """
+
+    return np.where(R <= Rc, -0.5*(np.pi/Rc) * np.sin(np.pi*R / Rc), 0.0)
+
+
+def dG2drBlock(Rij, eta, Rc, Rs):
+    """
+    Radial derivative dG2/dRij for a block of padded environments
+    Rij: [size, maxNeigh], eta, Rc, Rs: [numberOfG2]
+    Returns [size, maxNeigh, numberOfG2]
+    """
+
+    R = Rij[:,:,np.newaxis]
+
+    return np.exp(-eta*(R - Rs)**2) * \
+           (2*eta*(Rs - R)*cutoffFunctionBlock(R, Rc) + dfcdrBlock(R, Rc))
+
+
+def tripletGradientBlock(Rij, cosTheta, Rjk, tripletWeight, dEdG, eta, Rc, zeta, Lambda,
+                         symmFuncType):
+    """
+    Coefficients of the gradient of sum_s dEdG[:,s]*G_s for G4 or G5,
+    for a block of padded environments
+    Rij: [size, maxNeigh], cosTheta, Rjk, tripletWeight: [size, maxNeigh, maxNeigh]
+    dEdG: [size, numberOfTriplets], eta, Rc, zeta, Lambda: [numberOfTriplets]
+    tripletWeight counts how often the triplet (j,k) or (k,j) is included,
+    which makes the coefficients symmetric so that only the gradient
+    w.r.t. neighbour j has to be formed. With xj the coordinates of neighbour j,
+    dE/dxj = sum_k angular*(xk/(Rij*Rik) - cosTheta*xj/Rij**2) + radial*xj + rjk*(xj - xk)
+    Returns the three [size, maxNeigh, maxNeigh] coefficients angular, radial and rjk
+    """
+
+    R = Rij[:,:,np.newaxis]
+    exponential = np.exp(-eta*R**2)
+    fc = cutoffFunctionBlock(R, Rc)
+    radial = exponential * fc
+    dRadial = exponential * (-2*eta*R*fc + dfcdrBlock(R, Rc)) / R
+
+    angularCoefficient = np.zeros(tripletWeight.shape)
+    radialCoefficient = np.zeros(tripletWeight.shape)
+    rjkCoefficient = np.zeros(tripletWeight.shape)
+    for z, l in set(zip(zeta, Lambda)):
+        rows = np.where((zeta == z) & (Lambda == l))[0]
+
+        # angular part and its derivative w.r.t. cos(theta) for each triplet
+        base = 1 + l*cosTheta
+        dAngular = 2**(1-z) * z*l * integerPower(base, z-1) * tripletWeight
+        angular = 2**(1-z) * integerPower(base, z) * tripletWeight
+
+        if symmFuncType == 'G4':
+            for s in rows:
+                rjkFactor = np.exp(-eta[s]*Rjk**2) * cutoffFunctionBlock(Rjk, Rc[s])
+                dRjkFactor = np.exp(-eta[s]*Rjk**2) * \
+                             (-2*eta[s]*Rjk*cutoffFunctionBlock(Rjk, Rc[s]) + dfcdrBlock(Rjk, Rc[s])) / Rjk
+                pairs = dEdG[:,s,np.newaxis,np.newaxis] * \
+                        radial[:,:,np.newaxis,s] * radial[:,np.newaxis,:,s]
+                angularCoefficient += dAngular * rjkFactor * pairs
+                radialCoefficient += angular * rjkFactor * dEdG[:,s,np.newaxis,np.newaxis] * \
+                                     dRadial[:,:,np.newaxis,s] * radial[:,np.newaxis,:,s]
+                rjkCoefficient += angular * dRjkFactor * pairs
+        else:
+            # contract the separable radial factors with dEdG over all rows at once
+            angularCoefficient += dAngular * np.einsum('is,ijs,iks->ijk', dEdG[:,rows],
+                                                       radial[:,:,rows], radial[:,:,rows])
+            radialCoefficient += angular * np.einsum('is,ijs,iks->ijk', dEdG[:,rows],
+                                                     dRadial[:,:,rows], radial[:,:,rows])
+
+    return angularCoefficient, radialCoefficient, rjkCoefficient
+
+
+
 def cutoffFunctionTF(R, Rc, cut=False):   
     
     value = 0.5 * (tf.cos(np.pi*R / Rc) + 1)
@@ -103,6 +453,79 @@ def G5TF(xij, yij, zij, xik, yik, zik, eta, Rc, zeta, Lambda):
            cutoffFunctionTF(Rij, Rc) * cutoffFunctionTF(Rik, Rc) )
            
            
+def symmetryLayerTF(coordinates, maxNeighbours, parameters, symmFuncType, klargerj=True):
+    """
+    All symmetry functions of a batch of padded environments inside the graph,
+    so that the network can be trained on coordinates and differentiated with respect to them
+    coordinates: [batch, 4*maxNeighbours], the x, y and z of the neighbours and a mask
+    that is 1 for real and 0 for padded neighbours, see symmetries.packCoordinates
+    Mirrors symmetries.symmetryBlock: G2 and G4/G5 rows grouped by cutoff, with the
+    radial factors per pair and the angular factors per distinct (zeta, Lambda)
+    Returns [batch, numberOfSymmFunc]
+    """
+    
+    n = maxNeighbours
+    dtype = coordinates.dtype.as_numpy_dtype
+    x = coordinates[:,0:n]
+    y = coordinates[:,n:2*n]
+    z = coordinates[:,2*n:3*n]
+    mask = coordinates[:,3*n:4*n]
+    
+    # padded neighbours are put beyond any cutoff, which also keeps the gradients finite
+    r = tf.sqrt( (x*x + y*y + z*z)*mask + (1 - mask)*1e6 )
+    cutoff = lambda R, Rc: cutoffFunctionTF(R, Rc) * tf.cast(tf.less_equal(R, Rc), coordinates.dtype)
+    
+    columns = {}
+    G2Rows = [s for s, p in enumerate(parameters) if len(p) == 3]
+    tripletRows = [s for s, p in enumerate(parameters) if len(p) != 3]
+    
+    if G2Rows:
+        p = np.array([parameters[s] for s in G2Rows], dtype=dtype)
+        R = tf.expand_dims(r, 2)
+        G2 = tf.reduce_sum( tf.exp(-p[:,0]*(R - p[:,2])**2) * cutoff(R, p[:,1]), axis=1 )
+        for column, s in enumerate(G2Rows):
+            columns[s] = G2[:,column]
+            
+    if tripletRows:
+        # triplets (j,k) to include for each environment
+        if klargerj:
+            pairs = np.triu(np.ones((n, n), dtype=dtype), 1)
+        else:
+            pairs = 1 - np.eye(n, dtype=dtype)
+        tripletMask = tf.expand_dims(mask, 2) * tf.expand_dims(mask, 1) * pairs
+        
+        xj = tf.expand_dims(x, 2); yj = tf.expand_dims(y, 2); zj = tf.expand_dims(z, 2)
+        xk = tf.expand_dims(x, 1); yk = tf.expand_dims(y, 1); zk = tf.expand_dims(z, 1)
+        cosTheta = (xj*xk + yj*yk + zj*zk) / (tf.expand_dims(r, 2) * tf.expand_dims(r, 1))
+        cosTheta = tf.clip_by_value(cosTheta, -1, 1)
+        if symmFuncType == 'G4':
+            Rjk = tf.sqrt( ((xj - xk)**2 + (yj - yk)**2 + (zj - zk)**2)*tripletMask + (1 - tripletMask)*1e6 )
+            
+        p = np.array([parameters[s] for s in tripletRows], dtype=dtype)
+        eta, Rc, zeta, Lambda = p[:,0], p[:,1], p[:,2], p[:,3]
+        for Rcut, group in cutoffGroups(Rc):
+            
+            # radial part for each pair and distinct eta
+            etas, etaIndex = np.unique(eta[group], return_inverse=True)
+            fc = cutoff(r, Rcut)
+            radial = [tf.exp(-e*r*r) * fc for e in etas]
+            if symmFuncType == 'G4':
+                fcRjk = cutoff(Rjk, Rcut) * tripletMask
+                rjkFactors = [tf.exp(-e*Rjk*Rjk) * fcRjk for e in etas]
+                
+            for zetaValue, l, angular in angularFactors(cosTheta, zeta[group], Lambda[group]):
+                rows = np.where((zeta[group] == zetaValue) & (Lambda[group] == l))[0]
+                if symmFuncType != 'G4':
+                    angular = angular * tripletMask
+                for s in rows:
+                    radialPairs = tf.expand_dims(radial[etaIndex[s]], 2) * tf.expand_dims(radial[etaIndex[s]], 1)
+                    if symmFuncType == 'G4':
+                        radialPairs = radialPairs * rjkFactors[etaIndex[s]]
+                    columns[tripletRows[group[s]]] = tf.reduce_sum(angular * radialPairs, axis=[1, 2])
+                    
+    return tf.stack([columns[s] for s in xrange(len(parameters))], axis=1)
+    
+    
 def dfcdr(R, Rc):
     
     return -0.5*(np.pi/Rc) * np.sin((np.pi*R) / Rc)
@@ -12,7 +12,12 @@ int main(int numberOfArguments, char *argumentList[]) {
     const char *filename = argumentList[1];
 
     NeuralNetwork *neuralNetwork = new NeuralNetwork();
-    neuralNetwork->readFromFile(filename);
+    // graph.bin is the binary format, graph.dat the old text format
+    std::string name(filename);
+    if ( name.size() > 4 && name.substr(name.size()-4) == ".bin" )
+        neuralNetwork->readFromBinaryFile(filename);
+    else
+        neuralNetwork->readFromFile(filename);
 
     // generate data
     arma::vec data = arma::linspace(0.9, 1.6, 500);
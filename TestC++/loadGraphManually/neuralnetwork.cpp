@@ -108,6 +108,73 @@ void NeuralNetwork::readFromFile(const char *filename) {
 }
 
 
+void NeuralNetwork::readFromBinaryFile(const char *filename) {
+    // read a network written by Tools/networkFile.py writeNetwork
+    // the header gives the layer sizes, so all matrices are allocated
+    // before the weights and biases are read with a single read()
+    // assumes a little-endian host, like the file
+
+    std::ifstream input;
+    input.open(filename, std::ios::in | std::ios::binary);
+
+    // check if file successfully opened
+    if ( !input.is_open() ) { std::cout << "File is not opened" << std::endl; return; }
+
+    // process header
+    char magic[8];
+    input.read(magic, 8);
+    if ( std::string(magic, 8) != std::string("NNGRAPH\0", 8) ) {
+        std::cout << filename << " is not a binary network file" << std::endl;
+        return;
+    }
+
+    int header[3];
+    input.read(reinterpret_cast<char*>(header), sizeof(header));
+    int version = header[0];
+    int numberOfLayers = header[1];
+    if ( version != 1 ) {
+        std::cout << "Unknown format version " << version << std::endl;
+        return;
+    }
+
+    m_activation.resize(header[2]);
+    input.read(&m_activation[0], header[2]);
+
+    m_sizes.resize(numberOfLayers+1);
+    input.read(reinterpret_cast<char*>(&m_sizes[0]), (numberOfLayers+1)*sizeof(int));
+
+    m_nLayers = numberOfLayers - 1;
+    m_nNodes  = m_sizes[1];
+    std::cout << m_nLayers << " " << m_nNodes << " " << m_activation << std::endl;
+
+    // all weights and biases are stored contiguously
+    int numberOfParameters = 0;
+    for (int i=0; i < numberOfLayers; i++)
+        numberOfParameters += m_sizes[i]*m_sizes[i+1] + m_sizes[i+1];
+
+    arma::vec parameters(numberOfParameters);
+    input.read(reinterpret_cast<char*>(parameters.memptr()), numberOfParameters*sizeof(double));
+    if ( input.gcount() != std::streamsize(numberOfParameters*sizeof(double)) ) {
+        std::cout << filename << " is truncated" << std::endl;
+        return;
+    }
+
+    // weights are column-major [sizes[i], sizes[i+1]] like armadillo,
+    // biases are row vectors
+    m_weights.resize(numberOfLayers);
+    m_biases.resize(numberOfLayers);
+    double *position = parameters.memptr();
+    for (int i=0; i < numberOfLayers; i++) {
+        m_weights[i] = arma::mat(position, m_sizes[i], m_sizes[i+1]);
+        position += m_sizes[i]*m_sizes[i+1];
+    }
+    for (int i=0; i < numberOfLayers; i++) {
+        m_biases[i] = arma::mat(position, 1, m_sizes[i+1]);
+        position += m_sizes[i+1];
+    }
+}
+
+
 void NeuralNetwork::network(double dataPoint) {
     // the data needs to be a 1x1 armadillo matrix
     // maybe more than one data point can be processed simultaneously?
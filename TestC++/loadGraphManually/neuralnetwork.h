@@ -2,12 +2,14 @@
 #include <vector>
 #include <armadillo>
 #include <fstream>
+#include <string>
 
 class NeuralNetwork {
 
 public:
     NeuralNetwork();
     void readFromFile(const char *filename);
+    void readFromBinaryFile(const char *filename);
     void network(double dataPoint);
     arma::mat relu(arma::mat matrix);
 
@@ -16,6 +18,8 @@ private:
     int m_nNodes;
     std::vector<arma::mat> m_weights = std::vector<arma::mat>();
     std::vector<arma::mat> m_biases  = std::vector<arma::mat>();
+    std::vector<int> m_sizes = std::vector<int>();
+    std::string m_activation;
     std::ofstream m_outFile;
 };
 
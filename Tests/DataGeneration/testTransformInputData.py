@@ -0,0 +1,48 @@
+# checks that transformInputData only writes symmetry data to file when given a sample name
+# run with python testTransformInputData.py from any directory
+
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+grandParentDir = os.path.dirname(os.path.dirname(currentdir))
+sys.path.insert(0, grandParentDir)
+
+import numpy as np
+import shutil
+import tempfile
+import unittest
+import DataGeneration.symmetries as symmetries
+
+
+class TestTransformInputData(unittest.TestCase):
+    
+    def setUp(self):
+        
+        self.workingDir = os.getcwd()
+        self.tempDir = tempfile.mkdtemp()
+        os.chdir(self.tempDir)
+        self.inputData = np.random.rand(10, 4)
+        self.outputData = np.random.rand(10, 1)
+        
+    def tearDown(self):
+        
+        os.chdir(self.workingDir)
+        shutil.rmtree(self.tempDir)
+        
+    def testEmptySampleNameWritesNothing(self):
+        
+        # SiTrajectoryData and reruns of SiTrainingData pass no sample name
+        for transformation in ['shiftMean', 'normalize', 'standardize']:
+            symmetries.transformInputData(self.inputData.copy(), self.outputData.copy(), 
+                                          **{transformation: True})
+            self.assertEqual(os.listdir(self.tempDir), [])
+            
+    def testSampleNameWritesUntransformedData(self):
+        
+        symmetries.transformInputData(self.inputData.copy(), self.outputData.copy(), 
+                                      sampleName='symmetryBehlerShifted.txt', shiftMean=True)
+        self.assertTrue(os.path.isfile('symmetryBehler.txt'))
+        self.assertTrue(np.allclose(np.loadtxt('symmetryBehler.txt'), self.inputData, rtol=1e-5))
+        
+        
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# checkpoints written in a background thread, so that training does not wait for the disk
+
+import tensorflow as tf
+import threading
+import Queue
+import atexit
+
+
+# writers that are not closed yet, closed at exit and dropped by close()
+openWriters = set()
+
+
+def closeWriters():
+
+    for writer in list(openWriters):
+        writer.close()
+
+
+atexit.register(closeWriters)
+
+
+class CheckpointWriter:
+    """
+    Write checkpoints of variables of the training graph in a background thread
+    save() copies the values to host memory with one session call and queues them,
+    blocking only when queueSize snapshots are already waiting
+    The snapshots are written by a saver of a separate graph with variables of the
+    same names, so that the checkpoints and checkpoint_state are those of tf.train.Saver
+    Queued checkpoints are flushed by close(), which also runs at exit,
+    e.g. when training is interrupted
+    """
+
+    def __init__(self, variables, queueSize=2, latestFilename='checkpoint_state', **saverArguments):
+
+        self.variables = list(variables)
+        self.latestFilename = latestFilename
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders = []
+            copies = {}
+            for variable in self.variables:
+                placeholder = tf.placeholder(variable.dtype.base_dtype, variable.get_shape())
+                self.placeholders.append(placeholder)
+                copies[variable.op.name] = tf.Variable(placeholder, trainable=False)
+            self.assign = tf.variables_initializer(copies.values())
+            self.saver = tf.train.Saver(copies, **saverArguments)
+        self.sess = tf.Session(graph=self.graph)
+
+        self.queue = Queue.Queue(queueSize)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.writeLoop)
+        self.thread.daemon = True
+        self.thread.start()
+        openWriters.add(self)
+
+
+    def save(self, sess, saveFileName, globalStep):
+        """
+        Snapshot the variables in sess and queue a checkpoint saveFileName-globalStep
+        """
+
+        self.checkError()
+        values = sess.run(self.variables)
+        self.queue.put((values, saveFileName, globalStep))
+
+
+    def writeLoop(self):
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            values, saveFileName, globalStep = item
+            try:
+                self.sess.run(self.assign, feed_dict=dict(zip(self.placeholders, values)))
+                self.saver.save(self.sess, saveFileName, global_step=globalStep,
+                                latest_filename=self.latestFilename)
+            except Exception as error:
+                self.error = error
+
+
+    def checkError(self):
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+    def close(self):
+        """
+        Write the queued checkpoints and stop the writer
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        openWriters.discard(self)
+
+        if self.queue.qsize():
+            print "Writing %d queued checkpoints" % self.queue.qsize()
+        self.queue.put(None)
+        self.thread.join()
+        self.sess.close()
+        self.checkError()
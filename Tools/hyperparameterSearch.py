@@ -0,0 +1,269 @@
+# search for network architectures with independent trainings run in a process pool
+#
+# the training data of a Regression object are copied once into shared memory
+# before the pool is forked, so that all workers read the same copy
+# each worker is pinned to its own set of CPUs with taskset and trains with
+# as many intra-op threads as it has CPUs
+# every finished training is appended to a results file of fixed-size binary
+# records, see resultType, and configurations already in the file are skipped
+# when the search is run again, e.g. after a crash
+# the file starts with a line of the run signature, the data and training settings
+# shared by all configurations, and it is only resumed by a run with the same signature
+
+import tensorflow as tf
+import numpy as np
+import multiprocessing
+import multiprocessing.sharedctypes
+import subprocess
+import itertools
+import Queue
+import json
+import os
+import sys
+
+
+configurationType = np.dtype([('layers', '<i4'), ('nodes', '<i4'), ('learningRate', '<f8')])
+
+resultType = np.dtype(configurationType.descr + [('testRMSE', '<f8'), ('epoch', '<i4'),
+                                                 ('timeElapsed', '<f8')])
+
+# state of the worker processes, set before the pool is forked
+searchRegression = None
+searchArguments = None
+
+
+def gridConfigurations(layers, nodes, learningRates, samples=None, seed=None):
+    """
+    All combinations of layers, nodes and learning rates, or with samples
+    a random search of that many of them
+    """
+
+    configurations = np.array(list(itertools.product(layers, nodes, learningRates)),
+                              dtype=configurationType)
+    if samples is not None and samples < len(configurations):
+        chosen = np.random.RandomState(seed).choice(len(configurations), samples, replace=False)
+        configurations = configurations[np.sort(chosen)]
+
+    return configurations
+
+
+def signatureValue(value):
+
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return getattr(value, '__name__', str(value))
+
+
+def runSignature(regress, maxEpochs, networkArguments, trainArguments, extra):
+    """
+    Header line of a results file with the settings shared by all configurations:
+    the data of regress, the training arguments and any extra settings 
+    """
+
+    signature = {'maxEpochs': maxEpochs, 'network': networkArguments, 'train': trainArguments,
+                 'samplesDir': regress.samplesDir, 'symmFuncType': regress.symmFuncType,
+                 'trainSize': regress.trainSize, 'testSize': regress.testSize, 
+                 'inputs': regress.inputs, 'outputs': regress.outputs, 'batchSize': regress.batchSize,
+                 'RMSEtol': regress.RMSEtol, 'parameters': regress.parameters}
+    signature.update(extra)
+
+    return 'signature ' + json.dumps(signature, sort_keys=True, default=signatureValue) + '\n'
+
+
+def readResults(filename):
+    """
+    Signature line and records of a results file as a structured array, 
+    a record cut short by a crash is ignored
+    """
+
+    if not os.path.exists(filename):
+        return None, np.zeros(0, dtype=resultType)
+
+    with open(filename, 'rb') as inFile:
+        signature = inFile.readline()
+        data = inFile.read()
+    if not signature.startswith('signature '):
+        print "%s has no run signature, it is not a results file of runSearch. Exiting." % filename
+        exit(1)
+    complete = len(data) - len(data) % resultType.itemsize
+    return signature, np.frombuffer(data[:complete], dtype=resultType).copy()
+
+
+def writeResult(filename, result):
+
+    with open(filename, 'ab') as outFile:
+        np.array([result], dtype=resultType).tofile(outFile)
+
+
+def configurationKey(configuration):
+
+    return (int(configuration['layers']), int(configuration['nodes']),
+            float(configuration['learningRate']))
+
+
+def sharedArray(array):
+    """
+    Read-only copy of array in shared memory, inherited by forked processes
+    """
+
+    array = np.ascontiguousarray(array)
+    buffer = multiprocessing.sharedctypes.RawArray('b', max(1, array.nbytes))
+    shared = np.frombuffer(buffer, dtype=array.dtype, count=array.size).reshape(array.shape)
+    shared[...] = array
+    shared.flags.writeable = False
+
+    return shared
+
+
+def shareData(regress):
+    """
+    Replace the training and test data of regress by shared copies
+    """
+
+    regress.xTrain = sharedArray(regress.xTrain)
+    regress.yTrain = sharedArray(regress.yTrain)
+    regress.xTest  = sharedArray(regress.xTest)
+    regress.yTest  = sharedArray(regress.yTest)
+    if regress.forceTrain is not None:
+        regress.forceTrain = dict((name, sharedArray(array)) for name, array in regress.forceTrain.items())
+        regress.forceTest  = dict((name, sharedArray(array)) for name, array in regress.forceTest.items())
+
+
+def cpuSets(processes, threads):
+    """
+    CPUs of each worker, threads consecutive CPUs, wrapping around
+    when there are more threads in total than CPUs
+    """
+
+    cpus = multiprocessing.cpu_count()
+    return [[(worker*threads + thread) % cpus for thread in xrange(threads)]
+            for worker in xrange(processes)]
+
+
+def pinProcess(cpus):
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['taskset', '-p', '-c', ','.join(str(cpu) for cpu in cpus),
+                                   str(os.getpid())], stdout=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        print "Could not pin process %d to CPUs %s" % (os.getpid(), cpus)
+
+
+def initializeWorker(workerCPUs, threads):
+
+    # a worker that replaces a dead one finds the queue empty and is not pinned
+    try:
+        pinProcess(workerCPUs.get(True, 1))
+    except Queue.Empty:
+        print "No CPUs left for process %d, it is not pinned" % os.getpid()
+    searchRegression.sessionConfig = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                    inter_op_parallelism_threads=1)
+
+
+def trainConfiguration(configuration):
+    """
+    Train a new network of the given configuration on the data of searchRegression,
+    in a graph of its own
+    """
+
+    regress = searchRegression
+    arguments = searchArguments
+    layers, nodes, learningRate = configurationKey(configuration)
+
+    stdout = sys.stdout
+    if arguments['logDir']:
+        logName = '%s/layers%d-nodes%d-lr%g.txt' % (arguments['logDir'], layers, nodes, learningRate)
+        sys.stdout = open(logName, 'w')
+    try:
+        regress.learningRate = learningRate
+        with tf.Graph().as_default():
+            regress.constructNetwork(layers, nodes, **arguments['network'])
+            testRMSE, epoch, timeElapsed = regress.train(arguments['maxEpochs'], **arguments['train'])
+    finally:
+        if arguments['logDir']:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    return (layers, nodes, learningRate, testRMSE, epoch, timeElapsed)
+
+
+def runSearch(regress, configurations, resultsName, maxEpochs, processes=1, threads=None,
+              logDir=None, networkArguments={}, trainArguments={}, signature={}):
+    """
+    Train a network for each configuration on the data of regress,
+    processes at a time with threads CPUs each, by default the CPUs are
+    divided between the processes
+    The results are appended to resultsName as they finish and configurations
+    already in resultsName are skipped
+    networkArguments and trainArguments are passed on to
+    Regression.constructNetwork and Regression.train
+    With logDir the output of each training goes to a file in logDir
+    signature holds settings of the data that regress does not know, e.g. how it
+    was transformed, a results file made with other settings is not resumed
+    Returns all results in resultsName
+    """
+
+    global searchRegression, searchArguments
+
+    header = runSignature(regress, maxEpochs, networkArguments, trainArguments, signature)
+    previous, results = readResults(resultsName)
+    if previous is None:
+        with open(resultsName, 'wb') as outFile:
+            outFile.write(header)
+    elif previous != header:
+        previous = json.loads(previous.split(' ', 1)[1])
+        current = json.loads(header.split(' ', 1)[1])
+        print "%s is the search of another run, it differs in: %s. Exiting." % \
+              (resultsName, ', '.join(sorted(key for key in set(previous) | set(current) 
+                                             if previous.get(key) != current.get(key))))
+        exit(1)
+    else:
+        # a record cut short by a crash is dropped before new ones are appended
+        with open(resultsName, 'r+b') as outFile:
+            outFile.truncate(len(header) + results.nbytes)
+
+    done = set(configurationKey(result) for result in results)
+    remaining = [configuration for configuration in configurations
+                 if configurationKey(configuration) not in done]
+    print "Configurations: %d, finished: %d, remaining: %d" % \
+          (len(configurations), len(configurations) - len(remaining), len(remaining))
+    if logDir and not os.path.exists(logDir):
+        os.makedirs(logDir)
+
+    searchRegression = regress
+    searchArguments = {'maxEpochs': maxEpochs, 'logDir': logDir,
+                       'network': networkArguments, 'train': trainArguments}
+
+    def report(result):
+        writeResult(resultsName, result)
+        print "Layers: %2d, nodes: %2d, learning rate: %g, RMSE = %g, Epoch = %d, time = %10g" % result
+        sys.stdout.flush()
+
+    if processes <= 1:
+        if threads:
+            regress.sessionConfig = tf.ConfigProto(intra_op_parallelism_threads=threads)
+        for configuration in remaining:
+            report(trainConfiguration(configuration))
+        return readResults(resultsName)[1]
+
+    # the data are shared by the workers forked below
+    shareData(regress)
+    if not threads:
+        threads = max(1, multiprocessing.cpu_count() / processes)
+    workerCPUs = multiprocessing.Queue()
+    for cpus in cpuSets(processes, threads):
+        workerCPUs.put(cpus)
+
+    pool = multiprocessing.Pool(processes, initializer=initializeWorker, initargs=(workerCPUs, threads))
+    try:
+        for result in pool.imap_unordered(trainConfiguration, remaining):
+            report(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return readResults(resultsName)[1]
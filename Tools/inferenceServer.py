@@ -0,0 +1,464 @@
+"""
+Long-running inference service for trained networks
+The network is loaded once, from a binary network file (graph.bin), a frozen
+graph (frozen_graph.pb) or the latest checkpoint of a training directory, and
+requests from many clients are served over a Unix socket or localhost TCP
+Concurrent requests are coalesced into micro-batches that are evaluated with
+one session call, waiting at most maxDelay seconds for more requests after
+the first one has arrived
+
+One JSON object per line in each direction:
+{"symmetry": [[G1, G2, ...], ...]}
+    energies and dE/dG of symmetry vectors, as seen by the network
+{"coordinates": [[x1, y1, z1, x2, y2, z2, ...], ...]}
+    energies, forces on the central atoms and forces on their neighbours
+    from neighbour coordinates, needs the symmetry parameters
+{"statistics": true}
+    throughput and latency counters
+Errors are returned as {"error": message}
+
+Usage:
+python inferenceServer.py <training directory or network file> [--address host:port or path]
+       [--maxbatch size] [--maxdelay seconds] [--symm G4/G5] [--klargerj]
+"""
+
+import os, sys, inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import tensorflow as tf
+import numpy as np
+import json
+import socket
+import SocketServer
+import threading
+import Queue
+import time
+import neuralNetwork as nn
+import DataGeneration.symmetries as symmetries
+import DataGeneration.readers as readers
+import Tools.networkFile as networkFile
+
+
+def readCheckpointNetwork(loadDir):
+    """
+    Weights, biases and name of the activation function of the latest
+    checkpoint of a training directory, the architecture is read from meta.dat
+    """
+
+    nNodes, nLayers, activation, inputs, outputs, _ = readers.readMetaFile(loadDir + '/meta.dat')
+
+    # find latest checkpoint
+    with open(loadDir + '/Checkpoints/checkpoint_state', 'r') as infile:
+        checkpoint = infile.readline().split()[1][1:-1]
+    loadFileName = loadDir + '/Checkpoints/' + os.path.basename(checkpoint)
+
+    with tf.Graph().as_default():
+        x = tf.placeholder('float', [None, inputs], name='x-input')
+        neuralNetwork = nn.neuralNetwork(nNodes, nLayers, activation, inputs=inputs, outputs=outputs)
+        neuralNetwork.model(x)
+        with tf.Session() as sess:
+            saver = tf.train.Saver()
+            saver.restore(sess, loadFileName)
+            print 'Model restored: ', loadFileName
+            weights = sess.run(neuralNetwork.allWeights)
+            biases = sess.run(neuralNetwork.allBiases)
+
+    return weights, biases, activation.__name__
+
+
+def readTrainedNetwork(source):
+    """
+    Network of a training directory, graph.bin is preferred over frozen_graph.pb
+    and frozen_graph.pb over the latest checkpoint, or of a network file
+    Returns (weights, biases, activation) or the GraphDef of a frozen graph
+    """
+
+    if os.path.isdir(source):
+        if os.path.isfile(source + '/graph.bin'):
+            source = source + '/graph.bin'
+        elif os.path.isfile(source + '/frozen_graph.pb'):
+            source = source + '/frozen_graph.pb'
+        else:
+            return readCheckpointNetwork(source)
+
+    print 'Reading network: ', source
+    if source.endswith('.pb'):
+        graphDef = tf.GraphDef()
+        with open(source, 'rb') as infile:
+            graphDef.ParseFromString(infile.read())
+        return graphDef
+
+    return networkFile.readNetwork(source)
+
+
+class InferenceServer:
+
+    def __init__(self, network, parameters=None, mean=None, symmFuncType='G5', klargerj=False,
+                 maxBatch=10000, maxDelay=0.002):
+
+        self.parameters   = parameters
+        self.mean         = mean
+        self.symmFuncType = symmFuncType
+        self.klargerj     = klargerj
+        self.maxBatch     = maxBatch
+        self.maxDelay     = maxDelay
+
+        # the graph is only run by the batching thread
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            if isinstance(network, tf.GraphDef):
+                # the input and output of the training graph, see regression.py,
+                # the number of inputs is read from the frozen weights of the first layer
+                weights = [node for node in network.node if node.name == 'layer1/weights/Variable'][0]
+                self.inputs = weights.attr['value'].tensor.tensor_shape.dim[0].size
+                self.x = tf.placeholder('float', [None, self.inputs], name='x-input')
+                self.prediction, = tf.import_graph_def(network, input_map={'input/x-input:0': self.x},
+                                                       return_elements=['outputLayer/activation:0'],
+                                                       name='network')
+            else:
+                weights, biases, activation = network
+                self.inputs = weights[0].shape[0]
+                self.x = tf.placeholder(tf.float64, [None, self.inputs], name='x-input')
+                self.prediction = self.makeNetwork(self.x, weights, biases, getattr(tf.nn, activation))
+            self.networkGradient = tf.gradients(self.prediction, self.x)[0]
+        self.sess = tf.Session(graph=self.graph)
+
+        print "Inputs: ", self.inputs
+        if parameters is not None and len(parameters) != self.inputs:
+            print "The network has %d inputs, but %d symmetry parameters are given" % (self.inputs, len(parameters))
+            exit(1)
+        print "Maximum batch size: ", maxBatch
+        print "Maximum delay: ", maxDelay
+
+        self.requests = Queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {'requests': 0, 'environments': 0, 'batches': 0, 'errors': 0,
+                         'latency': 0.0, 'maxLatency': 0.0, 'evaluation': 0.0}
+
+        batcher = threading.Thread(target=self.batchLoop)
+        batcher.daemon = True
+        batcher.start()
+
+
+    def makeNetwork(self, data, weights, biases, activation):
+        """
+        Network of fixed weights and biases with the layers of neuralNetwork.model,
+        evaluated by its modelFromVariables with the values as float64 constants
+        """
+
+        network = nn.neuralNetwork(weights[0].shape[1], len(weights) - 1, activation,
+                                   inputs=weights[0].shape[0], outputs=weights[-1].shape[1])
+
+        # the variables of model only lay out the layers, they are never initialized
+        with tf.name_scope('layout'):
+            network.model(tf.placeholder('float', [None, network.inputs]))
+        constants = dict(zip(network.allWeights + network.allBiases,
+                             [tf.constant(value, tf.float64) for value in list(weights) + list(biases)]))
+        prediction, _ = network.modelFromVariables(data, readVariable=lambda variable: constants[variable])
+
+        return prediction
+
+
+    def evaluate(self, inputData):
+        """
+        Energies [size, 1] and dE/dG [size, inputs] of input vectors,
+        evaluated in the next micro-batch
+        """
+
+        request = {'input': inputData, 'received': time.time(), 'done': threading.Event()}
+        self.requests.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise RuntimeError(request['error'])
+
+        return request['energy'], request['dEdG']
+
+
+    def batchLoop(self):
+        """
+        Take the waiting requests, up to maxBatch input vectors or until maxDelay
+        has passed since the first one, and evaluate them in one session call
+        """
+
+        while True:
+            pending = [self.requests.get()]
+            size = len(pending[0]['input'])
+            deadline = time.time() + self.maxDelay
+            while size < self.maxBatch:
+                try:
+                    request = self.requests.get(timeout=max(0.0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                pending.append(request)
+                size += len(request['input'])
+
+            start = time.time()
+            try:
+                energy, dEdG = self.sess.run([self.prediction, self.networkGradient],
+                    feed_dict={self.x: np.concatenate([request['input'] for request in pending])})
+            except Exception as error:
+                for request in pending:
+                    request['error'] = str(error)
+            else:
+                first = 0
+                for request in pending:
+                    last = first + len(request['input'])
+                    request['energy'] = energy[first:last]
+                    request['dEdG'] = dEdG[first:last]
+                    first = last
+            end = time.time()
+
+            with self.lock:
+                self.counters['batches'] += 1
+                self.counters['requests'] += len(pending)
+                self.counters['environments'] += size
+                self.counters['evaluation'] += end - start
+                for request in pending:
+                    latency = end - request['received']
+                    self.counters['latency'] += latency
+                    self.counters['maxLatency'] = max(self.counters['maxLatency'], latency)
+
+            for request in pending:
+                request['done'].set()
+
+
+    def statistics(self):
+        """
+        Throughput in environments per second since start, mean batch size
+        and mean and max latency of the evaluated requests in seconds
+        """
+
+        with self.lock:
+            counters = dict(self.counters)
+        uptime = time.time() - self.started
+
+        return {'uptime': uptime,
+                'requests': counters['requests'],
+                'environments': counters['environments'],
+                'batches': counters['batches'],
+                'errors': counters['errors'],
+                'throughput': counters['environments'] / uptime,
+                'meanBatchSize': counters['environments'] / float(max(counters['batches'], 1)),
+                'meanLatency': counters['latency'] / max(counters['requests'], 1),
+                'maxLatency': counters['maxLatency'],
+                'evaluationTime': counters['evaluation']}
+
+
+    def symmetryRequest(self, inputData):
+
+        inputData = np.array(inputData, dtype=np.float64)
+        if inputData.ndim != 2 or inputData.shape[1] != self.inputs:
+            raise ValueError('symmetry vectors must have %d values' % self.inputs)
+
+        energy, dEdG = self.evaluate(inputData)
+
+        return {'energy': energy[:,0].tolist(), 'dEdG': dEdG.tolist()}
+
+
+    def coordinateRequest(self, coordinates):
+        """
+        Transform the neighbour coordinates of each environment, evaluate the network
+        and contract dE/dG with the derivatives of the symmetry functions
+        block by block with symmetries.forceBlock
+        The force on the central atom is minus the sum of the forces on its neighbours
+        """
+
+        if self.parameters is None:
+            raise ValueError('no symmetry parameters are loaded')
+
+        environments = [np.array(neighbours, dtype=np.float64).reshape(-1, 3) for neighbours in coordinates]
+        x = [neighbours[:,0] for neighbours in environments]
+        y = [neighbours[:,1] for neighbours in environments]
+        z = [neighbours[:,2] for neighbours in environments]
+        r = [np.sum(neighbours**2, axis=1) for neighbours in environments]
+        xFlat, yFlat, zFlat, rFlat, offsets = symmetries.neighbourArrays(x, y, z, r)
+
+        size = len(offsets) - 1
+        numberOfNeighbours = np.diff(offsets)
+        maxNeighbours = max(int(np.max(numberOfNeighbours)), 1)
+        blockSize = symmetries.defaultBlockSize(maxNeighbours)
+
+        inputData = np.zeros((size, len(self.parameters)))
+        for start in xrange(0, size, blockSize):
+            end = min(start + blockSize, size)
+            inputData[start:end] = symmetries.symmetryBlock(xFlat, yFlat, zFlat, rFlat, offsets, start, end,
+                                                            maxNeighbours, self.parameters, self.symmFuncType,
+                                                            klargerj=self.klargerj)[0]
+        if self.mean is not None:
+            inputData -= self.mean
+
+        energy, dEdG = self.evaluate(inputData)
+
+        forces = np.zeros((size, maxNeighbours, 3))
+        for start in xrange(0, size, blockSize):
+            end = min(start + blockSize, size)
+            forces[start:end] = symmetries.forceBlock(xFlat, yFlat, zFlat, rFlat, offsets, start, end,
+                                                      maxNeighbours, self.parameters, dEdG[start:end],
+                                                      self.symmFuncType, klargerj=self.klargerj)
+
+        return {'energy': energy[:,0].tolist(),
+                'forces': (-np.sum(forces, axis=1)).tolist(),
+                'neighbourForces': [forces[i,:numberOfNeighbours[i]].tolist() for i in xrange(size)]}
+
+
+    def handleRequest(self, request):
+
+        try:
+            if not isinstance(request, dict):
+                raise ValueError('a request must be a JSON object')
+            if request.get('statistics'):
+                return self.statistics()
+            elif 'symmetry' in request:
+                return self.symmetryRequest(request['symmetry'])
+            elif 'coordinates' in request:
+                return self.coordinateRequest(request['coordinates'])
+            else:
+                raise ValueError('unknown request, expected symmetry, coordinates or statistics')
+        except (ValueError, TypeError, RuntimeError) as error:
+            with self.lock:
+                self.counters['errors'] += 1
+            return {'error': str(error)}
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """
+    Serve the requests of one connection, one JSON object per line
+    """
+
+    def handle(self):
+
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as error:
+                reply = {'error': 'invalid JSON: %s' % error}
+            else:
+                reply = self.server.inference.handleRequest(request)
+            self.wfile.write(json.dumps(reply) + '\n')
+            self.wfile.flush()
+
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def parseAddress(address):
+    """
+    (host, port) of host:port, otherwise the path of a Unix socket
+    """
+
+    if ':' in address:
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+
+    return address
+
+
+def makeServer(inference, address='localhost:5000'):
+    """
+    Threaded socket server for an InferenceServer,
+    a stale Unix socket file is removed
+    """
+
+    address = parseAddress(address)
+    if isinstance(address, tuple):
+        server = ThreadingTCPServer(address, RequestHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = ThreadingUnixServer(address, RequestHandler)
+    server.inference = inference
+
+    return server
+
+
+def query(address, request):
+    """
+    Send one request to a running server and return the reply
+    """
+
+    address = parseAddress(address)
+    if isinstance(address, tuple):
+        connection = socket.create_connection(address)
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(address)
+
+    try:
+        connection.sendall(json.dumps(request) + '\n')
+        stream = connection.makefile('r')
+        reply = json.loads(stream.readline())
+        stream.close()
+    finally:
+        connection.close()
+
+    return reply
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print __doc__
+        exit(1)
+
+    source       = sys.argv[1]
+    address      = 'localhost:5000'
+    maxBatch     = 10000
+    maxDelay     = 0.002
+    symmFuncType = 'G5'
+    klargerj     = False
+
+    i = 2
+    while i < len(sys.argv):
+        if sys.argv[i] == '--address':
+            address = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '--maxbatch':
+            maxBatch = int(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == '--maxdelay':
+            maxDelay = float(sys.argv[i+1])
+            i += 2
+        elif sys.argv[i] == '--symm':
+            symmFuncType = sys.argv[i+1]
+            i += 2
+        elif sys.argv[i] == '--klargerj':
+            klargerj = True
+            i += 1
+        else:
+            print "Unknown option %s" % sys.argv[i]
+            exit(1)
+
+    # symmetry parameters and mean of the symmetry functions of a training directory
+    parameters = None
+    mean = None
+    if os.path.isdir(source):
+        if os.path.isfile(source + '/parameters.dat'):
+            parameters = [p for p in readers.readParameters(source + '/parameters.dat') if p]
+            print "Number of symmetry functions: ", len(parameters)
+        if os.path.isfile(source + '/mean.txt'):
+            mean = np.loadtxt(source + '/mean.txt')
+            print "Symmetry functions are shifted by their mean"
+
+    inference = InferenceServer(readTrainedNetwork(source), parameters=parameters, mean=mean,
+                                symmFuncType=symmFuncType, klargerj=klargerj,
+                                maxBatch=maxBatch, maxDelay=maxDelay)
+    server = makeServer(inference, address)
+    print "Serving on", address
+    sys.stdout.flush()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Stopping"
+        server.server_close()
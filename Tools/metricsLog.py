@@ -0,0 +1,90 @@
+# log of the training error, buffered in memory and written in blocks
+#
+# meta.dat keeps its text format, three header lines followed by lines of
+# epoch, train RMSE and test RMSE, which is read by Analyze/plotRMSE.readError
+# metrics.bin next to it has all columns of each record as fixed-size
+# little-endian binary records, see metricsType, which load with one read
+
+import numpy as np
+import os
+import atexit
+
+
+metricsType = np.dtype([('epoch', '<i4'), ('trainRMSE', '<f8'), ('testRMSE', '<f8'),
+                        ('trainMAD', '<f8'), ('testMAD', '<f8'), ('wallTime', '<f8'),
+                        ('stepsPerSecond', '<f8')])
+
+
+# logs that are not closed yet, closed at exit and dropped by close()
+openLogs = set()
+
+
+def closeLogs():
+
+    for log in list(openLogs):
+        log.close()
+
+
+atexit.register(closeLogs)
+
+
+def metricsFileName(metaName):
+
+    return os.path.join(os.path.dirname(metaName), 'metrics.bin')
+
+
+def readMetrics(filename):
+    """
+    Records of a metrics.bin as a structured array, e.g. readMetrics(filename)['testRMSE']
+    """
+
+    return np.fromfile(filename, dtype=metricsType)
+
+
+class MetricsLog:
+    """
+    Records of the training error kept in memory and appended to meta.dat
+    and metrics.bin every blockSize records, by close() and at exit
+    """
+
+    def __init__(self, metaName, header, blockSize=100):
+
+        self.metaName = metaName
+        self.metricsName = metricsFileName(metaName)
+        self.blockSize = blockSize
+        self.records = []
+
+        with open(self.metaName, 'w') as outFile:
+            outFile.write(header)
+        open(self.metricsName, 'wb').close()
+
+        self.closed = False
+        openLogs.add(self)
+
+
+    def record(self, epoch, trainRMSE, testRMSE, trainMAD, testMAD, wallTime, stepsPerSecond):
+
+        self.records.append((epoch, trainRMSE, testRMSE, trainMAD, testMAD, wallTime, stepsPerSecond))
+        if len(self.records) >= self.blockSize:
+            self.flush()
+
+
+    def flush(self):
+
+        if not self.records:
+            return
+
+        records = np.array(self.records, dtype=metricsType)
+        with open(self.metaName, 'a') as outFile:
+            outFile.write(''.join('%d %g %g\n' % (record[0], record[1], record[2]) for record in self.records))
+        with open(self.metricsName, 'ab') as outFile:
+            records.tofile(outFile)
+        self.records = []
+
+
+    def close(self):
+
+        if not self.closed:
+            self.flush()
+            self.closed = True
+            openLogs.discard(self)
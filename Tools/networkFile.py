@@ -0,0 +1,94 @@
+# binary file format of trained networks, read by the C++ code in TestC++/loadGraphManually
+#
+# all numbers are little-endian
+# header:
+#   char[8]     magic, 'NNGRAPH' followed by a zero byte
+#   int32       version
+#   int32       numberOfLayers, number of weight matrices (hidden layers + output layer)
+#   int32       length of the name of the activation function of the hidden layers
+#   char[]      name of the activation function, the output layer is linear
+#   int32[numberOfLayers+1]     layer sizes, inputs first and outputs last
+# data:
+#   float64     weights of each layer in turn, [sizes[l], sizes[l+1]] in column-major order
+#   float64     biases of each layer in turn, [sizes[l+1]]
+#
+# the data is one contiguous block of doubles so that it can be read with a single read()
+# and column-major weights can be used directly as armadillo matrices
+
+import numpy as np
+
+
+magic = 'NNGRAPH\0'
+formatVersion = 1
+
+
+def writeNetwork(filename, weights, biases, activation):
+    """
+    Write the weight matrices [inputs, outputs] and bias vectors of each layer,
+    e.g. from sess.run(neuralNetwork.allWeights), and the name of the activation function
+    """
+
+    sizes = [weights[0].shape[0]] + [w.shape[1] for w in weights]
+
+    with open(filename, 'wb') as outFile:
+        outFile.write(magic)
+        np.array([formatVersion, len(weights), len(activation)], dtype='<i4').tofile(outFile)
+        outFile.write(activation)
+        np.array(sizes, dtype='<i4').tofile(outFile)
+        for w in weights:
+            np.asarray(w, dtype='<f8').ravel(order='F').tofile(outFile)
+        for b in biases:
+            np.asarray(b, dtype='<f8').ravel().tofile(outFile)
+
+
+def readNetwork(filename):
+    """
+    Read a network written by writeNetwork
+    Returns lists of weight matrices and bias vectors and the name of the activation function
+    """
+
+    with open(filename, 'rb') as inFile:
+        if inFile.read(len(magic)) != magic:
+            raise ValueError("%s is not a binary network file" % filename)
+        version, numberOfLayers, nameLength = np.fromfile(inFile, dtype='<i4', count=3)
+        if version != formatVersion:
+            raise ValueError("%s has format version %d, expected %d" % (filename, version, formatVersion))
+        activation = inFile.read(nameLength)
+        sizes = np.fromfile(inFile, dtype='<i4', count=numberOfLayers+1)
+        data = np.fromfile(inFile, dtype='<f8')
+
+    numberOfWeights = np.sum(sizes[:-1]*sizes[1:])
+    if len(data) != numberOfWeights + np.sum(sizes[1:]):
+        raise ValueError("%s is truncated" % filename)
+
+    weights = []
+    biases = []
+    position = 0
+    for l in xrange(numberOfLayers):
+        size = sizes[l]*sizes[l+1]
+        weights.append(data[position:position+size].reshape((sizes[l], sizes[l+1]), order='F'))
+        position += size
+    for l in xrange(numberOfLayers):
+        biases.append(data[position:position+sizes[l+1]])
+        position += sizes[l+1]
+
+    return weights, biases, activation
+
+
+def writeNetworkText(filename, weights, biases, activation):
+    """
+    Write the network in the text format of graph.dat:
+    a header line, the rows of each hidden weight matrix, the columns of the
+    output weights, a blank line and the biases of each layer
+    """
+
+    nLayers = len(weights) - 1
+    with open(filename, 'w') as outFile:
+        outFile.write("%1d %1d %s %d %d\n" % (nLayers, weights[0].shape[1], activation,
+                                            weights[0].shape[0], weights[-1].shape[1]))
+        for w in weights[:-1]:
+            np.savetxt(outFile, w, fmt='%.16g', delimiter=' ', newline=' \n')
+        np.savetxt(outFile, np.transpose(weights[-1]), fmt='%.16g', delimiter=' ', newline=' \n')
+        outFile.write("\n")
+        for b in biases:
+            np.savetxt(outFile, b.reshape((1, -1)), fmt='%.16g', delimiter=' ', newline=' \n')
@@ -2,6 +2,8 @@ import regression
 import numpy as np
 import tensorflow as tf
 import time
+import os
+import Tools.hyperparameterSearch as hyperparameterSearch
 
 def performanceTest(maxEpochs, maxLayers, maxNodes):
     
@@ -233,7 +235,8 @@ def StillingerWeberSymmetry(trainSize, batchSize, testSize, nLayers, nNodes, nEp
 
 def lammpsTrainingSiO2(nLayers=2, nNodes=10, nEpochs=int(1e5), symmFuncType='G5', 
                        activation= tf.nn.sigmoid, lammpsDir='4Atoms/T1e3N1e4', forces=False, 
-                       batch=5, learningRate=0.001, RMSEtol=0.003, outputs=1, atomType=0, nTypes=2, nAtoms=10):
+                       batch=5, learningRate=0.001, RMSEtol=0.003, outputs=1, atomType=0, nTypes=2, nAtoms=10, 
+                       workers=1, chunkSize=None, inputPipeline=False, stepsPerRun=1):
     """
     Use neighbour data and energies from lammps with vashista-potential
     as input and output training data respectively
@@ -249,10 +252,10 @@ def lammpsTrainingSiO2(nLayers=2, nNodes=10, nEpochs=int(1e5), symmFuncType='G5'
                                     learningRate=learningRate, RMSEtol=RMSEtol)
     regress.generateData(low, high, 'lammpsSiO2', 
                          symmFuncType=symmFuncType, dataFolder=lammpsDir, forces=forces, batch=batch,
-                         atomType=atomType, nTypes=nTypes, nAtoms=nAtoms)
+                         atomType=atomType, nTypes=nTypes, nAtoms=nAtoms, workers=workers, chunkSize=chunkSize)
     regress.constructNetwork(nLayers, nNodes, activation=activation,
                              wInit='xavier', bInit='constant')
-    regress.train(nEpochs)
+    regress.train(nEpochs, inputPipeline=inputPipeline, stepsPerRun=stepsPerRun)
     
     
     
@@ -262,10 +265,15 @@ def lammpsTrainingSi(nLayers=2, nNodes=35, nEpochs=int(1e5), symmFuncType='G5',
                      useFunction=False, forces=False, batch=5, Behler=True, \
                      klargerj=False, tags=False, learningRate=0.001, RMSEtol=1e-10, nTypes=1, 
                      normalize=False, shiftMean=False, standardize=False, 
-                     wInit='uniform', bInit='zeros', constantValue=0.1, stdDev=0.1):
+                     wInit='uniform', bInit='zeros', constantValue=0.1, stdDev=0.1, workers=1, 
+                     chunkSize=None, inputPipeline=False, stepsPerRun=1, tripletIndex=False,
+                     tableSpacing=None, coordinates=False, testEvaluation='full', 
+                     testSubset=1000, patience=None, minDelta=0.0):
     """
     Use neighbour data and energies from lammps with sw-potential 
     as input and output training data respectively
+    testEvaluation and testSubset decide how the test set is evaluated, see Regression.train
+    With patience training stops early and the best weights are kept
     """
     
     lammpsDir = "../LAMMPS_test/Silicon/Data/TrainingData/" + lammpsDir + '/'
@@ -285,10 +293,45 @@ def lammpsTrainingSi(nLayers=2, nNodes=35, nEpochs=int(1e5), symmFuncType='G5',
     regress.generateData(low, high, 'lammpsSi', 
                          symmFuncType=symmFuncType, dataFolder=lammpsDir, forces=forces, batch=batch, 
                          Behler=Behler, klargerj=klargerj, tags=tags, nTypes=nTypes, 
-                         normalize=normalize, shiftMean=shiftMean, standardize=standardize)
+                         normalize=normalize, shiftMean=shiftMean, standardize=standardize, 
+                         workers=workers, chunkSize=chunkSize, tripletIndex=tripletIndex, 
+                         tableSpacing=tableSpacing, coordinates=coordinates)
     regress.constructNetwork(nLayers, nNodes, activation=activation,
                              wInit=wInit, bInit=bInit, constantValue=constantValue, stdDev=stdDev)
-    regress.train(nEpochs)
+    regress.train(nEpochs, inputPipeline=inputPipeline, stepsPerRun=stepsPerRun, 
+                  testEvaluation=testEvaluation, testSubset=testSubset, 
+                  patience=patience, minDelta=minDelta)
+    
+    
+def lammpsTrajectoryTrainingSi(nLayers=2, nNodes=35, nEpochs=int(1e5), symmFuncType='G5', 
+                               lammpsDir='', trajectoryFile='trajectory.xyz', energyColumn='c_pe', 
+                               cut=None, frames=(0, None, 1), forceWeight=1.0, activation=tf.nn.sigmoid, 
+                               batch=500, Behler=True, klargerj=False, learningRate=0.001, RMSEtol=1e-10, 
+                               shiftMean=False, wInit='uniform', bInit='zeros', constantValue=0.1, stdDev=0.1, 
+                               workers=1, patience=None, minDelta=0.0):
+    """
+    Train on the energies and forces of all atoms of the frames of a lammps dump
+    with columns x y z, the energy of each atom and fx fy fz, e.g. 
+    dump 1 all custom 100 trajectory.xyz x y z c_pe fx fy fz with compute pe/atom
+    The batches are whole frames of about batch atoms
+    """
+    
+    lammpsDir = "../LAMMPS_test/Silicon/Data/TrainingData/" + lammpsDir + '/'
+    function = None
+    outputs = 1
+    
+    # these are sampled from lammps
+    trainSize = batchSize = testSize = inputs = low = high = 0
+                       
+    regress = regression.Regression(function, trainSize, batchSize, testSize, inputs, outputs,
+                                    learningRate=learningRate, RMSEtol=RMSEtol)
+    regress.generateData(low, high, 'lammpsSiTrajectory', 
+                         symmFuncType=symmFuncType, dataFolder=lammpsDir, batch=batch, 
+                         Behler=Behler, klargerj=klargerj, shiftMean=shiftMean, workers=workers, 
+                         trajectoryFile=trajectoryFile, energyColumn=energyColumn, cut=cut, frames=frames)
+    regress.constructNetwork(nLayers, nNodes, activation=activation,
+                             wInit=wInit, bInit=bInit, constantValue=constantValue, stdDev=stdDev)
+    regress.train(nEpochs, forceWeight=forceWeight, patience=patience, minDelta=minDelta)
     
     
     
@@ -297,14 +340,27 @@ def gridSearchSi(maxLayers=3, minNodes=5, skipNodes=2, maxNodes=30, maxEpochs=1e
                   useFunction=False, forces=False, batch=5, Behler=True, \
                   klargerj=False, tags=False, learningRate=0.001, RMSEtol=1e-10, nTypes=1, 
                   normalize=False, shiftMean=False, standardize=False,
-                  wInit='uniform', bInit='zeros', constantValue=0.1, stdDev=0.1):
+                  wInit='uniform', bInit='zeros', constantValue=0.1, stdDev=0.1, workers=1, 
+                  patience=None, minDelta=0.0, learningRates=None, samples=None, seed=None, 
+                  processes=1, threads=None, resultsName='Tests/gridSearch.bin'):
     """
     Do a grid search to find a suitable NN architecture
+    With patience each architecture is trained until its test RMSE stops improving
+    learningRates are searched as well, with samples a random search of that many
+    configurations is done instead
+    With processes > 1 the trainings run in a pool of processes with threads CPUs each,
+    see Tools/hyperparameterSearch.py. Results are appended to resultsName and 
+    a search that is run again continues where it stopped
     """
     
     lammpsDir = "../LAMMPS_test/Silicon/Data/TrainingData/" + lammpsDir + '/'  
     function = None
     
+    if processes > 1 and (regression.saveFlag or regression.summaryFlag or regression.saveGraphFlag 
+                          or regression.saveGraphTextFlag or regression.saveGraphProtoFlag):
+        print "Parallel trainings can not save to the same training directory. Exiting."
+        exit(1)
+    
     # these are sampled from lammps
     trainSize = batchSize = testSize = inputs = low = high = 0
     regress = regression.Regression(function, trainSize, batchSize, testSize, inputs, outputs,
@@ -312,28 +368,76 @@ def gridSearchSi(maxLayers=3, minNodes=5, skipNodes=2, maxNodes=30, maxEpochs=1e
     regress.generateData(low, high, 'lammpsSi', 
                          symmFuncType=symmFuncType, dataFolder=lammpsDir, forces=forces, batch=batch, 
                          Behler=Behler, klargerj=klargerj, tags=tags, nTypes=nTypes, 
-                         normalize=normalize, shiftMean=shiftMean, standardize=standardize)
+                         normalize=normalize, shiftMean=shiftMean, standardize=standardize, 
+                         workers=workers)
                          
     # finding optimal value
-    counter = 0
-    for layers in xrange(1, maxLayers+1):
-        for nodes in xrange(minNodes, maxNodes+1, skipNodes):
-            regress.constructNetwork(layers, nodes, activation=activation, 
-                                     wInit='uniform', bInit='zeros')
-            testRMSE, epoch, timeElapsed = regress.train(maxEpochs)
-            print "Layers: %2d, nodes: %2d, RMSE = %g, Epoch = %d, time = %10g" % (layers, nodes, testRMSE, epoch, timeElapsed)
-            print
-    
-            if counter == 0:
-                with open('Tests/timeElapsed.txt', 'w') as outFile:
-                    outStr = "Timing analysis"
-                    outFile.write(outStr + '\n')
-                    
-            with open('Tests/timeElapsed.txt', 'a') as outFile:
-                outStr = "Layers: %2d, nodes: %2d, RMSE: %g, Epoch: %d, time = %10g" % (layers, nodes, testRMSE, epoch, timeElapsed)
-                outFile.write(outStr + '\n')
+    if learningRates is None:
+        learningRates = [learningRate]
+    configurations = hyperparameterSearch.gridConfigurations(xrange(1, maxLayers+1), 
+                                                             xrange(minNodes, maxNodes+1, skipNodes), 
+                                                             learningRates, samples=samples, seed=seed)
+    logDir = os.path.splitext(resultsName)[0] if processes > 1 else None
+    results = hyperparameterSearch.runSearch(regress, configurations, resultsName, maxEpochs, 
+                                             processes=processes, threads=threads, logDir=logDir, 
+                                             networkArguments={'activation': activation, 
+                                                               'wInit': wInit, 'bInit': bInit, 
+                                                               'stdDev': stdDev, 
+                                                               'constantValue': constantValue}, 
+                                             trainArguments={'patience': patience, 'minDelta': minDelta}, 
+                                             signature={'forces': forces, 'Behler': Behler, 'klargerj': klargerj, 
+                                                        'tags': tags, 'normalize': normalize, 
+                                                        'shiftMean': shiftMean, 'standardize': standardize})
+    if not len(results):
+        print "No configurations were trained"
+        return
+    
+    with open('Tests/timeElapsed.txt', 'w') as outFile:
+        outFile.write("Timing analysis\n")
+        for result in np.sort(results, order='testRMSE'):
+            outStr = "Layers: %2d, nodes: %2d, learning rate: %g, RMSE: %g, Epoch: %d, time = %10g" % tuple(result)
+            outFile.write(outStr + '\n')
+    print "Best: layers %d, nodes %d, learning rate %g, RMSE %g" % tuple(np.sort(results, order='testRMSE')[0])[:4]
             
-            counter += 1
+            
+def benchmarkInputPipeline(batches=[5, 10, 20, 50, 100, 200], nEpochs=20, nLayers=2, nNodes=35, 
+                           symmFuncType='G5', lammpsDir='', Behler=True, klargerj=False, 
+                           learningRate=0.001, prefetch=10, stepsPerRun=10):
+    """
+    Compare the training step rate of minibatches fed from numpy 
+    with minibatches made in the graph by Regression.inputPipeline,
+    one step or stepsPerRun steps per session call
+    """
+    
+    lammpsDir = "../LAMMPS_test/Silicon/Data/TrainingData/" + lammpsDir + '/'
+    function = None
+    outputs = 1
+    
+    # these are sampled from lammps
+    trainSize = batchSize = testSize = inputs = low = high = 0
+    
+    results = []
+    for batch in batches:
+        regress = regression.Regression(function, trainSize, batchSize, testSize, inputs, outputs,
+                                        learningRate=learningRate)
+        regress.generateData(low, high, 'lammpsSi', symmFuncType=symmFuncType, dataFolder=lammpsDir, 
+                             batch=batch, Behler=Behler, klargerj=klargerj)
+        
+        stepRates = []
+        for inputPipeline, steps in [(False, 1), (True, 1), (True, stepsPerRun)]:
+            tf.reset_default_graph()
+            regress.constructNetwork(nLayers, nNodes, wInit='uniform', bInit='zeros')
+            start = time.time()
+            regress.train(nEpochs, inputPipeline=inputPipeline, prefetch=prefetch, stepsPerRun=steps)
+            stepRates.append( (nEpochs+1)*regress.numberOfBatches / (time.time() - start) )
+        results.append([batch] + stepRates)
+        
+    print
+    for batch, feedRate, pipelineRate, fusedRate in results:
+        print "Batch: %3d, steps/s feed_dict: %8.1f, input pipeline: %8.1f, %d steps per run: %8.1f" % \
+              (batch, feedRate, pipelineRate, stepsPerRun, fusedRate)
+              
+    return results
             
         
 # Lammps Stillinger-Weber gir naboer og energier
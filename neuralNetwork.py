@@ -22,6 +22,7 @@ class neuralNetwork:
         self.allBiases          = []
         self.allPreActivations  = []
         self.allActivations     = []
+        self.allActivationFunctions = []
         
     def init_weights(self, shape):
       
@@ -114,6 +115,8 @@ class neuralNetwork:
                 self.allPreActivations.append(preactivate)
                 tf.summary.histogram(layer_name + "/pre_activations", preactivate)
                 
+            self.allActivationFunctions.append(activation)
+                
             if not activation == None:
                 activations = activation(preactivate, "activation")
                 self.allActivations.append(activations)
@@ -155,6 +158,28 @@ class neuralNetwork:
         activations.append(outputLayer)
         
         return outputLayer
+        
+        
+    def modelFromVariables(self, data, readVariable=lambda variable: variable.read_value()):
+        """
+        Evaluate the network made by model on other data with the same weights and biases
+        Each variable is read with readVariable where the evaluation is built,
+        e.g. inside the body of a tf.while_loop where it changes between iterations
+        Returns the output layer and the values of the weights and biases of each layer in turn
+        """
+        
+        layer = data
+        values = []
+        for weights, biases, activation in zip(self.allWeights, self.allBiases, 
+                                               self.allActivationFunctions):
+            weightValues = readVariable(weights)
+            biasValues = readVariable(biases)
+            values += [weightValues, biasValues]
+            layer = tf.matmul(layer, weightValues) + biasValues
+            if activation != None:
+                layer = activation(layer)
+                
+        return layer, values
 
 
     
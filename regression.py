@@ -28,6 +28,9 @@ lammps:             (x, y, z, r)  of each neighbour and total E is sampled from
                     input data is transformed with angular symmetry functions
                     same sizes of input and output as for radialSymmetry
                     and angularSymmetry
+                    with coordinates=True the padded neighbour coordinates are the
+                    input, input: [size, 4*maxNeighbours], and the symmetry functions
+                    are evaluated in the graph by symmetryFunctions.symmetryLayerTF
 """
                     
 import tensorflow as tf
@@ -40,10 +43,15 @@ import matplotlib.pyplot as plt
 import DataGeneration.randomData as data
 import DataGeneration.lammpsData as lammps
 import DataGeneration.symmetries as symmetries
+import DataGeneration.symmetryFunctions as symmetryFunctions
 import neuralNetwork as nn
 from Tools.inspect_checkpoint import print_tensors_in_checkpoint_file
 from Tools.freeze_graph import freeze_graph
+import Tools.networkFile as networkFile
+import Tools.checkpointWriter as checkpointWriter
+import Tools.metricsLog as metricsLog
 from time import clock as timer
+from tensorflow.python.training import training_ops
 import Tools.matplotlibParameters
 
 
@@ -56,6 +64,8 @@ summaryFlag         = False
 summaryDir          = ''
 saveGraphFlag       = False
 saveGraphName       = ''
+saveGraphTextFlag   = False
+saveGraphTextName   = ''
 saveGraphProtoFlag  = False
 saveGraphProtoName  = ''
 saveMetaName        = ''
@@ -72,14 +82,15 @@ if len(sys.argv) > 1:
     i = 1
     while i < len(sys.argv):
         if sys.argv[i] == '--save' or sys.argv[i] == '--savegraph' or sys.argv[i] == '--savegraphproto' \
-                          or sys.argv[i] == '--summary':
+                          or sys.argv[i] == '--savegraphtext' or sys.argv[i] == '--summary':
             if os.path.exists(trainingDir):
                 print "Attempted to place data in existing directory, %s. Exiting." % trainingDir
                 exit(1)
             else:
                 os.mkdir(trainingDir)
                 saveMetaName = trainingDir + '/' + 'meta.dat'
-                saveGraphName = trainingDir + '/' + 'graph.dat'
+                saveGraphName = trainingDir + '/' + 'graph.bin'
+                saveGraphTextName = trainingDir + '/' + 'graph.dat'
                 print "Making data directory: ", saveMetaName
                 break
         i += 1
@@ -139,7 +150,13 @@ if len(sys.argv) > 1:
             i += 1
             saveGraphFlag = True
             saveMetaFlag = True
-            print "Graph.txt will be saved"
+            print "Graph.bin will be saved"
+
+        elif sys.argv[i] == '--savegraphtext':
+            i += 1
+            saveGraphTextFlag = True
+            saveMetaFlag = True
+            print "Graph.dat will be saved"
 
         elif sys.argv[i] == '--savegraphproto':
             i += 1
@@ -163,6 +180,59 @@ if saveFlag and loadFlag:
     os.system("cp " + loadDir + "/README.txt " + trainingDir)
     
 
+class AdamOptimizerInLoop(tf.train.AdamOptimizer):
+    """
+    Adam that reads its beta power accumulators when each update runs,
+    so that apply_gradients can be used in the body of a tf.while_loop
+    The base class reads them once per session call
+    This overrides private methods and uses private attributes of tf.train.AdamOptimizer
+    and training_ops.apply_adam of TensorFlow 0.12.1, the version this code is written for,
+    and refuses to run if any of them is missing
+    """
+    
+    internalAttributes = ['_beta1_power', '_beta2_power', '_lr_t', '_beta1_t', '_beta2_t', '_epsilon_t', 
+                          '_use_locking']
+    internalMethods = ['_apply_dense', '_finish']
+    
+    def __init__(self, *args, **kwargs):
+        
+        tf.train.AdamOptimizer.__init__(self, *args, **kwargs)
+        
+        missing = [name for name in self.internalAttributes if not hasattr(self, name)] + \
+                  [name for name in self.internalMethods if not hasattr(tf.train.AdamOptimizer, name)]
+        if not hasattr(training_ops, 'apply_adam'):
+            missing.append('training_ops.apply_adam')
+        if missing:
+            raise RuntimeError('AdamOptimizerInLoop is written for the internals of tf.train.AdamOptimizer '
+                               'in TensorFlow 0.12.1, TensorFlow %s lacks %s' % (tf.__version__, ', '.join(missing)))
+    
+    def _apply_dense(self, grad, var):
+        
+        m = self.get_slot(var, "m")
+        v = self.get_slot(var, "v")
+        dtype = var.dtype.base_dtype
+        return training_ops.apply_adam(
+            var, m, v,
+            tf.cast(self._beta1_power.read_value(), dtype),
+            tf.cast(self._beta2_power.read_value(), dtype),
+            tf.cast(self._lr_t, dtype),
+            tf.cast(self._beta1_t, dtype),
+            tf.cast(self._beta2_t, dtype),
+            tf.cast(self._epsilon_t, dtype),
+            grad, use_locking=self._use_locking).op
+            
+    def _finish(self, update_ops, name_scope):
+        
+        with tf.control_dependencies(update_ops):
+            with tf.device(self._beta1_power.device):
+                update_beta1 = self._beta1_power.assign(self._beta1_power.read_value() * self._beta1_t,
+                                                        use_locking=self._use_locking)
+                update_beta2 = self._beta2_power.assign(self._beta2_power.read_value() * self._beta2_t,
+                                                        use_locking=self._use_locking)
+        return tf.group(*update_ops + [update_beta1, update_beta2], name=name_scope)
+        
+    
+
 class Regression:
 
     def __init__(self, function, trainSize, batchSize, testSize, inputs, outputs,
@@ -177,9 +247,21 @@ class Regression:
         self.functionDerivative = functionDerivative
         self.learningRate = learningRate
         self.RMSEtol = RMSEtol
+        self.symmetryLayer = None
+        
+        # forces and symmetry derivatives of whole frames, see lammpsData.SiTrajectoryData
+        self.forceTrain = None
+        self.forceTest = None
+        
+        # environments per chunk of streamed training data, see lammpsData.streamTrainingData
+        self.chunkSize = None
+        
+        # configuration of the training session, e.g. the number of threads
+        self.sessionConfig = None
         
         # save output to terminal
-        if saveFlag or saveGraphFlag:
+        self.outputFile = None
+        if saveFlag or saveGraphFlag or saveGraphTextFlag:
             filepath = trainingDir + '/output.txt'
             self.outputFile = open(filepath, 'w')
             sys.stdout = self.outputFile
@@ -189,7 +271,9 @@ class Regression:
                      symmFuncType='G4', dataFolder='', batch=50, 
                      varyingNeigh=True, forces=False, Behler=True, 
                      klargerj=True, tags=False, atomType=0, nTypes=1, nAtoms=10, 
-                     normalize=False, shiftMean=False, standardize=False):
+                     normalize=False, shiftMean=False, standardize=False, workers=1, chunkSize=None, 
+                     tripletIndex=False, tableSpacing=None, coordinates=False, 
+                     trajectoryFile='trajectory.xyz', energyColumn=None, cut=None, frames=(0, None, 1)):
 
         self.a, self.b = a, b
         self.neighbours = neighbours
@@ -256,6 +340,40 @@ class Regression:
             if saveMetaFlag:              
                 saveParametersFlag = True
 
+        # all atoms of the frames of a lammps dump dataFolder + trajectoryFile with 
+        # energies in energyColumn, and the forces for force matching
+        elif method == 'lammpsSiTrajectory':
+            print "method=lammpsSiTrajectory: Reading energies and forces of lammps frames..."
+            if energyColumn is None:
+                print "The energy column of the lammps dump must be supplied. Exiting."
+                exit(1)
+            if normalize or standardize or tags or chunkSize or tripletIndex or tableSpacing or coordinates:
+                print "Trajectories are only supported with untransformed or shifted, exact symmetry data. Exiting."
+                exit(1)
+                
+            self.samplesDir = dataFolder
+            saveFolder = trainingDir if saveFlag else ''
+            start, stop, stride = frames
+            self.xTrain, self.yTrain, self.xTest, self.yTest, self.inputs, self.outputs, self.parameters, \
+            self.forceTrain, self.forceTest = \
+                lammps.SiTrajectoryData(dataFolder + trajectoryFile, symmFuncType, energyColumn, cut=cut, 
+                                        Behler=Behler, klargerj=klargerj, shiftMean=shiftMean, 
+                                        start=start, stop=stop, stride=stride, trainingDir=saveFolder, 
+                                        workers=workers)
+            self.trainSize = self.xTrain.shape[0]
+            self.testSize  = self.xTest.shape[0]
+            
+            # the batches are whole frames, about batch atoms each
+            numberOfFrames = len(self.forceTrain['frames']) - 1
+            if batch is None:
+                batch = self.trainSize
+            self.batchSize = batch
+            self.numberOfBatches = min(numberOfFrames, max(1, self.trainSize / batch))
+            print "Training frames: %d, test frames: %d" % (numberOfFrames, len(self.forceTest['frames']) - 1)
+            
+            if saveMetaFlag:
+                saveParametersFlag = True
+        
         elif method == 'lammpsSi' or method == 'lammpsSiO2':
             if self.function == None:
                 print "method=lammps: Reading data from lammps simulations, including energies..."
@@ -283,18 +401,35 @@ class Regression:
                     saveFolder = trainingDir
                 else:
                     saveFolder = ''
-                self.xTrain, self.yTrain, self.xTest, self.yTest, self.inputs, self.outputs, self.parameters, \
-                self.Ftrain, self.Ftest = \
-                    lammps.SiTrainingData(dataFolder, symmFuncType, function=self.function, forces=forces, Behler=Behler, 
-                                          klargerj=klargerj, tags=tags, normalize=normalize, shiftMean=shiftMean, 
-                                          standardize=standardize, trainingDir=saveFolder)
+                if coordinates:
+                    if forces or normalize or shiftMean or standardize or tags or chunkSize or tripletIndex or \
+                       tableSpacing or workers > 1 or self.function != None:
+                        print "Coordinates only support untransformed symmetry functions of the graph " \
+                              "and energies from lammps, read by one process. Exiting."
+                        exit(1)
+                    self.xTrain, self.yTrain, self.xTest, self.yTest, self.parameters, maxNeighbours = \
+                        lammps.SiCoordinateData(dataFolder, Behler=Behler)
+                    self.inputs = 4*maxNeighbours
+                    self.outputs = 1
+                    self.symmetryLayer = lambda data : \
+                        symmetryFunctions.symmetryLayerTF(data, maxNeighbours, self.parameters, 
+                                                          symmFuncType, klargerj=klargerj)
+                else:
+                    self.xTrain, self.yTrain, self.xTest, self.yTest, self.inputs, self.outputs, self.parameters, \
+                    self.Ftrain, self.Ftest = \
+                        lammps.SiTrainingData(dataFolder, symmFuncType, function=self.function, forces=forces, 
+                                              Behler=Behler, klargerj=klargerj, tags=tags, normalize=normalize, 
+                                              shiftMean=shiftMean, standardize=standardize, trainingDir=saveFolder, 
+                                              workers=workers, chunkSize=chunkSize, tripletIndex=tripletIndex, 
+                                              tableSpacing=tableSpacing)
             else:
                 print 'Training SiO2'
                 self.atomType = atomType
                 self.nTypes = nTypes
                 self.xTrain, self.yTrain, self.xTest, self.yTest, self.inputs, self.outputs, self.parameters, \
                 self.elem2param = \
-                    lammps.SiO2TrainingData(dataFolder, symmFuncType, atomType, forces=forces, nAtoms=nAtoms)
+                    lammps.SiO2TrainingData(dataFolder, symmFuncType, atomType, forces=forces, nAtoms=nAtoms, 
+                                            workers=workers, chunkSize=chunkSize)
             
             # set different sizes based on lammps data
             self.trainSize = self.xTrain.shape[0]
@@ -316,12 +451,19 @@ class Regression:
                 exit(1)
             
             # set batch size, ensure that train size is a multiple of batch size
+            self.chunkSize = chunkSize
             rest = self.trainSize % batch
             if rest != 0:
                 self.trainSize -= rest
-                indicies = np.random.choice(self.trainSize, rest)
-                self.xTrain = np.delete(self.xTrain, indicies, axis=0)
-                self.yTrain = np.delete(self.yTrain, indicies, axis=0)
+                if chunkSize:
+                    # streamed training data is memory-mapped, leave out the last rows
+                    # instead of copying the whole set
+                    self.xTrain = self.xTrain[:self.trainSize]
+                    self.yTrain = self.yTrain[:self.trainSize]
+                else:
+                    indicies = np.random.choice(self.trainSize, rest)
+                    self.xTrain = np.delete(self.xTrain, indicies, axis=0)
+                    self.yTrain = np.delete(self.yTrain, indicies, axis=0)
                 
             self.batchSize = batch
             self.numberOfBatches = self.trainSize / batch
@@ -370,15 +512,167 @@ class Regression:
             self.x = tf.placeholder('float', [None, self.inputs],  name='x-input')
             self.y = tf.placeholder('float', [None, self.outputs], name='y-input')
 
+        # with coordinate input the network sees the output of the symmetry layer
+        if self.symmetryLayer is None:
+            self.networkInput = lambda data : data
+            networkInputs = self.inputs
+        else:
+            self.networkInput = self.symmetryLayer
+            networkInputs = len(self.parameters)
+            print "Symmetry functions in graph: ", networkInputs
+
         self.neuralNetwork = nn.neuralNetwork(nNodes, nLayers, activation,
                                               weightsInit=wInit, biasesInit=bInit,
-                                              stdDev=stdDev, inputs=self.inputs, outputs=self.outputs, 
+                                              stdDev=stdDev, inputs=networkInputs, outputs=self.outputs, 
                                               constantValue=constantValue)
-        self.makeNetwork = lambda data : self.neuralNetwork.model(self.x)
+        self.makeNetwork = lambda data : self.neuralNetwork.model(self.networkInput(data))
+        
+        
+    def inputPipeline(self, prefetch=10):
+        """
+        Shuffled minibatches of the training set built inside the graph
+        The training set is kept in graph memory as local variables, so that it 
+        is not written to checkpoints, and batches are gathered from an index queue 
+        that is reshuffled every epoch into a queue filled by a background thread
+        Returns a function that makes the ops that take the next batch
+        and the feed that initializes the training set
+        """
+        
+        batchSize = self.batchSize
+        
+        with tf.name_scope('inputPipeline'):
+            xInit = tf.placeholder('float', [self.trainSize, self.inputs], name='x-init')
+            yInit = tf.placeholder('float', [self.trainSize, self.outputs], name='y-init')
+            xData = tf.Variable(xInit, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], 
+                                name='x-data')
+            yData = tf.Variable(yInit, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], 
+                                name='y-data')
+            
+            indexQueue = tf.train.range_input_producer(self.trainSize, shuffle=True, 
+                                                       capacity=batchSize*(prefetch+2))
+            
+            # with prefetch = 0 batches are gathered in the training step itself
+            if prefetch:
+                indicies = indexQueue.dequeue_many(batchSize)
+                batchQueue = tf.FIFOQueue(prefetch, [tf.float32, tf.float32], 
+                                          shapes=[[batchSize, self.inputs], [batchSize, self.outputs]])
+                enqueue = batchQueue.enqueue([tf.gather(xData, indicies), tf.gather(yData, indicies)])
+                tf.train.add_queue_runner(tf.train.QueueRunner(batchQueue, [enqueue]))
+                nextBatch = lambda : batchQueue.dequeue()
+            else:
+                def nextBatch():
+                    indicies = indexQueue.dequeue_many(batchSize)
+                    return tf.gather(xData, indicies), tf.gather(yData, indicies)
+            
+        return nextBatch, {xInit: self.xTrain[:self.trainSize], yInit: self.yTrain[:self.trainSize]}
+        
+        
+    def fusedTrainStep(self, optimizer, nextBatch, stepsPerRun):
+        """
+        Op that takes stepsPerRun optimizer steps on batches from nextBatch in a 
+        tf.while_loop, so that the session overhead is paid once per stepsPerRun steps
+        The slots of the optimizer must already exist, i.e. minimize has been 
+        called outside the loop, and it must read its state in the loop like AdamOptimizerInLoop
+        The number of steps can be fed to the returned placeholder
+        """
+        
+        # in the order the values are read by modelFromVariables
+        variables = [variable for layer in zip(self.neuralNetwork.allWeights, self.neuralNetwork.allBiases) 
+                     for variable in layer]
+        steps = tf.placeholder_with_default(stepsPerRun, [], name='steps')
+        
+        def body(step):
+            # everything in an iteration waits for the update of the previous one
+            with tf.control_dependencies([step]):
+                xBatch, yBatch = nextBatch()
+                prediction, values = self.neuralNetwork.modelFromVariables(self.networkInput(xBatch))
+                cost = tf.div( tf.nn.l2_loss( tf.subtract(prediction, yBatch) ), self.batchSize )
+                # gated like minimize, so that no update runs before all reads of the weights
+                gradients = tf.gradients(cost, values, gate_gradients=True)
+                update = optimizer.apply_gradients(zip(gradients, variables))
+            with tf.control_dependencies([update]):
+                return step + 1
+                
+        fusedStep = tf.while_loop(lambda step: step < steps, body, [tf.constant(0)], 
+                                  parallel_iterations=1)
+                                  
+        return fusedStep, steps
         
 
 
-    def train(self, numberOfEpochs):
+    def frameFeed(self, forceData, frames, xData, yData, inputs):
+        """
+        Feed of the energies, forces and symmetry derivatives of the frames of 
+        forceData, see lammpsData.frameForceData, to the placeholders 
+        inputs = x, y, F, environment, atom, function, dGdr
+        The atoms of the frames are numbered in order from 0
+        """
+        
+        x, y, F, environment, atom, function, dGdr = inputs
+        starts = forceData['frames'][frames]
+        ends = forceData['frames'][frames+1]
+        nonZeros = forceData['nonZeros']
+        
+        atoms = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        rows = np.concatenate([np.arange(nonZeros[start], nonZeros[end]) for start, end in zip(starts, ends)])
+        
+        # atoms of each frame are counted from its first atom in the batch
+        frameStarts = np.cumsum(ends - starts) - (ends - starts)
+        frameNonZeros = nonZeros[ends] - nonZeros[starts]
+        
+        return {x: xData[atoms], y: yData[atoms], F: forceData['F'][atoms], 
+                environment: np.repeat(np.arange(len(atoms)), np.diff(nonZeros)[atoms]), 
+                atom: forceData['atoms'][rows] + np.repeat(frameStarts, frameNonZeros), 
+                function: forceData['function'][rows], dGdr: forceData['dGdr'][rows]}
+        
+        
+    def testErrors(self, sess, errors, x, y, subset=None, chunkSize=None):
+        """
+        Sums of the error ops over the test vectors subset, or all if None,
+        evaluated chunkSize vectors per session call so that memory is bounded, 
+        or all at once if None
+        Returns the sums and the number of vectors
+        """
+        
+        size = self.testSize if subset is None else len(subset)
+        chunkSize = chunkSize or size
+        
+        sums = np.zeros(len(errors))
+        for start in xrange(0, size, chunkSize):
+            if subset is None:
+                rows = slice(start, start + chunkSize)
+            else:
+                rows = subset[start:start + chunkSize]
+            sums += sess.run(errors, feed_dict={x: self.xTest[rows], y: self.yTest[rows]})
+            
+        return sums, size
+        
+        
+    def train(self, numberOfEpochs, inputPipeline=False, prefetch=10, stepsPerRun=1, forceWeight=0, 
+              testEvaluation='full', testSubset=1000, patience=None, minDelta=0.0):
+        """
+        Train the network for numberOfEpochs epochs
+        With inputPipeline the minibatches are made in the graph by inputPipeline 
+        instead of being fed from numpy every step
+        With stepsPerRun > 1 the steps of each epoch are taken stepsPerRun at a 
+        time in one session call by fusedTrainStep, this implies inputPipeline
+        Neither is possible with streamed training data, as inputPipeline copies 
+        the whole training set into the graph
+        With forceWeight > 0 and forces of whole frames in the training data, 
+        method lammpsSiTrajectory, the cost includes forceWeight times the force 
+        cost. The force on each atom is summed over all environments it is part of
+        from the network gradient dE/dG and the sparse derivatives dG/dr, and the 
+        batches are whole frames
+        testEvaluation decides which test vectors are evaluated at each report:
+        'full': all at once, 'chunked': all, testSubset at a time, 
+        'subsample': the same random testSubset vectors every time, 
+        'rotate': the next testSubset vectors of a random order every time
+        With 'subsample' and 'rotate' the whole test set is evaluated in chunks 
+        when the test RMSE of the subset is a new low and at the end of training
+        With patience training stops when the test RMSE has not improved by more 
+        than minDelta in patience reports. The weights of the best report are kept 
+        in memory and restored at the end, and only improvements are checkpointed
+        """
 
         trainSize       = self.trainSize
         batchSize       = self.batchSize
@@ -398,29 +692,108 @@ class Regression:
         epochLow = 0
         timeElapsed = 0
         
+        # test vectors of each report
+        if testEvaluation not in ['full', 'chunked', 'subsample', 'rotate']:
+            print '%s is not a valid test evaluation' % testEvaluation
+            exit(1)
+        testOrder = np.random.permutation(testSize)
+        subsetSize = min(testSubset, testSize)
+        evaluations = 0
+        
+        # early stopping
+        bestRMSE = np.inf
+        bestEpoch = -1
+        bestValues = None
+        reportsSinceBest = 0
+        
+        if self.chunkSize and (inputPipeline or stepsPerRun > 1):
+            print 'Streamed training data are fed batch by batch, the input pipeline ' \
+                  'and stepsPerRun > 1 are not supported. Exiting.'
+            exit(1)
+        
+        # the force batches are fed together with the energy batches
+        forceMatching = forceWeight > 0 and self.forceTrain is not None
+        if forceWeight > 0 and not forceMatching:
+            print 'No forces of whole frames in the training data, training on energies only'
+        if forceMatching and (inputPipeline or stepsPerRun > 1):
+            print 'Force matching feeds the training batches, not using the input pipeline'
+            inputPipeline = False
+            stepsPerRun = 1
+        
         # begin session
-        with tf.Session() as sess:
+        with tf.Session(config=self.sessionConfig) as sess:
+        
+            # training batches are the default input of the network,
+            # test data and single samples are still fed 
+            if stepsPerRun > 1:
+                inputPipeline = True
+            if inputPipeline:
+                nextBatch, dataFeed = self.inputPipeline(prefetch)
+                xBatch, yBatch = nextBatch()
+                x = tf.placeholder_with_default(xBatch, [None, self.inputs], name='x-input-pipeline')
+                y = tf.placeholder_with_default(yBatch, [None, self.outputs], name='y-input-pipeline')
 
             # pass data to network and receive output
             prediction = self.makeNetwork(x)
 
             with tf.name_scope('L2Norm'):
                 # HAVE CHANGED HERE!!!!
-                trainCost = tf.div( tf.nn.l2_loss( tf.subtract(prediction, y) ), batchSize, name='/trainCost')
+                # batches of whole frames vary in size
+                trainCount = tf.cast(tf.shape(prediction)[0], tf.float32) if forceMatching else batchSize
+                trainCost = tf.div( tf.nn.l2_loss( tf.subtract(prediction, y) ), trainCount, name='/trainCost')
                 testCost  = tf.div( tf.nn.l2_loss( tf.subtract(prediction, y) ), testSize, name='/testCost')
+                squaredError = tf.reduce_sum( tf.square( tf.subtract(prediction, y) ) )
                 tf.summary.scalar('L2Norm', trainCost/batchSize)
                 
             with tf.name_scope('MAD'):
                 MAD = tf.reduce_sum( tf.abs( tf.subtract(prediction, y) ) )
+                
+            # total forces of whole frames, each non-zero derivative dG_s/dr_j of 
+            # environment i acts on the neighbour atom j and oppositely on atom i
+            if forceMatching:
+                with tf.name_scope('L2Force'):
+                    F           = tf.placeholder('float', [None, 3], name='F-input')
+                    environment = tf.placeholder(tf.int32, [None], name='environment-input')
+                    atom        = tf.placeholder(tf.int32, [None], name='atom-input')
+                    function    = tf.placeholder(tf.int32, [None], name='function-input')
+                    dGdr        = tf.placeholder('float', [None, 3], name='dGdr-input')
+                    forceInputs = [x, y, F, environment, atom, function, dGdr]
+                    dEdG = tf.gradients(prediction, x)[0]
+                    contributions = tf.expand_dims(tf.gather(tf.reshape(dEdG, [-1]), 
+                                                             environment*self.inputs + function), 1) * dGdr
+                    numberOfAtoms = tf.shape(x)[0]
+                    forcePrediction = tf.unsorted_segment_sum(contributions, environment, numberOfAtoms) - \
+                                      tf.unsorted_segment_sum(contributions, atom, numberOfAtoms)
+                    forceSquaredError = tf.reduce_sum( tf.square( tf.subtract(forcePrediction, F) ) )
+                    forceCost = forceSquaredError / (2*tf.cast(numberOfAtoms, tf.float32))
+                    totalCost = trainCost + forceWeight*forceCost
+            else:
+                totalCost = trainCost
+
+            # weights and biases of the best report are copied back by restoreBest
+            if patience:
+                with tf.name_scope('bestModel'):
+                    modelVariables = self.neuralNetwork.allWeights + self.neuralNetwork.allBiases
+                    bestPlaceholders = [tf.placeholder(variable.dtype.base_dtype, variable.get_shape()) 
+                                        for variable in modelVariables]
+                    restoreBest = tf.group(*[tf.assign(variable, placeholder) for variable, placeholder 
+                                             in zip(modelVariables, bestPlaceholders)])
 
             with tf.name_scope('train'):
-                trainStep = tf.train.AdamOptimizer(learning_rate=learningRate).minimize(trainCost)
+                if stepsPerRun > 1:
+                    optimizer = AdamOptimizerInLoop(learning_rate=learningRate)
+                else:
+                    optimizer = tf.train.AdamOptimizer(learning_rate=learningRate)
+                trainStep = optimizer.minimize(totalCost)
+                
+            if stepsPerRun > 1:
+                with tf.name_scope('fusedTrain'):
+                    fusedStep, fusedSteps = self.fusedTrainStep(optimizer, nextBatch, stepsPerRun)
               
+            # with coordinate input this is the gradient with respect to the 
+            # neighbour coordinates, the forces are minus its x, y and z blocks
             with tf.name_scope('networkGradient'):
                 networkGradient = tf.gradients(self.neuralNetwork.allActivations[-1], x)
-                
-            #with tf.name_scope('L2Force'):
-            #    CFDATrain = tf.nn.l2_loss( tf.subtract(networkGradient, xTrain) )
 
             # initialize variables or restore from file
             saver = tf.train.Saver(keep_checkpoint_every_n_hours=1)
@@ -428,6 +801,19 @@ class Regression:
             if loadFlag:
                 saver.restore(sess, loadFileName)
                 print 'Model %s restored' % loadFileName             
+                
+            # checkpoints are snapshot in the training loop and written in the background
+            if saveFlag or saveGraphProtoFlag:
+                checkpoints = checkpointWriter.CheckpointWriter(tf.global_variables(), 
+                                                                keep_checkpoint_every_n_hours=1)
+                savedEpoch = None
+                
+            # load the training set into the graph and start filling the batch queue
+            if inputPipeline:
+                sess.run(tf.local_variables_initializer(), feed_dict=dataFeed)
+                coordinator = tf.train.Coordinator()
+                threads = tf.train.start_queue_runners(sess=sess, coord=coordinator)
+                trainFeed = None
             
             # merge all the summaries and write them out to training directory
             if summaryFlag:
@@ -436,109 +822,195 @@ class Regression:
                 test_writer = tf.train.SummaryWriter(summaryDir + '/test')
                 
             # decide how often to print and store things
-            every = 1000/self.numberOfBatches
+            every = max(1, 1000/self.numberOfBatches)
+            
+            # forces of all test frames, compared with the reference forces at each report
+            if forceMatching:
+                testForceFeed = self.frameFeed(self.forceTest, np.arange(len(self.forceTest['frames']) - 1), 
+                                               xTest, yTest, forceInputs)
             
             if loadFlag and (plotFlag or plotErrorFlag) and not saveFlag:
                 numberOfEpochs = -1
 
+            # epochs and time of the last record of the metrics
+            metrics = None
+            lastEpoch = -1
+            lastWallTime = 0.0
+
             # train
             print 
             print "##### Starting training session #####"
             start = timer()
             for epoch in xrange(numberOfEpochs+1): 
                 
-                # for shuffling the training set
-                indicies = np.random.choice(trainSize, trainSize, replace=False)
-                
+                # stepsPerRun steps per session call, then the rest of the epoch
+                if stepsPerRun > 1:
+                    for b in xrange(numberOfBatches / stepsPerRun):
+                        sess.run(fusedStep)
+                    if numberOfBatches % stepsPerRun:
+                        sess.run(fusedStep, feed_dict={fusedSteps: numberOfBatches % stepsPerRun})
+                        
+                # batches are shuffled and made in the graph
+                elif inputPipeline:
+                    for b in xrange(numberOfBatches):
+                        sess.run(trainStep)
+                        
+                # batches of whole frames in random order
+                elif forceMatching:
+                    frameOrder = np.random.permutation(len(self.forceTrain['frames']) - 1)
+                    for frames in np.array_split(frameOrder, numberOfBatches):
+                        trainFeed = self.frameFeed(self.forceTrain, frames, xTrain, yTrain, forceInputs)
+                        sess.run(trainStep, feed_dict=trainFeed)
+                    
                 # offline learning
-                if batchSize == trainSize:    
+                elif batchSize == trainSize:    
                     
                     # pick whole set in random order               
+                    indicies = np.random.choice(trainSize, trainSize, replace=False)
                     xBatch = xTrain[indicies]
                     yBatch = yTrain[indicies]
+                    trainFeed = {x: xBatch, y: yBatch}
                     
                     # train
-                    sess.run(trainStep, feed_dict={x: xBatch, y: yBatch})
+                    sess.run(trainStep, feed_dict=trainFeed)
                     
                 # online learning
                 else:                      
+                    # for shuffling the training set
+                    indicies = np.random.choice(trainSize, trainSize, replace=False)
+                    
                     # loop through whole set, train each iteration
                     for b in xrange(numberOfBatches):
                         batch = indicies[b*batchSize:(b+1)*batchSize]
                         xBatch = xTrain[batch]
                         yBatch = yTrain[batch]
+                        trainFeed = {x: xBatch, y: yBatch}
                         
                         # train
-                        sess.run(trainStep, feed_dict={x: xBatch, y: yBatch})
+                        sess.run(trainStep, feed_dict=trainFeed)
                 
                 if summaryFlag:
                     if not epoch % every:
-                        summary = sess.run(merged, feed_dict={x: xBatch, y: yBatch})
+                        summary = sess.run(merged, feed_dict=trainFeed)
                         train_writer.add_summary(summary, epoch)
 
                 # calculate cost every every epoch
                 if not epoch % every or epoch == numberOfEpochs:
-                    trainError, absErrorTrain = sess.run([trainCost, MAD], feed_dict={x: xBatch, y: yBatch})
-                    testError, absErrorTest   = sess.run([testCost, MAD], feed_dict={x: xTest, y: yTest})
+                    trainError, absErrorTrain = sess.run([trainCost, MAD], feed_dict=trainFeed)
+                    # force matching batches hold the environments of whole frames
+                    trainSamples = len(trainFeed[x]) if forceMatching else batchSize
+                    if testEvaluation == 'subsample':
+                        subset = np.sort(testOrder[:subsetSize])
+                    elif testEvaluation == 'rotate':
+                        subset = np.sort(np.take(testOrder, np.arange(subsetSize) + evaluations*subsetSize, 
+                                                 mode='wrap'))
+                    else:
+                        subset = None
+                    evaluations += 1
+                    (testSquared, absErrorTest), testCount = \
+                        self.testErrors(sess, [squaredError, MAD], x, y, subset, 
+                                        subsetSize if testEvaluation == 'chunked' else None)
+                    testError = testSquared / (2.0*testCount)
                     trainRMSE = np.sqrt(2*trainError)
                     testRMSE = np.sqrt(2*testError)
-                    if testRMSE < testRMSELow:
-                        testRMSELow = testRMSE
-                        epochLow = epoch
-                        end = timer()
-                        timeElapsed = end - start
-                        
+                    
                     print 'Cost/N train test at epoch %4d: TF: %g %g, RMSE: %g %g, MAD: %g %g' % \
                                                     ( epoch, trainError, testError, \
                                                       trainRMSE, \
                                                       testRMSE, \
-                                                      absErrorTrain/float(batchSize), \
-                                                      absErrorTest/float(testSize) )
-                    sys.stdout.flush()
+                                                      absErrorTrain/float(trainSamples), \
+                                                      absErrorTest/float(testCount) )
+                    
+                    # a new low of a subset is confirmed on the whole test set
+                    if testRMSE < testRMSELow or (patience and testRMSE < bestRMSE - minDelta):
+                        fullRMSE = testRMSE
+                        if subset is not None:
+                            (fullSquared, _), _ = self.testErrors(sess, [squaredError, MAD], x, y, 
+                                                                  chunkSize=subsetSize)
+                            fullRMSE = np.sqrt(fullSquared/testSize)
+                            print 'Full test RMSE at epoch %4d: %g' % (epoch, fullRMSE)
+                        if fullRMSE < testRMSELow:
+                            testRMSELow = fullRMSE
+                            epochLow = epoch
+                            end = timer()
+                            timeElapsed = end - start
+                        if patience and fullRMSE < bestRMSE - minDelta:
+                            bestRMSE = fullRMSE
+                            bestEpoch = epoch
+                            bestValues = sess.run(modelVariables)
+                            reportsSinceBest = 0
+                    if epoch != bestEpoch:
+                        reportsSinceBest += 1
+                    if forceMatching:
+                        trainForceError = sess.run(forceSquaredError, feed_dict=trainFeed)
+                        testForceError  = sess.run(forceSquaredError, feed_dict=testForceFeed)
+                        print 'Force RMSE train test at epoch %4d: %g %g' % \
+                              ( epoch, np.sqrt(trainForceError/(3.0*len(trainFeed[F]))), 
+                                np.sqrt(testForceError/(3.0*len(testForceFeed[F]))) )
+                    # output.txt is written when its buffer is full
+                    if self.outputFile is None:
+                        sys.stdout.flush()
                     
-                    if testRMSE / trainRMSE > 10:
+                    if patience and reportsSinceBest >= patience:
+                        print 'No improvement of the test RMSE in %d reports, training ends' % patience
+                        break
+                    elif not patience and testRMSE / trainRMSE > 10:
                         print 'Overfitting is occuring, training ends'
                         break
 
                     if summaryFlag:
-                        summary = sess.run(merged, feed_dict={x: xTest, y: yTest})
+                        summarySet = testOrder[:subsetSize] if testEvaluation != 'full' else slice(None)
+                        summary = sess.run(merged, feed_dict={x: xTest[summarySet], y: yTest[summarySet]})
                         test_writer.add_summary(summary, epoch)
 
                 # if an argument is passed, save the graph variables ('w', 'b') and dump
-                # some info about the training so far to TrainingData/<this run>/meta.dat
+                # some info about the training so far to TrainingData/<this run>/meta.dat,
+                # the records are buffered and written in blocks by metricsLog
                 if saveMetaFlag:
                     if epoch == 0:
-                        saveEpochNumber = 0
-                        with open(saveMetaName, 'w') as outFile:
-                            outStr = '# epochs: %d train: %d, test: %d, batch: %d, nodes: %d, layers: %d \n' \
-                                     % (numberOfEpochs, trainSize, testSize, batchSize, nNodes, nLayers)
-                            outStr += 'a: %1.1f, b: %1.1f, activation: %s, wInit: %s, bInit: %s, learnRate: %g, symm: %s' % \
-                                       (self.a, self.b, self.activation.__name__, self.wInit, self.bInit, self.learningRate, self.symmFuncType)
-                            outFile.write(outStr + '\n')
-                            outStr = 'Inputs: %d, outputs: %d, loaded: %s, sampled: %s \n' %  \
-                                     (self.inputs, self.outputs, loadDir, self.samplesDir)
-                            outFile.write(outStr)
-                            outStr = '%d %g %g' % \
-                                     (epoch, trainRMSE, testRMSE)
-                            outFile.write(outStr + '\n')
-                    else:
-                        if not epoch % every:
-                             with open(saveMetaName, 'a') as outFile :
-                                 outStr = '%d %g %g' % \
-                                          (epoch, trainRMSE, testRMSE)
-                                 outFile.write(outStr + '\n')
+                        outStr = '# epochs: %d train: %d, test: %d, batch: %d, nodes: %d, layers: %d \n' \
+                                 % (numberOfEpochs, trainSize, testSize, batchSize, nNodes, nLayers)
+                        outStr += 'a: %1.1f, b: %1.1f, activation: %s, wInit: %s, bInit: %s, learnRate: %g, symm: %s\n' % \
+                                   (self.a, self.b, self.activation.__name__, self.wInit, self.bInit, self.learningRate, self.symmFuncType)
+                        outStr += 'Inputs: %d, outputs: %d, loaded: %s, sampled: %s \n' %  \
+                                  (self.inputs, self.outputs, loadDir, self.samplesDir)
+                        metrics = metricsLog.MetricsLog(saveMetaName, outStr)
+                    if not epoch % every:
+                        wallTime = timer() - start
+                        metrics.record(epoch, trainRMSE, testRMSE, absErrorTrain/float(trainSamples), 
+                                       absErrorTest/float(testCount), wallTime, 
+                                       (epoch - lastEpoch)*numberOfBatches / max(wallTime - lastWallTime, 1e-9))
+                        lastEpoch = epoch
+                        lastWallTime = wallTime
 
+                # with early stopping only improvements are checkpointed
                 if saveFlag or saveGraphProtoFlag:
-                    if not epoch % every:
+                    if (not patience and not epoch % every) or (patience and epoch == bestEpoch):
                         saveFileName = saveDirName + '/' 'ckpt'
-                        saver.save(sess, saveFileName, global_step=epoch,
-                                   latest_filename="checkpoint_state")
+                        checkpoints.save(sess, saveFileName, epoch)
+                        savedEpoch = epoch
                         
                 # finish training if RMSE of test set is below tolerance
                 if testRMSE < self.RMSEtol:
                     print "Reached RMSE tolerance"
                     break
                 
+            # continue with the best weights, which are written to the network files
+            if bestValues is not None:
+                sess.run(restoreBest, feed_dict=dict(zip(bestPlaceholders, bestValues)))
+                print 'Restored the weights of epoch %d, test RMSE: %g' % (bestEpoch, bestRMSE)
+                
+            # the reports only covered a part of the test set
+            if testEvaluation in ['subsample', 'rotate'] and numberOfEpochs >= 0:
+                (testSquared, absErrorTest), _ = self.testErrors(sess, [squaredError, MAD], x, y, 
+                                                                 chunkSize=subsetSize)
+                print 'Full test RMSE: %g, MAD: %g' % (np.sqrt(testSquared/testSize), absErrorTest/testSize)
+                
+            if saveFlag or saveGraphProtoFlag:
+                checkpoints.close()
+            if metrics is not None:
+                metrics.close()
+            sys.stdout.flush()
             
             if numberOfEpochs == -1:
                 print sess.run(trainCost, feed_dict={x: xTrain[0].reshape([1,self.inputs]), y: yTrain[0].reshape([1,1])})
@@ -547,40 +1019,23 @@ class Regression:
                 print '%.16g' % sess.run(prediction, feed_dict={x: xTrain[0].reshape([1,self.inputs])})
                 print  sess.run(networkGradient, feed_dict={x: xTrain})                                           
                         
+            if inputPipeline:
+                coordinator.request_stop()
+                coordinator.join(threads)
+                
             # elapsed time
             end = timer();
             print "Time elapsed: %g" % (end-start)
 
             # write network to file when training is finished
-            if saveGraphFlag:
-                with open(saveGraphName, 'w') as outFile:
-                    outStr = "%1d %1d %s %d %d" % (nLayers, nNodes, self.activation.__name__, \
-                                                   self.inputs, self.outputs)
-                    outFile.write(outStr + '\n')
-                    size = len(self.neuralNetwork.allWeights)
-                    for i in range(size):
-                        weights = sess.run(self.neuralNetwork.allWeights[i])
-                        if i < size-1:
-                            for j in range(len(weights)):
-                                for k in range(len(weights[0])):
-                                    outFile.write("%.16g" % weights[j][k])
-                                    outFile.write(" ")
-                                outFile.write("\n")
-                        else:
-                            for j in range(len(weights[0])):
-                                for k in range(len(weights)):
-                                    outFile.write("%.16g" % weights[k][j])
-                                    outFile.write(" ")
-                                outFile.write("\n")
-
-                    outFile.write("\n")
-
-                    for biasVariable in self.neuralNetwork.allBiases:
-                        biases = sess.run(biasVariable)
-                        for j in range(len(biases)):
-                            outFile.write("%.16g" % biases[j])
-                            outFile.write(" ")
-                        outFile.write("\n")
+            if saveGraphFlag or saveGraphTextFlag:
+                weights = sess.run(self.neuralNetwork.allWeights)
+                biases = sess.run(self.neuralNetwork.allBiases)
+                if saveGraphFlag:
+                    networkFile.writeNetwork(saveGraphName, weights, biases, self.activation.__name__)
+                if saveGraphTextFlag:
+                    networkFile.writeNetworkText(saveGraphTextName, weights, biases, 
+                                                 self.activation.__name__)
 
             # save parameters to file
             if saveParametersFlag:
@@ -627,14 +1082,14 @@ class Regression:
                                     outFile.write(" ")
                             outFile.write("\n")
 
-            # freeze graph
-            if saveGraphProtoFlag:
+            # freeze graph with the last checkpoint, that of the best epoch with early stopping
+            if saveGraphProtoFlag and savedEpoch is not None:
                 tf.train.write_graph(sess.graph_def, trainingDir, 'graph.pb')
 
                 input_graph_path = trainingDir + '/graph.pb'
                 input_saver_def_path = ""
                 input_binary = False
-                input_checkpoint_path = saveFileName + '-' + str(saveEpochNumber-1)
+                input_checkpoint_path = saveFileName + '-' + str(savedEpoch)
                 output_node_names = "outputLayer/activation"
                 restore_op_name = "save/restore_all"
                 filename_tensor_name = "save/Const:0"
@@ -647,7 +1102,7 @@ class Regression:
                              filename_tensor_name, output_graph_path,
                              clear_devices, "")
 
-            if saveFlag or saveGraphFlag:
+            if saveFlag or saveGraphFlag or saveGraphTextFlag:
                 self.outputFile.close()
             
             # plot RMSE as function of epoch